@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""Benchmark fix-quant-python-sql.py on a synthetic stock ledger.
+
+``generate`` creates the minimal Odoo 12 stock tables in a dedicated schema
+of a local PostgreSQL database and fills them with a reproducible (--seed)
+ledger: products, internal locations, done moves and their move lines,
+done inventories, and quants of which some are deliberately corrupted
+(wrong quantity, split in several quants, missing). A part of the
+inventory moves is dropped so that the move lines disagree with the
+inventories, as in the databases the script fixes, and some products have
+a leftover quant on a location where their only move line is cancelled or
+not done yet. The quantity each
+(product, location) must have after the fix is kept in
+fix_quant_benchmark_expected.
+
+    python3 fix-quant-benchmark.py --dsn "dbname=bench" generate --products 2000 --moves 200000
+
+``run`` restores the generated quants, moves and move lines, drops the
+tables kept by the previous runs (incremental watermark, ledger,
+reconciliation), runs do_the_thing() through a counting ``env.cr`` and
+reports the throughput, the queries by kind, the phases of the script and
+its correctness: the pairs whose quants differ from the expected quantity
+or from their move lines, and the pairs with more than one quant. The result can be saved
+and compared to a baseline:
+
+    python3 fix-quant-benchmark.py --dsn "dbname=bench" run --save baseline.json
+    python3 fix-quant-benchmark.py --dsn "dbname=bench" run --bulk --baseline baseline.json
+
+Requires psycopg2.
+"""
+import argparse
+import datetime
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import time
+
+import psycopg2
+
+RUNNER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fix-quant-runner.py')
+
+_spec = importlib.util.spec_from_file_location('fix_quant_runner', RUNNER_PATH)
+runner = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(runner)
+
+SCHEMA = """
+CREATE TABLE stock_location (
+    id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    location_id integer,
+    parent_path varchar,
+    usage varchar NOT NULL,
+    company_id integer
+);
+CREATE TABLE stock_warehouse (
+    id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    view_location_id integer NOT NULL,
+    company_id integer
+);
+CREATE TABLE product_category (
+    id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    parent_id integer,
+    parent_path varchar
+);
+CREATE TABLE product_template (
+    id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    type varchar NOT NULL,
+    categ_id integer NOT NULL,
+    uom_id integer NOT NULL,
+    company_id integer
+);
+CREATE TABLE product_product (
+    id serial PRIMARY KEY,
+    product_tmpl_id integer NOT NULL
+);
+CREATE TABLE stock_inventory (
+    id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    date timestamp NOT NULL,
+    state varchar NOT NULL,
+    write_date timestamp
+);
+CREATE TABLE stock_inventory_line (
+    id serial PRIMARY KEY,
+    inventory_id integer NOT NULL,
+    product_id integer NOT NULL,
+    location_id integer NOT NULL,
+    product_qty numeric NOT NULL
+);
+CREATE TABLE stock_move (
+    id serial PRIMARY KEY,
+    create_uid integer,
+    create_date timestamp,
+    write_uid integer,
+    write_date timestamp,
+    date timestamp NOT NULL,
+    date_expected timestamp,
+    procure_method varchar,
+    company_id integer,
+    is_done boolean,
+    location_dest_id integer NOT NULL,
+    location_id integer NOT NULL,
+    name varchar NOT NULL,
+    product_id integer NOT NULL,
+    product_uom integer,
+    product_uom_qty numeric,
+    state varchar NOT NULL,
+    inventory_id integer
+);
+CREATE TABLE stock_move_line (
+    id serial PRIMARY KEY,
+    create_uid integer,
+    create_date timestamp,
+    write_uid integer,
+    write_date timestamp,
+    date timestamp NOT NULL,
+    done_move boolean,
+    location_dest_id integer NOT NULL,
+    location_id integer NOT NULL,
+    move_id integer,
+    product_id integer NOT NULL,
+    product_uom_id integer,
+    product_uom_qty numeric,
+    qty_done numeric,
+    done_wo boolean,
+    product_qty numeric,
+    state varchar
+);
+CREATE TABLE stock_quant (
+    id serial PRIMARY KEY,
+    create_uid integer,
+    create_date timestamp,
+    write_uid integer,
+    write_date timestamp,
+    in_date timestamp,
+    location_id integer NOT NULL,
+    product_id integer NOT NULL,
+    quantity numeric NOT NULL,
+    reserved_quantity numeric NOT NULL DEFAULT 0,
+    company_id integer
+);
+CREATE INDEX stock_move_product_id_index ON stock_move (product_id);
+CREATE INDEX stock_move_line_product_id_index ON stock_move_line (product_id);
+CREATE INDEX stock_move_line_move_id_index ON stock_move_line (move_id);
+CREATE INDEX stock_quant_product_id_index ON stock_quant (product_id);
+CREATE INDEX stock_quant_location_id_index ON stock_quant (location_id);
+CREATE INDEX stock_inventory_line_product_id_index ON stock_inventory_line (product_id);
+CREATE TABLE fix_quant_benchmark_expected (
+    product_id integer NOT NULL,
+    location_id integer NOT NULL,
+    quantity numeric NOT NULL,
+    PRIMARY KEY (product_id, location_id)
+);
+"""
+
+# the tables run restores from their fix_quant_benchmark_<table> copy
+LEDGER_TABLES = ('stock_quant', 'stock_move', 'stock_move_line')
+# the tables the script and the runner keep from a run to the next one, dropped by run: they would
+# hold balances and desired quantities of the ledger before the restore
+RUN_STATE_TABLES = ('fix_quant_watermark', 'fix_quant_snapshot', 'fix_quant_todo', 'fix_quant_ledger',
+                    'fix_quant_ledger_pending', 'fix_quant_ledger_watermark', runner.RECONCILIATION_TABLE)
+
+VENDOR_LOCATION_ID = 1
+CUSTOMER_LOCATION_ID = 2
+VIEW_LOCATION_ID = 3
+INVENTORY_LOCATION_ID = 5
+FIRST_INTERNAL_LOCATION_ID = 10
+UOM_ID = 1
+CATEGORY_ID = 1
+COMPANY_ID = 1
+START_DATE = datetime.datetime(2019, 1, 1)
+
+
+class CountingCursor(runner.Cursor):
+    "A runner cursor counting the queries by kind (first keyword) and their time."
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.queries = {}
+        self.seconds = 0.0
+
+    def execute(self, query, params=None):
+        words = query.split(None, 1)
+        kind = words[0].upper() if words else ''
+        self.queries[kind] = self.queries.get(kind, 0) + 1
+        start = time.monotonic()
+        try:
+            return super().execute(query, params)
+        finally:
+            self.seconds += time.monotonic() - start
+
+
+class Copy:
+    "Buffer the rows of a table in memory and COPY them every ``size`` rows."
+
+    def __init__(self, cr, table, columns, size=100000):
+        self.cr = cr
+        self.table = table
+        self.columns = columns
+        self.size = size
+        self.buffer = io.StringIO()
+        self.count = 0
+
+    def write(self, *row):
+        self.buffer.write('\t'.join('\\N' if value is None else str(value) for value in row) + '\n')
+        self.count += 1
+        if self.count % self.size == 0:
+            self.flush()
+
+    def flush(self):
+        self.buffer.seek(0)
+        self.cr.copy_expert('COPY %s (%s) FROM STDIN' % (self.table, ', '.join(self.columns)), self.buffer)
+        self.buffer = io.StringIO()
+
+
+def connect(dsn, schema):
+    "Open a connection whose search_path is the benchmark schema."
+    connection = psycopg2.connect(dsn)
+    with connection.cursor() as cr:
+        cr.execute('SET search_path TO %s' % schema)
+    connection.commit()
+    return connection
+
+
+def generate(dsn, schema, args):
+    "Create the benchmark schema and fill it with a synthetic ledger."
+    rng = random.Random(args.seed)
+    connection = psycopg2.connect(dsn)
+    cr = connection.cursor()
+    cr.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+    cr.execute('CREATE SCHEMA %s' % schema)
+    cr.execute('SET search_path TO %s' % schema)
+    cr.execute(SCHEMA)
+
+    # locations: vendors, customers, the warehouse view, inventory adjustment and the internal ones
+    locations = Copy(cr, 'stock_location', ('id', 'name', 'location_id', 'parent_path', 'usage', 'company_id'))
+    locations.write(VENDOR_LOCATION_ID, 'Partner Locations/Vendors', None, '1/', 'supplier', None)
+    locations.write(CUSTOMER_LOCATION_ID, 'Partner Locations/Customers', None, '2/', 'customer', None)
+    locations.write(VIEW_LOCATION_ID, 'WH', None, '3/', 'view', COMPANY_ID)
+    locations.write(INVENTORY_LOCATION_ID, 'Virtual Locations/Inventory adjustment', None, '5/', 'inventory', None)
+    internal_location_ids = list(range(FIRST_INTERNAL_LOCATION_ID, FIRST_INTERNAL_LOCATION_ID + args.locations))
+    for location_id in internal_location_ids:
+        locations.write(location_id, 'WH/Stock/%s' % location_id, VIEW_LOCATION_ID,
+                        '%s/%s/' % (VIEW_LOCATION_ID, location_id), 'internal', COMPANY_ID)
+    locations.flush()
+    cr.execute("INSERT INTO stock_warehouse (id, name, view_location_id, company_id) VALUES (1, 'WH', %s, %s)",
+               (VIEW_LOCATION_ID, COMPANY_ID))
+    cr.execute("INSERT INTO product_category (id, name, parent_id, parent_path) VALUES (%s, 'All', NULL, '1/')",
+               (CATEGORY_ID,))
+
+    templates = Copy(cr, 'product_template', ('id', 'name', 'type', 'categ_id', 'uom_id', 'company_id'))
+    products = Copy(cr, 'product_product', ('id', 'product_tmpl_id'))
+    stockable_ids = []
+    for product_id in range(1, args.products + 1):
+        stockable = rng.random() >= args.consumables
+        templates.write(product_id, 'Product %s' % product_id, 'product' if stockable else 'consu', CATEGORY_ID, UOM_ID,
+                        rng.choice((COMPANY_ID, None)))
+        products.write(product_id, product_id)
+        if stockable:
+            stockable_ids.append(product_id)
+    templates.flush()
+    products.flush()
+
+    days = args.days
+    inventory_dates = sorted(START_DATE + datetime.timedelta(days=rng.uniform(0, days), microseconds=1)
+                             for _i in range(args.inventories))
+    inventories = Copy(cr, 'stock_inventory', ('id', 'name', 'date', 'state', 'write_date'))
+    for inventory_id, date in enumerate(inventory_dates, 1):
+        inventories.write(inventory_id, 'Inventory %s' % inventory_id, date, 'done', date)
+    inventories.flush()
+
+    move_columns = ('id', 'date', 'company_id', 'is_done', 'location_dest_id', 'location_id', 'name', 'product_id',
+                    'product_uom', 'product_uom_qty', 'state', 'inventory_id')
+    line_columns = ('id', 'date', 'done_move', 'location_dest_id', 'location_id', 'move_id', 'product_id',
+                    'product_uom_id', 'product_uom_qty', 'qty_done', 'done_wo', 'product_qty', 'state')
+    moves = Copy(cr, 'stock_move', move_columns)
+    lines = Copy(cr, 'stock_move_line', line_columns)
+    inventory_lines = Copy(cr, 'stock_inventory_line',
+                           ('id', 'inventory_id', 'product_id', 'location_id', 'product_qty'))
+    quants = Copy(cr, 'stock_quant', ('id', 'in_date', 'location_id', 'product_id', 'quantity',
+                                      'reserved_quantity', 'company_id'))
+    expected = Copy(cr, 'fix_quant_benchmark_expected', ('product_id', 'location_id', 'quantity'))
+    ids = {'move': 0, 'line': 0, 'inventory_line': 0, 'quant': 0}
+    counts = {'pairs': 0, 'corrupted quants': 0, 'ledger errors': 0, 'stale quants': 0}
+
+    def move(date, product_id, location_id, location_dest_id, quantity, name, inventory_id=None, state='done'):
+        ids['move'] += 1
+        ids['line'] += 1
+        done = 't' if state == 'done' else 'f'
+        moves.write(ids['move'], date, COMPANY_ID, done, location_dest_id, location_id, name, product_id,
+                    UOM_ID, quantity, state, inventory_id)
+        lines.write(ids['line'], date, done, location_dest_id, location_id, ids['move'], product_id,
+                    UOM_ID, 0, quantity, done, quantity, state)
+
+    def quant(product_id, location_id, quantity):
+        ids['quant'] += 1
+        quants.write(ids['quant'], START_DATE, location_id, product_id, quantity, 0, COMPANY_ID)
+
+    moves_per_product = max(1, args.moves // max(1, len(stockable_ids)))
+    for product_id in stockable_ids:
+        product_locations = rng.sample(internal_location_ids,
+                                       rng.randint(1, min(args.locations_per_product, len(internal_location_ids))))
+        dates = sorted(START_DATE + datetime.timedelta(days=rng.uniform(0, days))
+                       for _i in range(rng.randint(1, 2 * moves_per_product)))
+        # move lines balance, and what the script must restore: last inventory + later moves
+        balance = dict.fromkeys(product_locations, 0)
+        desired = dict.fromkeys(product_locations, 0)
+        events = [(date, None) for date in dates]
+        for inventory_id, date in enumerate(inventory_dates, 1):
+            if rng.random() < args.inventory_coverage:
+                events.append((date, inventory_id))
+        events.sort()
+        for date, inventory_id in events:
+            if inventory_id:
+                for location_id in product_locations:
+                    counted = max(0, desired[location_id] + rng.choice((0, 0, 0, -1, 1, -2, 3)))
+                    ids['inventory_line'] += 1
+                    inventory_lines.write(ids['inventory_line'], inventory_id, product_id, location_id, counted)
+                    difference = counted - balance[location_id]
+                    desired[location_id] = counted
+                    if rng.random() < args.ledger_errors:
+                        # the inventory move got lost: the move lines disagree with the inventory
+                        counts['ledger errors'] += 1
+                        continue
+                    if difference > 0:
+                        move(date, product_id, INVENTORY_LOCATION_ID, location_id, difference,
+                             'INV:Inventory %s' % inventory_id, inventory_id)
+                    elif difference < 0:
+                        move(date, product_id, location_id, INVENTORY_LOCATION_ID, -difference,
+                             'INV:Inventory %s' % inventory_id, inventory_id)
+                    balance[location_id] = counted
+                continue
+            location_id = rng.choice(product_locations)
+            kind = rng.random()
+            if kind < 0.4 or balance[location_id] <= 0:
+                quantity = rng.randint(1, 20)
+                move(date, product_id, VENDOR_LOCATION_ID, location_id, quantity, 'WH/IN/%s' % ids['move'])
+                balance[location_id] += quantity
+                desired[location_id] += quantity
+            elif kind < 0.85 or len(product_locations) == 1:
+                quantity = rng.randint(1, balance[location_id])
+                move(date, product_id, location_id, CUSTOMER_LOCATION_ID, quantity, 'WH/OUT/%s' % ids['move'])
+                balance[location_id] -= quantity
+                desired[location_id] -= quantity
+            else:
+                location_dest_id = rng.choice([other for other in product_locations if other != location_id])
+                quantity = rng.randint(1, balance[location_id])
+                move(date, product_id, location_id, location_dest_id, quantity, 'WH/INT/%s' % ids['move'])
+                balance[location_id] -= quantity
+                desired[location_id] -= quantity
+                balance[location_dest_id] += quantity
+                desired[location_dest_id] += quantity
+
+        for location_id in product_locations:
+            counts['pairs'] += 1
+            expected.write(product_id, location_id, desired[location_id])
+            quantity = balance[location_id]
+            corruption = rng.random() if rng.random() < args.corrupt_quants else None
+            if corruption is None:
+                if quantity:
+                    quant(product_id, location_id, quantity)
+                continue
+            counts['corrupted quants'] += 1
+            if corruption < 0.4:
+                quant(product_id, location_id, quantity + rng.choice((-5, -1, 1, 2, 10)))
+            elif corruption < 0.8:
+                # split in several quants, the total may be right or wrong
+                for _part in range(rng.randint(1, 3)):
+                    part = rng.randint(-3, 3)
+                    quant(product_id, location_id, part)
+                    quantity -= part
+                quant(product_id, location_id, quantity + rng.choice((0, 0, 1, -1)))
+            # else: the quant is missing
+
+        other_locations = [location_id for location_id in internal_location_ids if location_id not in product_locations]
+        if other_locations and rng.random() < args.stale_quants:
+            # only a move line not done there, and a quant left over: realigned to 0
+            location_id = rng.choice(other_locations)
+            quantity = rng.randint(1, 20)
+            move(rng.choice(dates), product_id, VENDOR_LOCATION_ID, location_id, quantity,
+                 'WH/IN/%s' % (ids['move'] + 1), state=rng.choice(('cancel', 'assigned')))
+            counts['pairs'] += 1
+            counts['stale quants'] += 1
+            expected.write(product_id, location_id, 0)
+            quant(product_id, location_id, quantity)
+
+    for copy in (moves, lines, inventory_lines, quants, expected):
+        copy.flush()
+
+    for table in ('stock_location', 'stock_warehouse', 'product_category', 'product_template', 'product_product', 'stock_inventory',
+                  'stock_inventory_line') + LEDGER_TABLES:
+        cr.execute("SELECT setval('%s_id_seq', (SELECT COALESCE(max(id), 0) + 1 FROM %s), false)" % (table, table))
+    for table in LEDGER_TABLES:
+        cr.execute('CREATE TABLE fix_quant_benchmark_%s AS SELECT * FROM %s' % (table, table))
+    cr.execute("""
+        CREATE TABLE product_locks AS
+            SELECT id, 'f' AS processed, NULL::varchar AS claimed_by, NULL::timestamp AS claimed_at,
+                0 AS attempts, NULL::varchar AS error
+            FROM product_product;
+        CREATE INDEX ON product_locks (id);
+    """)
+    cr.execute('ANALYZE')
+    connection.commit()
+    connection.close()
+    print('%s products (%s stockable), %s locations, %s moves, %s inventory lines, %s quants' % (
+        args.products, len(stockable_ids), args.locations, ids['move'], ids['inventory_line'], ids['quant']))
+    print('%(pairs)s pairs, %(corrupted quants)s corrupted quants, %(ledger errors)s lost inventory moves, '
+          '%(stale quants)s quants without done move line' % counts)
+
+
+def restore(cr):
+    "Put back the generated ledger, drop the state of the previous runs and mark all the products unprocessed."
+    for table in LEDGER_TABLES:
+        cr.execute('TRUNCATE %s' % table)
+        cr.execute('INSERT INTO %s SELECT * FROM fix_quant_benchmark_%s' % (table, table))
+        cr.execute("SELECT setval('%s_id_seq', (SELECT COALESCE(max(id), 0) + 1 FROM %s), false)" % (table, table))
+    cr.execute('DROP TABLE IF EXISTS %s' % ', '.join(RUN_STATE_TABLES))
+    cr.execute("UPDATE product_locks SET processed = 'f', claimed_by = NULL, claimed_at = NULL, attempts = 0, error = NULL")
+    cr.execute('ANALYZE')
+
+
+def correctness(cr):
+    """Return the number of pairs whose quants differ from the expected quantity,
+    or from their move lines, and the number of pairs with several quants."""
+    cr.execute("""
+        WITH quants AS (
+            SELECT q.product_id, q.location_id, sum(q.quantity) AS quantity, count(*) AS quants
+            FROM stock_quant q
+            JOIN stock_location l ON l.id = q.location_id AND l.usage = 'internal'
+            GROUP BY q.product_id, q.location_id
+        ), lines AS (
+            SELECT t.product_id, t.location_id, sum(t.quantity) AS quantity
+            FROM stock_move_line l
+            JOIN stock_move m ON m.id = l.move_id AND m.state = 'done'
+            CROSS JOIN LATERAL (VALUES (l.product_id, l.location_id, - l.qty_done),
+                                       (l.product_id, l.location_dest_id, l.qty_done)) AS t (product_id, location_id, quantity)
+            GROUP BY t.product_id, t.location_id
+        )
+        SELECT
+            count(*) FILTER (WHERE COALESCE(q.quantity, 0) <> e.quantity),
+            count(*) FILTER (WHERE COALESCE(q.quantity, 0) <> COALESCE(ml.quantity, 0)),
+            count(*) FILTER (WHERE q.quants > 1)
+        FROM fix_quant_benchmark_expected e
+        LEFT JOIN quants q ON q.product_id = e.product_id AND q.location_id = e.location_id
+        LEFT JOIN lines ml ON ml.product_id = e.product_id AND ml.location_id = e.location_id
+    """)
+    wrong_quantity, quant_line_mismatch, duplicated = cr.fetchone()
+    return {'wrong_quantity': wrong_quantity, 'quant_line_mismatch': quant_line_mismatch,
+            'duplicated': duplicated}
+
+
+def run(dsn, schema, args):
+    "Restore the ledger, run do_the_thing() and return the measures."
+    constants = {'CRON_ID': 'benchmark', 'BULK_MODE': args.bulk, 'COMMIT_EACH_PRODUCT': args.commit_each_product}
+    if args.batch_size:
+        constants['CLAIM_BATCH_SIZE'] = args.batch_size
+    for assignment in args.set or ():
+        name, value = assignment.split('=', 1)
+        constants[name] = json.loads(value)
+    if constants.get('RECONCILIATION_TABLE'):
+        raise SystemExit('RECONCILIATION_TABLE is filled by fix-quant-runner.py --numpy, not by the benchmark')
+    connection = connect(dsn, schema)
+    cr = CountingCursor(connection)
+    restore(cr.cursor)
+    connection.commit()
+    before = correctness(cr.cursor)
+
+    namespace = runner.load_script(runner.Environment(cr), path=args.script, **constants)
+
+    start = time.monotonic()
+    stats = namespace['do_the_thing']()
+    connection.commit()
+    seconds = time.monotonic() - start
+
+    after = correctness(cr.cursor)
+    connection.close()
+    return {
+        'constants': constants,
+        'seconds': seconds,
+        'products': stats['products'],
+        'locations': stats['locations'],
+        'products_per_second': stats['products'] / seconds if seconds else 0.0,
+        'queries': sum(cr.queries.values()),
+        'query_seconds': cr.seconds,
+        'queries_by_kind': cr.queries,
+        'phases': stats.get('phases', {}),
+        'before': before,
+        'after': after,
+    }
+
+
+def report(result, baseline=None):
+    "Print the measures of a run, next to the ones of the baseline."
+    rows = [
+        ('seconds', '%.2f'),
+        ('products', '%s'),
+        ('locations', '%s'),
+        ('products_per_second', '%.2f'),
+        ('queries', '%s'),
+        ('query_seconds', '%.2f'),
+    ]
+    print('%-28s %14s %14s %9s' % ('', 'run', 'baseline', 'change'))
+    for name, template in rows:
+        line = '%-28s %14s' % (name, template % result[name])
+        if baseline:
+            change = (result[name] - baseline[name]) * 100.0 / baseline[name] if baseline[name] else 0.0
+            line += ' %14s %8.1f%%' % (template % baseline[name], change)
+        print(line)
+    for kind, count in sorted(result['queries_by_kind'].items()):
+        line = '%-28s %14s' % ('queries ' + kind, count)
+        if baseline:
+            line += ' %14s' % baseline['queries_by_kind'].get(kind, 0)
+        print(line)
+    for phase, stats in sorted(result['phases'].items(), key=lambda item: -item[1]['seconds']):
+        line = '%-28s %14.2f' % ('seconds in ' + phase, stats['seconds'])
+        if baseline and phase in baseline['phases']:
+            line += ' %14.2f' % baseline['phases'][phase]['seconds']
+        print(line)
+    for name in ('wrong_quantity', 'quant_line_mismatch', 'duplicated'):
+        line = '%-28s %14s' % ('%s (before: %s)' % (name, result['before'][name]), result['after'][name])
+        if baseline:
+            line += ' %14s' % baseline['after'][name]
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dsn', required=True, help='libpq connection string of a scratch database')
+    parser.add_argument('--schema', default='fix_quant_benchmark', help='schema of the benchmark tables')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='(re)create the schema and the synthetic ledger')
+    generate_parser.add_argument('--seed', type=int, default=42)
+    generate_parser.add_argument('--products', type=int, default=1000)
+    generate_parser.add_argument('--consumables', type=float, default=0.1,
+                                 help='share of non-stockable products')
+    generate_parser.add_argument('--locations', type=int, default=20, help='number of internal locations')
+    generate_parser.add_argument('--locations-per-product', type=int, default=3)
+    generate_parser.add_argument('--moves', type=int, default=50000, help='approximate number of moves')
+    generate_parser.add_argument('--days', type=int, default=730, help='period covered by the moves')
+    generate_parser.add_argument('--inventories', type=int, default=4)
+    generate_parser.add_argument('--inventory-coverage', type=float, default=0.5,
+                                 help='share of the products counted by each inventory')
+    generate_parser.add_argument('--ledger-errors', type=float, default=0.05,
+                                 help='share of the inventory moves lost')
+    generate_parser.add_argument('--corrupt-quants', type=float, default=0.1,
+                                 help='share of the pairs whose quants are corrupted')
+    generate_parser.add_argument('--stale-quants', type=float, default=0.02,
+                                 help='share of the products with a quant where they only have a move line not done')
+
+    run_parser = commands.add_parser('run', help='restore the ledger, fix it and report')
+    run_parser.add_argument('--script', default=runner.SCRIPT_PATH, help='script to benchmark')
+    run_parser.add_argument('--bulk', action='store_true', help='set BULK_MODE')
+    run_parser.add_argument('--commit-each-product', action='store_true', help='set COMMIT_EACH_PRODUCT')
+    run_parser.add_argument('--batch-size', type=int, help='override CLAIM_BATCH_SIZE')
+    run_parser.add_argument('--set', action='append', metavar='NAME=JSON',
+                            help='override a global variable of the script, e.g. --set FETCH_SIZE=50000')
+    run_parser.add_argument('--log', action='store_true', help='show the messages of the script')
+    run_parser.add_argument('--save', metavar='FILE', help='write the measures to FILE (JSON)')
+    run_parser.add_argument('--baseline', metavar='FILE', help='compare with the measures saved in FILE')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'generate':
+        generate(args.dsn, args.schema, args)
+        return
+    runner.setup_logging(logging.INFO if args.log else logging.WARNING)
+    result = run(args.dsn, args.schema, args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(result, save_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
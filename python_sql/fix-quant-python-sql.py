@@ -4,19 +4,10 @@
 #        How to use it ?
 #        ----------------
 #
-#        1. Adapt the script or odoo code.
-#            1.1 Add the print opcode to debug.
-#                1.1.1. search for 'def safe_eval' in all code or in odoo/odoo/tools/safe_eval.py
-#                1.1.2. add the print opcode:
-#                    just above the 'def safe_eval' there is a list of allowed builtins, all the print
-#                    ...
-#                    'Exception': Exception,
-#                    'print': print, <----------------------------- add this line
-#                1.1.3. save and restart odoo-bin to take the change into account
-#                or
-#            1.2 comment all the print in this script (replace all 'print' by '#print')
 #        1. Check the global variable below.
 #        2. Copy the code in a server action and run it
+#        or
+#        2. Run it outside of Odoo with a pool of processes, see fix-quant-runner.py
 #
 #
 #        How does it works ?
@@ -24,7 +15,8 @@
 #
 #        Here is a very small summary of what it does:
 #        take a backup
-#        for each for stockable product
+#        claim a batch of products in product_locks
+#        for each for stockable product of the batch
 #            for each stock_location with 'internal' usage:
 #                # realign the quants regarding the stock_move_line
 #                look in stock_move_line what quantity should be in this location
@@ -38,83 +30,586 @@
 #                merge the quants
 #        take a backup
 #
+#        With BULK_MODE = True, the realignment with the stock_move_line is done for all the
+#        products of the batch at once before the loop:
+#            keep the stockable products of the batch (fix_quant_product temporary table)
+#            compute the stock_move_line balance and the current quant quantity of every internal
+#            (product, location) in one grouped pass (fix_quant_balance temporary table)
+#            insert all the non-zero quant deltas in one statement
+#            find the latest inventory adjustment and the stock_move_line delta since then of every
+#            (product, location) in one pass (fix_quant_desired temporary table, read by set_quants)
+#        and, after the inventory corrections of the batch, the company of the quants is fixed and
+#        the quants of the batch are merged in one pass (consolidate_quants).
+#        Use a big CLAIM_BATCH_SIZE with the bulk mode.
+#        With RECONCILIATION_TABLE set, the stock_move_line balances and the desired quantities are
+#        read from that table instead of stock_move_line: fix-quant-runner.py --numpy fills it
+#        before the run from one sequential scan of the done stock_move_line, aggregated with NumPy.
+#
+#        With PREFETCH set (fix-quant-runner.py --pipeline, not with BULK_MODE), the state of each
+#        product (stock_move_line balance, current quant and desired quantity of each internal
+#        location, PRODUCT_STATE_QUERY, or PRODUCT_LEDGER_STATE_QUERY with LEDGER) is read ahead on
+#        another connection while the corrections of the previous products are written:
+#        fix_prefetched_product() only sends the writes.
+#
+#        With WRITE_BUFFER_SIZE > 0, the correction moves, their move lines and the quants are
+#        buffered (PENDING_WRITES) and sent a few statements for all of them (flush_writes()): one
+#        INSERT ... SELECT FROM unnest() for the moves whose RETURNING feeds the move lines, one for
+#        the quants, then one merge of the quants of all the (product, location) merge_quant() was
+#        called for. After the realignment, the quant quantity of a pair is its stock_move_line
+#        balance: the quants are only read back with VERBOSE. The buffer is flushed when it is full,
+#        before the quants of a buffered (product, location) are read, before consolidate_quants()
+#        and before a commit.
+#
+#        merge_all_quants() fixes the company and merges the quants of the whole stock_quant table,
+#        MERGE_CHUNK_SIZE product ids at a time.
+#
+#        The non-stockable products are flagged as processed before claiming any product. The uom of
+#        the stockable products is loaded once per batch (or once per run with PRODUCT_CACHE_PER_RUN =
+#        True) in PRODUCT_METADATA instead of being queried product by product: being in the map is
+#        being stockable.
+#        The internal locations (fix_quant_location temporary table and INTERNAL_LOCATION_IDS) and the
+#        internal locations of every unprocessed product (PRODUCT_LOCATIONS) are loaded once per run,
+#        with one grouped pass over stock_move_line.
+#
+#        The products are claimed by batch of CLAIM_BATCH_SIZE with FOR UPDATE SKIP LOCKED: the
+#        crons never wait for each other. product_locks keeps which cron claimed the product
+#        (claimed_by) and when (claimed_at). If a cron crashed (with COMMIT_EACH_PRODUCT = True),
+#        its unprocessed products are claimed again by another cron after CLAIM_LEASE_MINUTES; the
+#        lease of the products of the current batch is renewed at each commit.
+#
+#        A run can be limited to a location subtree (SCOPE_LOCATION_ID, with stock_location.parent_path),
+#        a warehouse (SCOPE_WAREHOUSE_ID, the subtree of its view location), a company of the locations
+#        (SCOPE_COMPANY_ID) and a product category with its children (SCOPE_CATEGORY_ID), on top of the
+#        product id range (MIN_PRODUCT_ID, MAX_PRODUCT_ID). The internal locations of the scope are the
+#        only ones loaded in fix_quant_location, so the stock_move_line scans, the bulk balances and
+#        the merges only see them; only the products with a move line in these locations (and in the
+#        category) are claimed (fix_quant_scope_product). A scoped run flags its products as processed:
+#        reset product_locks (processed = 'f') before a run with another scope.
+#
+#        The fixed products are committed every COMMIT_EVERY_PRODUCTS products or every
+#        COMMIT_EVERY_SECONDS seconds, whichever comes first (0: not used, COMMIT_EACH_PRODUCT = True
+#        is every product; without any of them the run is one transaction). In bulk mode, the
+#        commits only happen at the end of a batch. With PRODUCT_SAVEPOINTS = True, each product is
+#        fixed in its own savepoint: a failure only rolls back that product, which is released in
+#        product_locks with the error and claimed again later by another cron or the next run (not by
+#        the same run, FAILED_PRODUCT_IDS), up to MAX_ATTEMPTS times; then it is flagged as processed,
+#        with its error kept in product_locks.
+#
+#        With DRY_RUN = True, nothing is written: do_the_thing() computes, for every internal
+#        (product, location) of the unprocessed stockable products, the stock_move_line balance, the
+#        desired and the current quant quantity (with the bulk temporary tables) and streams the
+#        pairs that would be corrected as CSV (logged, or written by fix-quant-runner.py --dry-run).
+#
+#        Everything goes through log() (the ir_logging table in a server action, the log of
+#        fix-quant-runner.py otherwise). The details of each (product, location) are only logged with
+#        VERBOSE = True. Every SUMMARY_INTERVAL seconds, and at the end, a summary is logged:
+#        products/sec, ETA of the remaining products of product_locks, wall time, queries and rows
+#        of each phase (realign, find_desired, adjustment, merge, ...) and the slowest pairs.
+#
+#        With INCREMENTAL = True, the run only processes the (product, location) touched since the
+#        previous run. When there is no unprocessed product left in product_locks, the first cron:
+#            saves a watermark (fix_quant_watermark): max stock_move_line id, min id of the
+#            stock_move_line not done yet, max stock_inventory_line id
+#            fills fix_quant_todo with the internal (product, location) having a stock_move_line
+#            created or updated since the previous watermark, a newly done inventory line, or
+#            quants that changed since their snapshot (fix_quant_snapshot, saved after each fix)
+#            flags the products of fix_quant_todo as unprocessed in product_locks
+#        The first incremental run processes every (product, location).
+#
+#        With LEDGER = True, the stock_move_line balances are read from a checkpoint instead of the
+#        whole history: fix_quant_ledger keeps, for every internal (product, location), the balance of
+#        the done stock_move_line up to a cutoff (the move line id of fix_quant_ledger_watermark) and
+#        their delta since the latest inventory adjustment of the pair (delta_date). A lookup adds the
+#        "tail": the stock_move_line after the cutoff and the ones that were not done at the cutoff
+#        (fix_quant_ledger_pending). roll_forward_ledger() (fix-quant-runner.py --ledger) moves the
+#        cutoff forward reading only the tail, and recomputes the delta of the pairs with a newer
+#        inventory. It doesn't lock stock_move_line: the cutoff is the latest move line visible in a
+#        snapshot, and it waits (up to LEDGER_WAIT_SECONDS) until the transactions running at that
+#        snapshot ended, so no move line can be committed later with an id below the cutoff; the rest
+#        runs in one REPEATABLE READ transaction. Every internal pair of a move line up to the cutoff
+#        has a row, with a balance of 0 when its lines are cancelled. The done stock_move_line are not
+#        expected to change: if they were edited, rebuild the ledger with roll_forward_ledger(rebuild=True).
+#        realign_quant_with_moves, find_delta_move and the bulk balances read the ledger; the
+#        delta falls back on the history when the pair got a new inventory since the cutoff.
+#
 #       What are the risks ?
 #       --------------------
 #
 #       Attention to reserved quantities !!!
-#       The script shouldn't be executed a second time !!!
+#       The quants inserted by the script are not reserved and merge_quant sums the reservations of
+#       the merged quants. With RECOMPUTE_RESERVED = True, after each batch, the reserved_quantity of
+#       the quants of the batch is recomputed from the stock_move_line not done nor cancelled
+#       (product_qty, on their location_id) in one grouped pass (recompute_reserved_quantities): the
+#       first quant of each (product, location) gets the reservation, the others 0, and a quant of 0
+#       is inserted where a reservation has no quant. No unreserve / reserve through the ORM is needed.
+#       The moves created by the script (named 'correction_script product ...') are not counted in
+#       the delta since the latest inventory adjustment, so running the script again doesn't apply
+#       the same correction twice.
 #
 #       How to improve execution speed ?
 #       ---------------------------------
 #
-#       drop the following indexes if still exists: (the create index are here for information only)
-#       -- CREATE INDEX stock_pack_operation_location_id_fkey_mig_idx ON public.stock_move_line USING btree (location_id)
-#       drop index stock_pack_operation_location_id_fkey_mig_idx;
-#
-#       -- CREATE INDEX stock_pack_operation_location_dest_id_fkey_mig_idx ON public.stock_move_line USING btree (location_dest_id)
-#       drop index stock_pack_operation_location_dest_id_fkey_mig_idx
+#       Before the run, call create_run_indexes() once (fix-quant-runner.py --manage-indexes does it):
+#           it lists the indexes of the tables used by the script
+#           it drops the stock_pack_operation_*_mig_idx indexes if DROP_MIGRATION_INDEXES = True,
+#           otherwise it warns about them:
+#           -- CREATE INDEX stock_pack_operation_location_id_fkey_mig_idx ON public.stock_move_line USING btree (location_id)
+#           -- CREATE INDEX stock_pack_operation_location_dest_id_fkey_mig_idx ON public.stock_move_line USING btree (location_dest_id)
+#           it creates CONCURRENTLY the covering indexes of RUN_INDEXES that don't exist yet, so the
+#           stock_move_line, stock_quant and stock_inventory_line lookups are index-only scans,
+#           and logs how long each took and its size
+#       After the run (all the crons are done), call drop_run_indexes() to drop them.
 #
 #
 #       Before running the script :
 #       ---------------------------
 #
 #       You can now start the same cron many time ... but you need some preparation
-#       - make a backup before and after
+#       - make a backup before and after: take_v12_backup('before') / take_v12_backup('after')
+#         BACKUP_MODE = 'full': copy of the whole stock_quant, stock_move and stock_move_line tables
+#         BACKUP_MODE = 'scoped': only the rows of the unprocessed products between MIN_PRODUCT_ID and
+#             MAX_PRODUCT_ID (kept in fix_quant_scope_<timestamp>), the 'after' backup uses the
+#             scope of the latest 'before' backup
+#         BACKUP_MODE = 'copy': same rows as 'scoped', written with COPY ... TO PROGRAM 'gzip ...' in
+#             BACKUP_DIRECTORY on the database server (needs pg_execute_server_program),
+#             or on the client with fix-quant-runner.py --backup
+#         restore_v12_backup(timestamp) restores the quants of a 'before' backup and deletes the
+#         stock_move and stock_move_line created since then for the products of the backup
 #       - create the following table:
-#           CREATE TABLE product_locks AS SELECT id, 'f' AS processed FROM product_product;
+#           CREATE TABLE product_locks AS
+#               SELECT id, 'f' AS processed, NULL::varchar AS claimed_by, NULL::timestamp AS claimed_at,
+#                   0 AS attempts, NULL::varchar AS error
+#               FROM product_product;
+#           CREATE INDEX ON product_locks (id);
+#         (the claimed_by, claimed_at, attempts and error columns are added if missing)
 
 INVENTORY_LOCATION_ID = 5
 TIMESTAMP = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 CRON_ID = datetime.datetime.now().strftime('%f')
-MAX_OFFSET = 10000
+CLAIM_BATCH_SIZE = 100
+CLAIM_LEASE_MINUTES = 60
+MIN_PRODUCT_ID = 0
+MAX_PRODUCT_ID = 2147483647
+SCOPE_LOCATION_ID = None
+SCOPE_WAREHOUSE_ID = None
+SCOPE_COMPANY_ID = None
+SCOPE_CATEGORY_ID = None
+PRODUCT_CACHE_PER_RUN = False
+FETCH_SIZE = 10000
+MERGE_CHUNK_SIZE = 10000
 COMMIT_EACH_PRODUCT = False
+COMMIT_EVERY_PRODUCTS = 0
+COMMIT_EVERY_SECONDS = 0
+PRODUCT_SAVEPOINTS = True
+MAX_ATTEMPTS = 3
+RECOMPUTE_RESERVED = False
+BULK_MODE = False
+RECONCILIATION_TABLE = None
+PREFETCH = None
+WRITE_BUFFER_SIZE = 0
+DRY_RUN = False
+BACKUP_MODE = 'full'
+BACKUP_DIRECTORY = '/tmp'
+INCREMENTAL = False
+INCREMENTAL_LOCK_ID = 424243
+LEDGER = False
+LEDGER_LOCK_ID = 424244
+LEDGER_WAIT_SECONDS = 600
+CORRECTION_MOVE_NAME = 'correction_script product %s'
+CORRECTION_MOVE_PATTERN = 'correction_script product %'
+DROP_MIGRATION_INDEXES = False
+MIGRATION_INDEXES = ['stock_pack_operation_location_id_fkey_mig_idx', 'stock_pack_operation_location_dest_id_fkey_mig_idx']
+# (name, table, columns) of the temporary indexes of the run, columns as written by pg_get_indexdef
+RUN_INDEXES = [
+    ('fix_quant_sml_location_idx', 'stock_move_line',
+     '(product_id, location_id, date) INCLUDE (qty_done, move_id)'),
+    ('fix_quant_sml_location_dest_idx', 'stock_move_line',
+     '(product_id, location_dest_id, date) INCLUDE (qty_done, move_id)'),
+    # the tail of fix_quant_ledger
+    ('fix_quant_sml_product_idx', 'stock_move_line',
+     '(product_id, id) INCLUDE (location_id, location_dest_id, qty_done, move_id, date)'),
+    ('fix_quant_quant_idx', 'stock_quant',
+     '(product_id, location_id) INCLUDE (quantity)'),
+    ('fix_quant_inventory_line_idx', 'stock_inventory_line',
+     '(product_id, location_id) INCLUDE (inventory_id, product_qty)'),
+]
+VERBOSE = False
+SUMMARY_INTERVAL = 60
+SLOWEST_PAIRS = 10
+DRY_RUN_COLUMNS = ('product_id', 'location_id', 'quant_value_according_to_sml', 'quant_desired_value',
+                   'quant_current_value', 'realign_delta', 'adjustment_delta')
 
-def take_v12_backup(before_after):
-    "create a backup of stock_quant, stock_move and stock_move_line"
+# product_id: uom_id of the stockable products (a key is enough to know the product is stockable)
+PRODUCT_METADATA = {}
+# ids of the stock_location with 'internal' usage
+INTERNAL_LOCATION_IDS = set()
+# product_id: internal location ids found in stock_move_line
+PRODUCT_LOCATIONS = {}
+# names of the caches above that are loaded
+LOADED_CACHES = set()
+
+# correction moves (location_id, location_dest_id, product_id, product_uom, qty), quants
+# (location_id, product_id, quantity) and (product_id, location_id) of the quants not sent yet,
+# and the moves and quants sent since the savepoint of the current product (None out of it)
+PENDING_WRITES = {'moves': [], 'quants': [], 'pairs': set(), 'merges': set(),
+                  'sent_moves': None, 'sent_quants': None, 'sent_merges': None}
+
+# ids of the batch claimed by this cron
+CLAIMED_PRODUCT_IDS = []
+# ids of the products that failed in this run, not claimed again by this cron until the next run
+FAILED_PRODUCT_IDS = []
+
+# phase: {calls, seconds, queries, query_seconds, rows}, stack of running phases, ...
+STATS = {
+    'phases': {},
+    'stack': [],
+    'slowest': [],
+    'start': None,
+    'last_summary': None,
+    'processed_at_start': 0,
+    'products': 0,
+    'locations': 0,
+    'failed': 0,
+    'uncommitted': 0,
+    'last_commit': None,
+}
+
+def info(message):
+    "log a message: the ir_logging table in a server action, the log of fix-quant-runner.py otherwise"
+    log(message)
+
+def trace(message):
+    "log the details of a (product, location), only with VERBOSE"
+    if VERBOSE:
+        log(message, level='debug')
 
+def phase_stats(phase):
+    if phase not in STATS['phases']:
+        STATS['phases'][phase] = {'calls': 0, 'seconds': 0.0, 'queries': 0, 'query_seconds': 0.0, 'rows': 0}
+    return STATS['phases'][phase]
+
+def start_phase(phase):
+    """start recording a call of phase, return the frame to give to end_phase
+
+        the functions of a phase call end_phase in a finally clause (no decorator: the server
+        action code can't have closures)
+    """
+    # [phase, start, seconds spent in nested phases]
+    frame = [phase, datetime.datetime.now(), 0.0]
+    STATS['stack'].append(frame)
+    return frame
+
+def end_phase(frame):
+    """record the call and the wall time of the phase of frame
+
+        the time spent in a nested phase is only counted in its own phase
+    """
+    STATS['stack'].pop()
+    seconds = (datetime.datetime.now() - frame[1]).total_seconds()
+    stats = phase_stats(frame[0])
+    stats['calls'] += 1
+    stats['seconds'] += seconds - frame[2]
+    if STATS['stack']:
+        STATS['stack'][-1][2] += seconds
+
+def execute(query, params=None):
+    "env.cr.execute, counted in the running phase"
+    start = datetime.datetime.now()
+    env.cr.execute(query, params)
+    stats = phase_stats(STATS['stack'][-1][0] if STATS['stack'] else 'other')
+    stats['queries'] += 1
+    stats['query_seconds'] += (datetime.datetime.now() - start).total_seconds()
+    if env.cr.rowcount > 0:
+        stats['rows'] += env.cr.rowcount
+
+def record_pair(product_id, location_id, seconds):
+    "keep the SLOWEST_PAIRS slowest (product, location)"
+    STATS['slowest'].append((seconds, product_id, location_id))
+    STATS['slowest'].sort(reverse=True)
+    STATS['slowest'][SLOWEST_PAIRS:] = []
+
+def start_stats():
+    "reset the statistics at the beginning of the run"
+    STATS['phases'].clear()
+    STATS['slowest'][:] = []
+    STATS['start'] = STATS['last_summary'] = datetime.datetime.now()
+    STATS['products'] = STATS['locations'] = STATS['failed'] = STATS['uncommitted'] = 0
+    STATS['last_commit'] = STATS['start']
+
+def count_products():
+    "return the number of processed and unprocessed products of product_locks in the range"
+    execute("""
+        SELECT
+            count(*) FILTER (WHERE processed = 't'),
+            count(*) FILTER (WHERE processed = 'f' AND attempts < %s)
+        FROM product_locks
+        WHERE id BETWEEN %s AND %s
+    """, (MAX_ATTEMPTS, MIN_PRODUCT_ID, MAX_PRODUCT_ID,))
+    return env.cr.fetchone()
+
+def log_summary(force=False):
+    "log the progress of the run and the statistics of each phase, every SUMMARY_INTERVAL seconds"
+    now = datetime.datetime.now()
+    if not force and (now - STATS['last_summary']).total_seconds() < SUMMARY_INTERVAL:
+        return
+    STATS['last_summary'] = now
+    elapsed = max((now - STATS['start']).total_seconds(), 0.001)
+    done, remaining = count_products()
+    # all the crons together
+    rate = (done - STATS['processed_at_start']) / elapsed
+    info("%s - summary (cron: %s): %s products (%s failed), %s locations in %.0f s, %.2f products/s, "
+         "all crons: %.2f products/s, %s products remaining, ETA %s" %
+         (now.strftime('%Y/%m/%d %H:%M:%S'), CRON_ID, STATS['products'], STATS['failed'], STATS['locations'], elapsed,
+          STATS['products'] / elapsed, rate, remaining,
+          (now + datetime.timedelta(seconds=remaining / rate)).strftime('%Y/%m/%d %H:%M:%S') if rate else '?'))
+    for phase, stats in sorted(STATS['phases'].items(), key=lambda item: -item[1]['seconds']):
+        info("  phase %-14s %8s calls %10.1f s %8s queries %10.1f s in queries %10s rows" %
+             (phase, stats['calls'], stats['seconds'], stats['queries'], stats['query_seconds'], stats['rows']))
+    for seconds, product_id, location_id in STATS['slowest']:
+        info("  slow pair: product %s location %s: %.3f s" % (product_id, location_id, seconds))
+
+def fetch_by_chunk(query, params=None, name='fix_quant_stream'):
+    "yield the rows of the query, fetched FETCH_SIZE rows at a time through a server-side cursor"
+    execute("DECLARE " + name + " NO SCROLL CURSOR FOR " + query, params)
+    while True:
+        execute("FETCH FORWARD %s FROM " + name, (FETCH_SIZE,))
+        rows = env.cr.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+    execute("CLOSE " + name)
+
+BACKUP_TABLES = ['stock_quant', 'stock_move', 'stock_move_line']
+
+def backup_queries(before_after):
+    """return [(backup name, query)] of the rows to backup for each table of BACKUP_TABLES
+
+        out of the 'full' BACKUP_MODE, only the rows of the products of the scope table are kept.
+        the 'before' backup creates the scope table fix_quant_scope_<TIMESTAMP> with the unprocessed
+        products, the 'after' backup uses the latest scope table.
+    """
     if before_after not in ['before','after']:
         raise Exception('before_after should be before of after')
-    env.cr.execute("CREATE TABLE stock_quant_%s_%s AS SELECT * FROM stock_quant" % (before_after, TIMESTAMP))
-    env.cr.execute("CREATE TABLE stock_move_%s_%s AS SELECT * FROM stock_move" % (before_after, TIMESTAMP))
-    env.cr.execute("CREATE TABLE stock_move_line_%s_%s AS SELECT * FROM stock_move_line" % (before_after, TIMESTAMP))
+    if BACKUP_MODE not in ['full', 'scoped', 'copy']:
+        raise Exception('BACKUP_MODE should be full, scoped or copy')
+
+    queries = []
+    if BACKUP_MODE == 'full':
+        for table in BACKUP_TABLES:
+            queries.append(("%s_%s_%s" % (table, before_after, TIMESTAMP), "SELECT * FROM %s" % table))
+        return queries
+
+    if before_after == 'before':
+        scope_table = "fix_quant_scope_%s" % TIMESTAMP
+        execute("""
+            CREATE TABLE """ + scope_table + """ AS
+            SELECT id FROM product_locks
+            WHERE processed = 'f'
+            AND id BETWEEN %s AND %s
+        """, (MIN_PRODUCT_ID, MAX_PRODUCT_ID,))
+        execute("ALTER TABLE " + scope_table + " ADD PRIMARY KEY (id)")
+    else:
+        execute("""
+            SELECT tablename FROM pg_tables
+            WHERE tablename ~ '^fix_quant_scope_[0-9]+$'
+            ORDER BY tablename DESC
+            LIMIT 1
+        """)
+        if not env.cr.rowcount:
+            raise Exception('no fix_quant_scope table, take the before backup first')
+        scope_table = env.cr.fetchone()[0]
+    for table in BACKUP_TABLES:
+        queries.append(("%s_%s_%s" % (table, before_after, TIMESTAMP),
+                        "SELECT t.* FROM %s t JOIN %s s ON s.id = t.product_id" % (table, scope_table)))
+    return queries
+
+def backup_file(name):
+    "path of the compressed file of a backup on the database server"
+    return "%s/%s.csv.gz" % (BACKUP_DIRECTORY, name)
+
+def take_v12_backup(before_after):
+    "create a backup of stock_quant, stock_move and stock_move_line"
+
+    frame = start_phase('backup')
+    try:
+        for name, query in backup_queries(before_after):
+            if BACKUP_MODE == 'copy':
+                execute("COPY (" + query + ") TO PROGRAM %s WITH (FORMAT csv, HEADER)",
+                               ("gzip > %s" % backup_file(name),))
+            else:
+                execute("CREATE TABLE %s AS %s" % (name, query))
+            info("%s - backup %s: %s rows" %
+            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), name, env.cr.rowcount,))
+    finally:
+        end_phase(frame)
+
+def restore_v12_backup(timestamp, load=True):
+    """restore the 'before' backup taken at timestamp
+
+        the quants of the products of the backup are replaced by the backup ones, and the
+        stock_move and stock_move_line created since the backup for these products are deleted
+        (the script never updates existing moves).
+        with BACKUP_MODE = 'copy', the files are first loaded in temporary tables (unless load is
+        False: fix-quant-runner.py loads them from the client).
+    """
+    frame = start_phase('backup')
+    try:
+        names = {}
+        for table in BACKUP_TABLES:
+            names[table] = "%s_before_%s" % (table, timestamp)
+        if BACKUP_MODE == 'copy' and load:
+            for table in BACKUP_TABLES:
+                execute("CREATE TEMP TABLE %s (LIKE %s)" % (names[table], table))
+                execute("COPY " + names[table] + " FROM PROGRAM %s WITH (FORMAT csv, HEADER)",
+                               ("gzip -dc %s" % backup_file(names[table]),))
+
+        execute("SELECT to_regclass(%s)", ("fix_quant_scope_%s" % timestamp,))
+        scope_table = env.cr.fetchone()[0]
+        if scope_table:
+            scope = " AND product_id IN (SELECT id FROM %s)" % scope_table
+        elif BACKUP_MODE == 'full':
+            scope = ""
+        else:
+            raise Exception('no fix_quant_scope_%s table' % timestamp)
+
+        execute("""
+            DELETE FROM stock_move_line l
+            WHERE NOT EXISTS (SELECT 1 FROM %s b WHERE b.id = l.id) %s
+        """ % (names['stock_move_line'], scope))
+        info("  restore: %s stock_move_line deleted" % env.cr.rowcount)
+        execute("""
+            DELETE FROM stock_move m
+            WHERE NOT EXISTS (SELECT 1 FROM %s b WHERE b.id = m.id) %s
+        """ % (names['stock_move'], scope))
+        info("  restore: %s stock_move deleted" % env.cr.rowcount)
+        execute("DELETE FROM stock_quant WHERE true %s" % scope)
+        execute("INSERT INTO stock_quant SELECT * FROM %s" % names['stock_quant'])
+        info("  restore: %s stock_quant restored" % env.cr.rowcount)
+    finally:
+        end_phase(frame)
+
+def create_run_indexes():
+    """pre-flight: check the indexes and create the temporary indexes of RUN_INDEXES
+
+        the indexes are created CONCURRENTLY, outside of any transaction: this commits.
+    """
+    tables = sorted(set([table for name, table, columns in RUN_INDEXES]))
+    execute("""
+        SELECT tablename, indexname, indexdef FROM pg_indexes
+        WHERE tablename = ANY(%s)
+        ORDER BY tablename, indexname
+    """, (tables,))
+    existing = env.cr.fetchall()
+    for tablename, indexname, indexdef in existing:
+        info("  index %s: %s" % (indexname, indexdef))
+
+    env.cr.commit()
+    env.cr.autocommit(True)
+    try:
+        for indexname in MIGRATION_INDEXES:
+            if indexname not in [index[1] for index in existing]:
+                continue
+            if DROP_MIGRATION_INDEXES:
+                execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % indexname)
+                info("%s - index %s dropped" % (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), indexname,))
+            else:
+                info("  WARNING: index %s slows down the script, drop it or set DROP_MIGRATION_INDEXES" % indexname)
+
+        for name, table, columns in RUN_INDEXES:
+            # an invalid index is what remains of a failed CREATE INDEX CONCURRENTLY
+            execute("""
+                SELECT i.indisvalid FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = %s
+            """, (name,))
+            res = env.cr.fetchone()
+            if res and not res[0]:
+                execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+            elif res:
+                info("  index %s already exists" % name)
+                continue
+            same = []
+            for index in existing:
+                if index[0] == table and index[2].endswith(' USING btree ' + columns):
+                    same.append(index[1])
+            if same:
+                info("  index %s not needed, %s is the same" % (name, same[0]))
+                continue
+            start = datetime.datetime.now()
+            execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s %s" % (name, table, columns))
+            execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))", (name,))
+            info("%s - index %s created in %s seconds (%s)" %
+            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), name,
+             (datetime.datetime.now() - start).total_seconds(), env.cr.fetchone()[0],))
+        for table in tables:
+            execute("ANALYZE %s" % table)
+    finally:
+        env.cr.autocommit(False)
+
+def drop_run_indexes():
+    "drop the temporary indexes of RUN_INDEXES, once all the crons are done (this commits)"
+    env.cr.commit()
+    env.cr.autocommit(True)
+    try:
+        for name, table, columns in RUN_INDEXES:
+            execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+            info("%s - index %s dropped" % (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), name,))
+    finally:
+        env.cr.autocommit(False)
 
 def merge_quant(product_id, location_id):
-    env.cr.execute("""
-        WITH
-        dupes AS (
-            SELECT min(qq.id) as to_update_quant_id,
-                (array_agg(qq.id ORDER BY qq.id))[2:array_length(array_agg(qq.id), 1)] as to_delete_quant_ids,
-                SUM(reserved_quantity) as reserved_quantity,
-                SUM(quantity) as quantity,
-                min(in_date) as in_date,
-                min(l.company_id) as company_id
-            FROM stock_quant qq
-            JOIN stock_location l ON qq.location_id = l.id
-            WHERE product_id = %s
-            AND qq.location_id = %s
-            GROUP BY product_id, qq.location_id
-            HAVING count(qq.id) > 1
-        ),
-        _up AS (
-            UPDATE stock_quant q
-                SET quantity = d.quantity,
-                    reserved_quantity = d.reserved_quantity,
-                    in_date = d.in_date,
-                    company_id = d.company_id
-            FROM dupes d
-            WHERE d.to_update_quant_id = q.id
-            AND product_id = %s
-            AND location_id = %s
-        )
-   DELETE FROM stock_quant m WHERE m.id in (SELECT unnest(to_delete_quant_ids) FROM dupes)
-    """, (product_id, location_id,product_id, location_id,))
+    frame = start_phase('merge')
+    try:
+        if WRITE_BUFFER_SIZE:
+            # merged by flush_writes, after the buffered quants
+            PENDING_WRITES['merges'].add((product_id, location_id))
+            if len(PENDING_WRITES['merges']) >= WRITE_BUFFER_SIZE:
+                flush_writes()
+            return
+        execute("""
+            WITH
+            dupes AS (
+                SELECT min(qq.id) as to_update_quant_id,
+                    (array_agg(qq.id ORDER BY qq.id))[2:array_length(array_agg(qq.id), 1)] as to_delete_quant_ids,
+                    SUM(reserved_quantity) as reserved_quantity,
+                    SUM(quantity) as quantity,
+                    min(in_date) as in_date,
+                    min(l.company_id) as company_id
+                FROM stock_quant qq
+                JOIN stock_location l ON qq.location_id = l.id
+                WHERE product_id = %s
+                AND qq.location_id = %s
+                GROUP BY product_id, qq.location_id
+                HAVING count(qq.id) > 1
+            ),
+            _up AS (
+                UPDATE stock_quant q
+                    SET quantity = d.quantity,
+                        reserved_quantity = d.reserved_quantity,
+                        in_date = d.in_date,
+                        company_id = d.company_id
+                FROM dupes d
+                WHERE d.to_update_quant_id = q.id
+                AND product_id = %s
+                AND location_id = %s
+            )
+       DELETE FROM stock_quant m WHERE m.id in (SELECT unnest(to_delete_quant_ids) FROM dupes)
+        """, (product_id, location_id,product_id, location_id,))
+    finally:
+        end_phase(frame)
 
 def find_delta_move(location_id, product_id, date):
     """return the change of quantity of the product in this location from the date
 
         eg: find_delta_move(1,2,'2019-09-26') returning -2.
         this means since '2019-09-26', two products has been removed from this location
+        the inventory moves and the correction moves of the script are not counted
     """
+    if LEDGER:
+        delta = find_ledger_delta(product_id, location_id, date)
+        if delta is not None:
+            return delta
     delta_query = """
                 SELECT
                     sum(quantity)
@@ -131,6 +626,7 @@ def find_delta_move(location_id, product_id, date):
                         AND l.product_id =%s
                         AND l.location_id = %s
                         AND m.inventory_id IS NULL
+                        AND m.name NOT LIKE %s
                 UNION ALL
                     SELECT
                         COALESCE(SUM(qty_done),0) AS quantity
@@ -143,10 +639,11 @@ def find_delta_move(location_id, product_id, date):
                         AND l.product_id = %s
                         AND l.location_dest_id = %s
                         AND m.inventory_id IS NULL
+                        AND m.name NOT LIKE %s
                 )
                 AS ml
     """
-    env.cr.execute(delta_query,(date,product_id,location_id,date,product_id,location_id,))
+    execute(delta_query,(date,product_id,location_id,CORRECTION_MOVE_PATTERN,date,product_id,location_id,CORRECTION_MOVE_PATTERN,))
     return env.cr.fetchone()[0]
 
 def find_latest_inventory_adjustment(product_id, location_id):
@@ -167,7 +664,7 @@ def find_latest_inventory_adjustment(product_id, location_id):
     ORDER BY date DESC, id DESC
     LIMIT 1
     """
-    env.cr.execute(query, (location_id,product_id,))
+    execute(query, (location_id,product_id,))
     res = env.cr.fetchone()
     return (res[0], res[1],)
 
@@ -178,78 +675,288 @@ def find_desired_quant_value(product_id, location_id):
         plus the delta of the quants
     """
 
-    latest_inventory_date, latest_inventory_qty = find_latest_inventory_adjustment(product_id, location_id)
-    print('  latest_inventory_date: %s' % latest_inventory_date)
-    print('  latest_inventory_qty: %s' % latest_inventory_qty)
-    delta_moves = find_delta_move(location_id, product_id, latest_inventory_date)
-    print('  delta_moves_since_inventory: %s' % delta_moves)
-    return latest_inventory_qty + delta_moves
+    frame = start_phase('find_desired')
+    try:
+        latest_inventory_date, latest_inventory_qty = find_latest_inventory_adjustment(product_id, location_id)
+        trace('  latest_inventory_date: %s' % latest_inventory_date)
+        trace('  latest_inventory_qty: %s' % latest_inventory_qty)
+        delta_moves = find_delta_move(location_id, product_id, latest_inventory_date)
+        trace('  delta_moves_since_inventory: %s' % delta_moves)
+        return latest_inventory_qty + delta_moves
+    finally:
+        end_phase(frame)
 
 def sql_inventory_adjustment(product_id, qty, location_id, location_dest_id):
     "create stock_move and stock_move_line but don't update the quant"
 
-    if qty == 0:
-        return
+    frame = start_phase('adjustment')
+    try:
+        if qty == 0:
+            return
 
-    if qty < 0:
-        qty = -qty
-        location_id, location_dest_id = location_dest_id, location_id
+        if qty < 0:
+            qty = -qty
+            location_id, location_dest_id = location_dest_id, location_id
 
-    # get default uom for the product.
-    env.cr.execute("""
-    SELECT t.uom_id FROM product_product p
-    JOIN product_template t ON p.product_tmpl_id = t.id
-    WHERE p.id = %s
-    """, (product_id,))
-    product_uom = env.cr.fetchone()[0]
+        # get default uom for the product.
+        product_uom = find_product_uom(product_id)
 
-    insert_move_query ="""
-    INSERT INTO stock_move
+        if WRITE_BUFFER_SIZE:
+            PENDING_WRITES['moves'].append((location_id, location_dest_id, product_id, product_uom, qty))
+            buffer_quant(product_id, location_dest_id, qty)
+            buffer_quant(product_id, location_id, -qty)
+            return
+
+        insert_move_query ="""
+        INSERT INTO stock_move
+                    (
+                        "id",
+                        "create_uid",
+                        "create_date",
+                        "write_uid",
+                        "write_date",
+                        "date",
+                        "date_expected",
+                        "procure_method",
+                        "company_id",
+                        "is_done",
+                        "location_dest_id",
+                        "location_id",
+                        "name",
+                        "product_id",
+                        "product_uom",
+                        "product_uom_qty",
+                        "state"
+                    )
+                    VALUES
+                    (
+                        Nextval('stock_move_id_seq'), --id
+                        1, -- create_uid
+                        (Now() at time zone 'UTC'), -- create_date
+                        1, -- write uid
+                        (Now() at time zone 'UTC'), -- write_date
+                        (Now() at time zone 'UTC'), -- date
+                        (Now() at time zone 'UTC'), -- date_expected
+                        'make_to_stock', -- procure method
+                        1, -- company_id
+                        't', --is_done
+                        %s, ---------------------------------------- location_dest_id
+                        %s, ---------------------------------------- location_id
+                        %s, ---------------------------------------- name
+                        %s, ---------------------------------------- product_id
+                        %s, ---------------------------------------- product_uom
+                        %s,  --------------------------------------- product_uom_qty
+                        'done' --state
+                    )
+                    returning id;
+        """
+        execute(insert_move_query , (location_dest_id, location_id, CORRECTION_MOVE_NAME % product_id, product_id, product_uom, qty,))
+        move_id = env.cr.fetchone()[0]
+
+        insert_move_line_query = """
+                    INSERT INTO "stock_move_line"
+                        (   "id",
+                            "create_uid",
+                            "create_date",
+                            "write_uid",
+                            "write_date",
+                            "date",
+                            "done_move",
+                            "location_dest_id",
+                            "location_id",
+                            "move_id",
+                            "product_id",
+                            "product_uom_id",
+                            "product_uom_qty",
+                            "qty_done",
+                            "done_wo",
+                            "product_qty",
+                            "state"
+                        )
+                    VALUES
+                        (
+                            Nextval('stock_move_line_id_seq'), --id
+                            1, -- create_uid
+                            (Now() at time zone 'UTC'), --create_date
+                            1, -- write_uid
+                            (Now() at time zone 'UTC'), --write_date
+                            (Now() at time zone 'UTC'), --date
+                            't', --done_move
+                            %s, --------------------------------- location_dest_id
+                            %s, --------------------------------- location_id
+                            %s, --------------------------------- move_id
+                            %s, --------------------------------- product_id
+                            %s, --------------------------------- product_uom_id
+                            '0.000', -- product_uom_qty
+                            %s, --------------------------------- qty_done
+                            't', --done_wo
+                            0, -- product_qty
+                            'done' --state
+                        )
+        """
+        execute(insert_move_line_query , (location_dest_id, location_id, move_id, product_id, product_uom, qty,))
+
+        insert_quant_query = """
+                INSERT INTO "stock_quant"
                 (
                     "id",
                     "create_uid",
                     "create_date",
                     "write_uid",
                     "write_date",
-                    "date",
-                    "date_expected",
-                    "procure_method",
-                    "company_id",
-                    "is_done",
-                    "location_dest_id",
+                    "in_date",
                     "location_id",
-                    "name",
                     "product_id",
-                    "product_uom",
-                    "product_uom_qty",
-                    "state"
+                    "quantity",
+                    "reserved_quantity"
                 )
                 VALUES
                 (
-                    Nextval('stock_move_id_seq'), --id
-                    1, -- create_uid
-                    (Now() at time zone 'UTC'), -- create_date
-                    1, -- write uid
-                    (Now() at time zone 'UTC'), -- write_date
-                    (Now() at time zone 'UTC'), -- date
-                    (Now() at time zone 'UTC'), -- date_expected
-                    'make_to_stock', -- procure method
-                    1, -- company_id
-                    't', --is_done
-                    %s, ---------------------------------------- location_dest_id
-                    %s, ---------------------------------------- location_id
-                    %s, ---------------------------------------- name
-                    %s, ---------------------------------------- product_id
-                    %s, ---------------------------------------- product_uom
-                    %s,  --------------------------------------- product_uom_qty
-                    'done' --state
+                    Nextval('stock_quant_id_seq'), --id
+                    1, --create_uid
+                    (Now() at time zone 'UTC'), --create_date
+                    1, --write_uid
+                    (Now() at time zone 'UTC'), --write_date
+                    (Now() at time zone 'UTC'), --in_date
+                    %s, ------------------------------------- location_id
+                    %s, ------------------------------------- product_id
+                    %s, ------------------------------------- quantity,
+                    0.0 -- reserved_quantity
                 )
-                returning id;
-    """
-    env.cr.execute(insert_move_query , (location_dest_id, location_id, 'correction_script product %s' % product_id, product_id, product_uom, qty,))
-    move_id = env.cr.fetchone()[0]
+        """
+        execute(insert_quant_query , (location_dest_id, product_id, qty,))
 
-    insert_move_line_query = """
+        insert_quant_query = """
+                INSERT INTO "stock_quant"
+                (
+                    "id",
+                    "create_uid",
+                    "create_date",
+                    "write_uid",
+                    "write_date",
+                    "in_date",
+                    "location_id",
+                    "product_id",
+                    "quantity",
+                    "reserved_quantity"
+                )
+                VALUES
+                (
+                    Nextval('stock_quant_id_seq'), --id
+                    1, --create_uid
+                    (Now() at time zone 'UTC'), --create_date
+                    1, --write_uid
+                    (Now() at time zone 'UTC'), --write_date
+                    (Now() at time zone 'UTC'), --in_date
+                    %s, ------------------------------------- location_id
+                    %s, ------------------------------------- product_id
+                    %s, ------------------------------------- quantity,
+                    0.0 -- reserved_quantity
+                )
+        """
+        execute(insert_quant_query , (location_id, product_id, -qty,))
+    finally:
+        end_phase(frame)
+
+def buffer_quant(product_id, location_id, quantity):
+    "add a quant to PENDING_WRITES, flush when WRITE_BUFFER_SIZE quants are waiting"
+    PENDING_WRITES['quants'].append((location_id, product_id, quantity))
+    PENDING_WRITES['pairs'].add((product_id, location_id))
+    if len(PENDING_WRITES['quants']) >= WRITE_BUFFER_SIZE:
+        flush_writes()
+
+def flush_pending_pair(product_id, location_id):
+    "flush the buffer if a quant of the (product, location) is waiting in it"
+    if (product_id, location_id) in PENDING_WRITES['pairs']:
+        flush_writes()
+
+def discard_writes():
+    "forget the writes not sent yet"
+    PENDING_WRITES['moves'][:] = []
+    PENDING_WRITES['quants'][:] = []
+    PENDING_WRITES['pairs'].clear()
+    PENDING_WRITES['merges'].clear()
+
+def rollback_writes(product_id):
+    """after the rollback to the savepoint of the product, forget its writes
+       and buffer again the ones of the previous products sent since the savepoint"""
+    moves = []
+    for move in PENDING_WRITES['sent_moves'] + PENDING_WRITES['moves']:
+        if move[2] != product_id:
+            moves.append(move)
+    quants = []
+    for quant in PENDING_WRITES['sent_quants'] + PENDING_WRITES['quants']:
+        if quant[1] != product_id:
+            quants.append(quant)
+    merges = []
+    for pair in PENDING_WRITES['sent_merges'] + list(PENDING_WRITES['merges']):
+        if pair[0] != product_id:
+            merges.append(pair)
+    discard_writes()
+    PENDING_WRITES['moves'].extend(moves)
+    PENDING_WRITES['quants'].extend(quants)
+    PENDING_WRITES['pairs'].update([(quant[1], quant[0]) for quant in quants])
+    PENDING_WRITES['merges'].update(merges)
+
+def flush_writes():
+    """send the buffered correction moves, move lines and quants, and merge the buffered pairs
+
+        the moves are inserted from unnest() of one array per column, the move lines from the
+        RETURNING of the moves: each line gets the id of its move without a round-trip per move.
+    """
+    frame = start_phase('flush')
+    try:
+        moves = PENDING_WRITES['moves']
+        quants = PENDING_WRITES['quants']
+        merges = list(PENDING_WRITES['merges'])
+        if moves:
+            execute("""
+                WITH
+                moves AS (
+                    INSERT INTO stock_move
+                    (
+                        "id",
+                        "create_uid",
+                        "create_date",
+                        "write_uid",
+                        "write_date",
+                        "date",
+                        "date_expected",
+                        "procure_method",
+                        "company_id",
+                        "is_done",
+                        "location_dest_id",
+                        "location_id",
+                        "name",
+                        "product_id",
+                        "product_uom",
+                        "product_uom_qty",
+                        "state"
+                    )
+                    SELECT
+                        Nextval('stock_move_id_seq'), --id
+                        1, -- create_uid
+                        (Now() at time zone 'UTC'), -- create_date
+                        1, -- write uid
+                        (Now() at time zone 'UTC'), -- write_date
+                        (Now() at time zone 'UTC'), -- date
+                        (Now() at time zone 'UTC'), -- date_expected
+                        'make_to_stock', -- procure method
+                        1, -- company_id
+                        't', --is_done
+                        r.location_dest_id,
+                        r.location_id,
+                        r.name,
+                        r.product_id,
+                        r.product_uom,
+                        r.qty,
+                        'done' --state
+                    FROM unnest(
+                        %(location_id)s::integer[], %(location_dest_id)s::integer[], %(name)s::varchar[],
+                        %(product_id)s::integer[], %(product_uom)s::integer[], %(qty)s::numeric[]
+                    ) AS r (location_id, location_dest_id, name, product_id, product_uom, qty)
+                    RETURNING id, location_id, location_dest_id, product_id, product_uom, product_uom_qty
+                )
                 INSERT INTO "stock_move_line"
                     (   "id",
                         "create_uid",
@@ -269,30 +976,140 @@ def sql_inventory_adjustment(product_id, qty, location_id, location_dest_id):
                         "product_qty",
                         "state"
                     )
-                VALUES
+                SELECT
+                    Nextval('stock_move_line_id_seq'), --id
+                    1, -- create_uid
+                    (Now() at time zone 'UTC'), --create_date
+                    1, -- write_uid
+                    (Now() at time zone 'UTC'), --write_date
+                    (Now() at time zone 'UTC'), --date
+                    't', --done_move
+                    m.location_dest_id,
+                    m.location_id,
+                    m.id, -- move_id
+                    m.product_id,
+                    m.product_uom,
+                    '0.000', -- product_uom_qty
+                    m.product_uom_qty, -- qty_done
+                    't', --done_wo
+                    0, -- product_qty
+                    'done' --state
+                FROM moves m
+            """, {
+                'location_id': [move[0] for move in moves],
+                'location_dest_id': [move[1] for move in moves],
+                'name': [CORRECTION_MOVE_NAME % move[2] for move in moves],
+                'product_id': [move[2] for move in moves],
+                'product_uom': [move[3] for move in moves],
+                'qty': [move[4] for move in moves],
+            })
+        if quants:
+            execute("""
+                INSERT INTO "stock_quant"
+                (
+                    "id",
+                    "create_uid",
+                    "create_date",
+                    "write_uid",
+                    "write_date",
+                    "in_date",
+                    "location_id",
+                    "product_id",
+                    "quantity",
+                    "reserved_quantity"
+                )
+                SELECT
+                    Nextval('stock_quant_id_seq'), --id
+                    1, --create_uid
+                    (Now() at time zone 'UTC'), --create_date
+                    1, --write_uid
+                    (Now() at time zone 'UTC'), --write_date
+                    (Now() at time zone 'UTC'), --in_date
+                    r.location_id,
+                    r.product_id,
+                    r.quantity,
+                    0.0 -- reserved_quantity
+                FROM unnest(%s::integer[], %s::integer[], %s::numeric[]) AS r (location_id, product_id, quantity)
+            """, ([quant[0] for quant in quants], [quant[1] for quant in quants], [quant[2] for quant in quants],))
+        if merges:
+            # merge_quant for all the pairs at once
+            execute("""
+                WITH
+                dupes AS (
+                    SELECT min(qq.id) as to_update_quant_id,
+                        (array_agg(qq.id ORDER BY qq.id))[2:array_length(array_agg(qq.id), 1)] as to_delete_quant_ids,
+                        SUM(reserved_quantity) as reserved_quantity,
+                        SUM(quantity) as quantity,
+                        min(in_date) as in_date,
+                        min(l.company_id) as company_id
+                    FROM
+                        unnest(%s::integer[], %s::integer[]) AS r (product_id, location_id)
+                        JOIN stock_quant qq ON qq.product_id = r.product_id AND qq.location_id = r.location_id
+                        JOIN stock_location l ON qq.location_id = l.id
+                    GROUP BY qq.product_id, qq.location_id
+                    HAVING count(qq.id) > 1
+                ),
+                _up AS (
+                    UPDATE stock_quant q
+                        SET quantity = d.quantity,
+                            reserved_quantity = d.reserved_quantity,
+                            in_date = d.in_date,
+                            company_id = d.company_id
+                    FROM dupes d
+                    WHERE d.to_update_quant_id = q.id
+                )
+                DELETE FROM stock_quant m WHERE m.id in (SELECT unnest(to_delete_quant_ids) FROM dupes)
+            """, ([pair[0] for pair in merges], [pair[1] for pair in merges],))
+        trace("  %s moves and %s quants flushed, %s locations merged" % (len(moves), len(quants), len(merges)))
+        if PENDING_WRITES['sent_moves'] is not None:
+            PENDING_WRITES['sent_moves'].extend(moves)
+            PENDING_WRITES['sent_quants'].extend(quants)
+            PENDING_WRITES['sent_merges'].extend(merges)
+        discard_writes()
+    finally:
+        end_phase(frame)
+
+def find_current_quant_value(product_id, location_id):
+    frame = start_phase('current_quant')
+    try:
+        flush_pending_pair(product_id, location_id)
+        execute("""
+            SELECT COALESCE(sum(quantity),0)
+            FROM stock_quant
+            WHERE location_id = %s
+            AND product_id = %s
+        """, (location_id, product_id))
+        current_quant_value = env.cr.fetchone()[0]
+        return current_quant_value
+    finally:
+        end_phase(frame)
+
+def fix_quant_company(product_id, location_id):
+    "fix quant with and without company_id"
+    frame = start_phase('realign')
+    try:
+        execute("""
+                    UPDATE stock_quant SET company_id = NULL WHERE id IN
                     (
-                        Nextval('stock_move_line_id_seq'), --id
-                        1, -- create_uid
-                        (Now() at time zone 'UTC'), --create_date
-                        1, -- write_uid
-                        (Now() at time zone 'UTC'), --write_date
-                        (Now() at time zone 'UTC'), --date
-                        't', --done_move
-                        %s, --------------------------------- location_dest_id
-                        %s, --------------------------------- location_id
-                        %s, --------------------------------- move_id
-                        %s, --------------------------------- product_id
-                        %s, --------------------------------- product_uom_id
-                        '0.000', -- product_uom_qty
-                        %s, --------------------------------- qty_done
-                        't', --done_wo
-                        0, -- product_qty
-                        'done' --state
-                    )
-    """
-    env.cr.execute(insert_move_line_query , (location_dest_id, location_id, move_id, product_id, product_uom, qty,))
+                    SELECT q.id FROM stock_quant q
+                    JOIN stock_location l ON q.location_id = l.id
+                    WHERE COALESCE(q.company_id, -1) <>  COALESCE(l.company_id, -1)
+                    AND q.company_id = 1
+                    AND q.location_id = %s
+                    AND q.product_id = %s
+                    );
+                    """, (location_id, product_id,))
+    finally:
+        end_phase(frame)
 
-    insert_quant_query = """
+def insert_quant(product_id, location_id, quantity):
+    "insert a quant of quantity, merged afterwards with the other quants of the location"
+    frame = start_phase('realign')
+    try:
+        if WRITE_BUFFER_SIZE:
+            buffer_quant(product_id, location_id, quantity)
+            return
+        insert_quant_query = """
             INSERT INTO "stock_quant"
             (
                 "id",
@@ -319,10 +1136,172 @@ def sql_inventory_adjustment(product_id, qty, location_id, location_dest_id):
                 %s, ------------------------------------- quantity,
                 0.0 -- reserved_quantity
             )
+            """
+        execute(insert_quant_query , (location_id, product_id, quantity,))
+    finally:
+        end_phase(frame)
+
+def realign_quant_with_moves(product_id, location_id):
+    "makes the quants great again, return the quant quantity once realigned: the stock_move_line balance"
+
+    frame = start_phase('realign')
+    try:
+        fix_quant_company(product_id, location_id)
+        merge_quant(product_id, location_id)
+
+        if LEDGER:
+            quant_value_according_to_sml = find_ledger_balance(product_id, location_id)
+            quant_current_value = find_current_quant_value(product_id, location_id)
+            quant_delta = quant_value_according_to_sml - quant_current_value
+            trace("  align quant with moves (%s)" % quant_delta )
+            insert_quant(product_id, location_id, quant_delta)
+            return quant_value_according_to_sml
+
+        execute("""
+                        SELECT
+                            sum(quantity)
+                        FROM
+                        (
+                            SELECT
+                                - COALESCE(SUM(qty_done),0) AS quantity
+                            FROM
+                                stock_move_line l
+                                JOIN stock_move m ON l.move_id=m.id
+                            WHERE
+                                m.state = 'done'
+                                AND l.product_id = %s
+                                AND l.location_id = %s
+                        UNION ALL
+                            SELECT
+                                COALESCE(SUM(qty_done),0) AS quantity
+                            FROM
+                                stock_move_line l
+                                JOIN stock_move m ON l.move_id=m.id
+                            WHERE
+                                m.state = 'done'
+                                AND l.product_id = %s
+                                AND l.location_dest_id = %s
+                        )
+                        AS ml
+                        """,(product_id, location_id, product_id, location_id))
+
+        quant_value_according_to_sml = env.cr.fetchone()[0]
+
+        quant_current_value = find_current_quant_value(product_id, location_id)
+
+        quant_delta = quant_value_according_to_sml - quant_current_value
+        trace("  align quant with moves (%s)" % quant_delta )
+        insert_quant(product_id, location_id, quant_delta)
+        return quant_value_according_to_sml
+    finally:
+        end_phase(frame)
+
+def bulk_select_products(product_ids):
+    "keep the stockable products of the claimed batch in the fix_quant_product temporary table"
+    frame = start_phase('load')
+    try:
+        execute("""
+            CREATE TEMP TABLE IF NOT EXISTS fix_quant_product (id integer PRIMARY KEY);
+            TRUNCATE fix_quant_product;
+        """)
+        execute("""
+            INSERT INTO fix_quant_product (id)
+            SELECT unnest(%s::integer[])
+        """, ([product_id for product_id in product_ids if product_id in PRODUCT_METADATA],))
+        info("%s - bulk: %s products selected" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount,))
+        execute("ANALYZE fix_quant_product")
+    finally:
+        end_phase(frame)
+
+def bulk_compute_balances():
+    """fill the fix_quant_balance temporary table for the products of fix_quant_product
+
+        one row per internal (product, location) found in stock_move_line with
+        sml_quantity: the balance of the done stock_move_line (what realign_quant_with_moves computes)
+        quant_quantity: the current sum of the quants (what find_current_quant_value returns)
+
+        stock_move_line is read once, each line counting negatively on location_id and
+        positively on location_dest_id, or the balances are read from RECONCILIATION_TABLE,
+        or from fix_quant_ledger and its tail.
     """
-    env.cr.execute(insert_quant_query , (location_dest_id, product_id, qty,))
+    frame = start_phase('bulk_balance')
+    try:
+        if RECONCILIATION_TABLE:
+            sml_query = """
+                SELECT r.product_id, r.location_id, r.sml_quantity AS quantity
+                FROM %s r
+                JOIN fix_quant_product p ON p.id = r.product_id
+                JOIN fix_quant_location ll ON ll.id = r.location_id
+            """ % RECONCILIATION_TABLE
+        elif LEDGER:
+            sml_query = """
+                SELECT s.product_id, s.location_id, SUM(s.quantity) AS quantity
+                FROM
+                    (
+                        SELECT g.product_id, g.location_id, g.balance AS quantity
+                        FROM fix_quant_ledger g
+                        JOIN fix_quant_product p ON p.id = g.product_id
+                    UNION ALL
+                        SELECT t.product_id, t.location_id, CASE WHEN t.done THEN t.quantity ELSE 0 END
+                        FROM (%s) t
+                    ) s
+                    JOIN fix_quant_location ll ON ll.id = s.location_id
+                GROUP BY s.product_id, s.location_id
+            """ % ledger_tail("l.product_id IN (SELECT id FROM fix_quant_product)")
+        else:
+            sml_query = """
+                SELECT
+                    l.product_id,
+                    b.location_id,
+                    COALESCE(SUM(b.quantity) FILTER (WHERE m.state = 'done'), 0) AS quantity
+                FROM
+                    stock_move_line l
+                    JOIN fix_quant_product p ON p.id = l.product_id
+                    LEFT JOIN stock_move m ON l.move_id = m.id
+                    CROSS JOIN LATERAL (
+                        VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+                    ) AS b (location_id, quantity)
+                    JOIN fix_quant_location ll ON ll.id = b.location_id
+                GROUP BY l.product_id, b.location_id
+            """
+        execute("""
+            DROP TABLE IF EXISTS fix_quant_balance;
+            CREATE TEMP TABLE fix_quant_balance AS
+            WITH
+            sml AS (%s),
+            quant AS (
+                SELECT
+                    q.product_id,
+                    q.location_id,
+                    SUM(q.quantity) AS quantity
+                FROM
+                    stock_quant q
+                    JOIN fix_quant_product p ON p.id = q.product_id
+                GROUP BY q.product_id, q.location_id
+            )
+            SELECT
+                sml.product_id,
+                sml.location_id,
+                sml.quantity AS sml_quantity,
+                COALESCE(quant.quantity, 0) AS quant_quantity
+            FROM
+                sml
+                LEFT JOIN quant ON quant.product_id = sml.product_id AND quant.location_id = sml.location_id;
+            ALTER TABLE fix_quant_balance ADD PRIMARY KEY (product_id, location_id);
+            ANALYZE fix_quant_balance;
+        """ % sml_query, {'pattern': CORRECTION_MOVE_PATTERN})
+    finally:
+        end_phase(frame)
 
-    insert_quant_query = """
+def bulk_realign_quant_with_moves():
+    """makes all the quants of fix_quant_balance great again, in one statement
+
+        the company of the quants is fixed afterwards by consolidate_quants
+    """
+    frame = start_phase('realign')
+    try:
+        execute("""
             INSERT INTO "stock_quant"
             (
                 "id",
@@ -336,219 +1315,1518 @@ def sql_inventory_adjustment(product_id, qty, location_id, location_dest_id):
                 "quantity",
                 "reserved_quantity"
             )
-            VALUES
-            (
+            SELECT
                 Nextval('stock_quant_id_seq'), --id
                 1, --create_uid
                 (Now() at time zone 'UTC'), --create_date
                 1, --write_uid
                 (Now() at time zone 'UTC'), --write_date
                 (Now() at time zone 'UTC'), --in_date
-                %s, ------------------------------------- location_id
-                %s, ------------------------------------- product_id
-                %s, ------------------------------------- quantity,
+                b.location_id, -------------------------- location_id
+                b.product_id, --------------------------- product_id
+                b.sml_quantity - b.quant_quantity, ------ quantity,
                 0.0 -- reserved_quantity
-            )
-    """
-    env.cr.execute(insert_quant_query , (location_id, product_id, -qty,))
-
-def find_current_quant_value(product_id, location_id):
-    env.cr.execute("""
-        SELECT COALESCE(sum(quantity),0)
-        FROM stock_quant
-        WHERE location_id = %s
-        AND product_id = %s
-    """, (location_id, product_id))
-    current_quant_value = env.cr.fetchone()[0]
-    return current_quant_value
+            FROM fix_quant_balance b
+            WHERE b.sml_quantity <> b.quant_quantity
+            """)
+        info("%s - bulk: align quant with moves (%s quants inserted)" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount,))
+    finally:
+        end_phase(frame)
 
-def realign_quant_with_moves(product_id, location_id):
-    "makes the quants great again"
+def bulk_find_desired_quant_values():
+    """fill the fix_quant_desired temporary table for the pairs of fix_quant_balance
 
-    # fix quant with and without company_id
-    env.cr.execute("""
-                UPDATE stock_quant SET company_id = NULL WHERE id IN
-                (
-                SELECT q.id FROM stock_quant q
-                JOIN stock_location l ON q.location_id = l.id
-                WHERE COALESCE(q.company_id, -1) <>  COALESCE(l.company_id, -1)
-                AND q.company_id = 1
-                AND q.location_id = %s
-                AND q.product_id = %s
-                );
-                """, (location_id, product_id,))
-    merge_quant(product_id, location_id)
-
-    env.cr.execute("""
-                    SELECT
-                        sum(quantity)
-                    FROM
+        same as find_desired_quant_value but for all the pairs at once:
+        the latest done inventory line of every (product, location) is found with DISTINCT ON,
+        and the stock_move_line delta since its date is computed in one join, or read from
+        fix_quant_ledger and its tail, or everything is read from RECONCILIATION_TABLE.
+    """
+    frame = start_phase('find_desired')
+    try:
+        if RECONCILIATION_TABLE:
+            execute("""
+                DROP TABLE IF EXISTS fix_quant_desired;
+                CREATE TEMP TABLE fix_quant_desired AS
+                SELECT r.product_id, r.location_id, r.inventory_date, r.inventory_qty, r.delta_quantity, r.desired_quantity
+                FROM %s r
+                JOIN fix_quant_balance b ON b.product_id = r.product_id AND b.location_id = r.location_id;
+                ALTER TABLE fix_quant_desired ADD PRIMARY KEY (product_id, location_id);
+                ANALYZE fix_quant_desired;
+            """ % RECONCILIATION_TABLE)
+            return
+        if LEDGER:
+            # as find_ledger_delta: the ledger plus its tail when the ledger holds the delta since
+            # the latest inventory of the pair, the history for the pairs with a newer inventory
+            delta_query = """
+                SELECT t.product_id, t.location_id, t.quantity
+                FROM
+                    (%s) t
+                    JOIN latest ON latest.product_id = t.product_id AND latest.location_id = t.location_id
+                    LEFT JOIN fix_quant_ledger g ON g.product_id = t.product_id AND g.location_id = t.location_id
+                WHERE
+                    t.done
+                    AND t.counted
+                    AND t.date > latest.inventory_date
+                    AND (g.product_id IS NULL OR g.delta_date = latest.inventory_date)
+            UNION ALL
+                SELECT g.product_id, g.location_id, g.delta
+                FROM
+                    fix_quant_ledger g
+                    JOIN latest ON latest.product_id = g.product_id AND latest.location_id = g.location_id
+                WHERE g.delta_date = latest.inventory_date
+            UNION ALL
+                SELECT
+                    latest.product_id,
+                    latest.location_id,
                     (
-                        SELECT
-                            - COALESCE(SUM(qty_done),0) AS quantity
-                        FROM
-                            stock_move_line l
-                            JOIN stock_move m ON l.move_id=m.id
-                        WHERE
-                            m.state = 'done'
-                            AND l.product_id = %s
-                            AND l.location_id = %s
-                    UNION ALL
-                        SELECT
-                            COALESCE(SUM(qty_done),0) AS quantity
+                        SELECT SUM(((l.location_dest_id = latest.location_id)::integer
+                                    - (l.location_id = latest.location_id)::integer) * l.qty_done)
                         FROM
                             stock_move_line l
-                            JOIN stock_move m ON l.move_id=m.id
+                            JOIN stock_move m ON l.move_id = m.id
                         WHERE
                             m.state = 'done'
-                            AND l.product_id = %s
-                            AND l.location_dest_id = %s
+                            AND l.product_id = latest.product_id
+                            AND (l.location_id = latest.location_id OR l.location_dest_id = latest.location_id)
+                            AND l.date > latest.inventory_date
+                            AND m.inventory_id IS NULL
+                            AND m.name NOT LIKE %%(pattern)s
                     )
-                    AS ml
-                    """,(product_id, location_id, product_id, location_id))
+                FROM
+                    latest
+                    JOIN fix_quant_ledger g ON g.product_id = latest.product_id AND g.location_id = latest.location_id
+                WHERE g.delta_date <> latest.inventory_date
+            """ % ledger_tail("l.product_id IN (SELECT id FROM fix_quant_product)")
+        else:
+            delta_query = """
+                SELECT l.product_id, b.location_id, b.quantity
+                FROM
+                    stock_move_line l
+                    JOIN stock_move m ON l.move_id = m.id
+                    CROSS JOIN LATERAL (
+                        VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+                    ) AS b (location_id, quantity)
+                    JOIN latest ON latest.product_id = l.product_id AND latest.location_id = b.location_id
+                WHERE
+                    m.state = 'done'
+                    AND l.date > latest.inventory_date
+                    AND m.inventory_id IS NULL
+                    AND m.name NOT LIKE %(pattern)s
+            """
+        execute("""
+            DROP TABLE IF EXISTS fix_quant_desired;
+            CREATE TEMP TABLE fix_quant_desired AS
+            WITH
+            inventory AS (
+                SELECT DISTINCT ON (il.product_id, il.location_id)
+                    il.product_id,
+                    il.location_id,
+                    i.date,
+                    il.product_qty
+                FROM
+                    stock_inventory i -- needed to have the state
+                    JOIN stock_inventory_line il ON il.inventory_id = i.id
+                    JOIN fix_quant_product p ON p.id = il.product_id
+                WHERE
+                    i.state = 'done'
+                ORDER BY il.product_id, il.location_id, i.date DESC, il.id DESC
+            ),
+            latest AS (
+                SELECT
+                    b.product_id,
+                    b.location_id,
+                    COALESCE(inventory.date, '1930-09-26') AS inventory_date,
+                    COALESCE(inventory.product_qty, 0) AS inventory_qty
+                FROM
+                    fix_quant_balance b
+                    LEFT JOIN inventory ON inventory.product_id = b.product_id AND inventory.location_id = b.location_id
+            ),
+            delta AS (
+                SELECT d.product_id, d.location_id, SUM(d.quantity) AS quantity
+                FROM (%s) AS d (product_id, location_id, quantity)
+                GROUP BY d.product_id, d.location_id
+            )
+            SELECT
+                latest.product_id,
+                latest.location_id,
+                latest.inventory_date,
+                latest.inventory_qty,
+                COALESCE(delta.quantity, 0) AS delta_quantity,
+                latest.inventory_qty + COALESCE(delta.quantity, 0) AS desired_quantity
+            FROM
+                latest
+                LEFT JOIN delta ON delta.product_id = latest.product_id AND delta.location_id = latest.location_id;
+            ALTER TABLE fix_quant_desired ADD PRIMARY KEY (product_id, location_id);
+            ANALYZE fix_quant_desired;
+        """ % delta_query, {'pattern': CORRECTION_MOVE_PATTERN})
+    finally:
+        end_phase(frame)
 
-    quant_value_according_to_sml = env.cr.fetchone()[0]
+def find_bulk_desired_quant_value(product_id, location_id):
+    """ return the quant value computed by bulk_find_desired_quant_values
 
-    quant_current_value = find_current_quant_value(product_id, location_id)
+        fallback on find_desired_quant_value for a pair outside of fix_quant_desired
+    """
+    frame = start_phase('find_desired')
+    try:
+        execute("""
+            SELECT inventory_date, inventory_qty, delta_quantity, desired_quantity
+            FROM fix_quant_desired
+            WHERE product_id = %s
+            AND location_id = %s
+        """, (product_id, location_id,))
+        res = env.cr.fetchone()
+        if not res:
+            return find_desired_quant_value(product_id, location_id)
+        trace('  latest_inventory_date: %s' % res[0])
+        trace('  latest_inventory_qty: %s' % res[1])
+        trace('  delta_moves_since_inventory: %s' % res[2])
+        return res[3]
+    finally:
+        end_phase(frame)
 
-    quant_delta = quant_value_according_to_sml - quant_current_value
-    print("  align quant with moves (%s)" % quant_delta )
-    insert_quant_query = """
-        INSERT INTO "stock_quant"
-        (
-            "id",
-            "create_uid",
-            "create_date",
-            "write_uid",
-            "write_date",
-            "in_date",
-            "location_id",
-            "product_id",
-            "quantity",
-            "reserved_quantity"
-        )
-        VALUES
-        (
-            Nextval('stock_quant_id_seq'), --id
-            1, --create_uid
-            (Now() at time zone 'UTC'), --create_date
-            1, --write_uid
-            (Now() at time zone 'UTC'), --write_date
-            (Now() at time zone 'UTC'), --in_date
-            %s, ------------------------------------- location_id
-            %s, ------------------------------------- product_id
-            %s, ------------------------------------- quantity,
-            0.0 -- reserved_quantity
-        )
-        """
-    env.cr.execute(insert_quant_query , (location_id, product_id, quant_delta,))
+def consolidate_quants(min_product_id, max_product_id, product_ids=None):
+    """fix the company and merge the quants of the internal locations, for all the products
+       between min_product_id and max_product_id (and in product_ids if given)
+
+        same as the company fix of realign_quant_with_moves and merge_quant, for all the
+        (product, location) at once. return the number of deleted quants.
+    """
+    frame = start_phase('merge')
+    try:
+        where = "q.product_id BETWEEN %(min_product_id)s AND %(max_product_id)s"
+        if product_ids is not None:
+            where += " AND q.product_id = ANY(%(product_ids)s)"
+        if SCOPE_LOCATION_ID or SCOPE_WAREHOUSE_ID or SCOPE_COMPANY_ID:
+            # only the internal locations of the scope
+            where += " AND q.location_id IN (SELECT id FROM fix_quant_location)"
+        params = {'min_product_id': min_product_id, 'max_product_id': max_product_id, 'product_ids': product_ids}
+        flush_writes()
 
-def set_quants(product_id, location_id):
-    "realign the quants"
+        # fix quant with and without company_id
+        execute("""
+                    UPDATE stock_quant q SET company_id = NULL
+                    FROM stock_location l
+                    WHERE q.location_id = l.id
+                    AND l.usage = 'internal'
+                    AND COALESCE(q.company_id, -1) <>  COALESCE(l.company_id, -1)
+                    AND q.company_id = 1
+                    AND """ + where, params)
 
-    quant_desired_value = find_desired_quant_value(product_id, location_id)
-    print("  quant_desired_value (%s)" % (quant_desired_value,))
-    quant_current_value = find_current_quant_value(product_id, location_id)
-    print("  quant_current_value (%s)" % (quant_current_value,))
+        execute("""
+            WITH
+            dupes AS (
+                SELECT min(q.id) as to_update_quant_id,
+                    (array_agg(q.id ORDER BY q.id))[2:array_length(array_agg(q.id), 1)] as to_delete_quant_ids,
+                    SUM(q.reserved_quantity) as reserved_quantity,
+                    SUM(q.quantity) as quantity,
+                    min(q.in_date) as in_date,
+                    min(l.company_id) as company_id
+                FROM stock_quant q
+                JOIN stock_location l ON q.location_id = l.id
+                WHERE l.usage = 'internal'
+                AND """ + where + """
+                GROUP BY q.product_id, q.location_id
+                HAVING count(q.id) > 1
+            ),
+            _up AS (
+                UPDATE stock_quant q
+                    SET quantity = d.quantity,
+                        reserved_quantity = d.reserved_quantity,
+                        in_date = d.in_date,
+                        company_id = d.company_id
+                FROM dupes d
+                WHERE d.to_update_quant_id = q.id
+            )
+       DELETE FROM stock_quant m WHERE m.id in (SELECT unnest(to_delete_quant_ids) FROM dupes)
+        """, params)
+        return env.cr.rowcount
+    finally:
+        end_phase(frame)
+
+def recompute_reserved_quantities(min_product_id, max_product_id, product_ids=None):
+    """set the reserved_quantity of the quants of the internal locations of fix_quant_location from the
+       reservations of the stock_move_line, for the products between min_product_id and max_product_id
+       (and in product_ids if given)
+
+        return the number of quants updated and inserted.
+    """
+    frame = start_phase('reserved')
+    try:
+        params = {'min_product_id': min_product_id, 'max_product_id': max_product_id, 'product_ids': product_ids}
+        products = "BETWEEN %(min_product_id)s AND %(max_product_id)s"
+        if product_ids is not None:
+            products += " AND {0}.product_id = ANY(%(product_ids)s)"
+        flush_writes()
+
+        execute("""
+            DROP TABLE IF EXISTS fix_quant_reserved;
+            CREATE TEMP TABLE fix_quant_reserved AS
+            SELECT
+                l.product_id,
+                l.location_id,
+                SUM(l.product_qty) AS quantity
+            FROM
+                stock_move_line l
+                JOIN fix_quant_location ll ON ll.id = l.location_id
+            WHERE
+                l.state NOT IN ('done', 'cancel')
+                AND l.product_id """ + products.format('l') + """
+            GROUP BY l.product_id, l.location_id
+            HAVING SUM(l.product_qty) <> 0;
+            ANALYZE fix_quant_reserved;
+        """, params)
+
+        execute("""
+            WITH
+            quant AS (
+                SELECT
+                    q.id,
+                    q.reserved_quantity,
+                    q.id = min(q.id) OVER (PARTITION BY q.product_id, q.location_id) AS first,
+                    r.quantity
+                FROM
+                    stock_quant q
+                    JOIN fix_quant_location ll ON ll.id = q.location_id
+                    LEFT JOIN fix_quant_reserved r ON r.product_id = q.product_id AND r.location_id = q.location_id
+                WHERE q.product_id """ + products.format('q') + """
+            )
+            UPDATE stock_quant q
+            SET reserved_quantity = CASE WHEN quant.first THEN COALESCE(quant.quantity, 0) ELSE 0 END
+            FROM quant
+            WHERE quant.id = q.id
+            AND q.reserved_quantity IS DISTINCT FROM CASE WHEN quant.first THEN COALESCE(quant.quantity, 0) ELSE 0 END
+        """, params)
+        updated = env.cr.rowcount
+
+        execute("""
+            INSERT INTO "stock_quant"
+            (
+                "id",
+                "create_uid",
+                "create_date",
+                "write_uid",
+                "write_date",
+                "in_date",
+                "location_id",
+                "product_id",
+                "quantity",
+                "reserved_quantity"
+            )
+            SELECT
+                Nextval('stock_quant_id_seq'), --id
+                1, --create_uid
+                (Now() at time zone 'UTC'), --create_date
+                1, --write_uid
+                (Now() at time zone 'UTC'), --write_date
+                (Now() at time zone 'UTC'), --in_date
+                r.location_id,
+                r.product_id,
+                0.0, -- quantity
+                r.quantity -- reserved_quantity
+            FROM fix_quant_reserved r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM stock_quant q WHERE q.product_id = r.product_id AND q.location_id = r.location_id
+            )
+        """)
+        inserted = env.cr.rowcount
+        info("%s - reserved quantities: %s quants updated, %s quants inserted" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), updated, inserted,))
+        return updated + inserted
+    finally:
+        end_phase(frame)
+
+def merge_all_quants():
+    "fix the company and merge the quants of the whole stock_quant table, MERGE_CHUNK_SIZE product ids at a time"
+    if 'internal_locations' not in LOADED_CACHES:
+        load_internal_locations()
+    execute("SELECT min(product_id), max(product_id) FROM stock_quant")
+    min_id, max_id = env.cr.fetchone()
+    if min_id is None:
+        return
+    for start in range(min_id, max_id + 1, MERGE_CHUNK_SIZE):
+        deleted = consolidate_quants(start, start + MERGE_CHUNK_SIZE - 1)
+        info("%s - merge quants of products %s to %s: %s quants deleted" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), start, start + MERGE_CHUNK_SIZE - 1, deleted,))
+        # keep the locks of each chunk short
+        env.cr.commit()
+
+def set_quants(product_id, location_id, quant_current_value=None):
+    """realign the quants, return the quant quantity once realigned
+
+        quant_current_value: the quant quantity before, read from stock_quant if not given
+    """
+
+    frame = start_phase('set_quants')
+    try:
+        if BULK_MODE:
+            quant_desired_value = find_bulk_desired_quant_value(product_id, location_id)
+        else:
+            quant_desired_value = find_desired_quant_value(product_id, location_id)
+        trace("  quant_desired_value (%s)" % (quant_desired_value,))
+        if quant_current_value is None:
+            quant_current_value = find_current_quant_value(product_id, location_id)
+        trace("  quant_current_value (%s)" % (quant_current_value,))
+        adjust_quant(product_id, location_id, quant_desired_value, quant_current_value)
+        return quant_desired_value
+    finally:
+        end_phase(frame)
+
+def adjust_quant(product_id, location_id, quant_desired_value, quant_current_value):
+    "correct the quant of the location from its current value to the desired one with an inventory move"
     quant_delta = quant_desired_value - quant_current_value
     if quant_delta == 0:
-        print("  adapt the quant (+0) (already at the good value)")
+        trace("  adapt the quant (+0) (already at the good value)")
         return
     elif quant_delta > 0:
         location_dest_id = location_id
         location_id = INVENTORY_LOCATION_ID
-        print("  adapt the quant (+%s)" % quant_delta)
+        trace("  adapt the quant (+%s)" % quant_delta)
     else:
         location_dest_id = INVENTORY_LOCATION_ID
         quant_delta = -quant_delta
-        print("  adapt the quant (%s)" % quant_delta)
+        trace("  adapt the quant (%s)" % quant_delta)
 
     sql_inventory_adjustment(product_id, quant_delta, location_id, location_dest_id)
 
+def load_internal_locations():
+    """load the internal locations of the scope in the fix_quant_location temporary table and INTERNAL_LOCATION_IDS
+
+        the subtree of SCOPE_LOCATION_ID or of the view location of SCOPE_WAREHOUSE_ID is found
+        with the parent_path of the locations
+    """
+    frame = start_phase('load')
+    try:
+        execute("""
+            CREATE TEMP TABLE IF NOT EXISTS fix_quant_location (id integer PRIMARY KEY);
+            TRUNCATE fix_quant_location;
+        """)
+        execute("""
+            INSERT INTO fix_quant_location (id)
+            SELECT l.id FROM stock_location l
+            WHERE l.usage = 'internal'
+            AND (%(company_id)s IS NULL OR l.company_id = %(company_id)s)
+            AND (%(location_id)s IS NULL OR l.parent_path LIKE (
+                SELECT r.parent_path || '%%' FROM stock_location r WHERE r.id = %(location_id)s
+            ))
+            AND (%(warehouse_id)s IS NULL OR l.parent_path LIKE (
+                SELECT r.parent_path || '%%'
+                FROM stock_warehouse w
+                JOIN stock_location r ON r.id = w.view_location_id
+                WHERE w.id = %(warehouse_id)s
+            ))
+            RETURNING id
+        """, {'company_id': SCOPE_COMPANY_ID, 'location_id': SCOPE_LOCATION_ID, 'warehouse_id': SCOPE_WAREHOUSE_ID})
+        INTERNAL_LOCATION_IDS.clear()
+        INTERNAL_LOCATION_IDS.update([r[0] for r in env.cr.fetchall()])
+        execute("ANALYZE fix_quant_location")
+        LOADED_CACHES.add('internal_locations')
+    finally:
+        end_phase(frame)
+
+def is_scoped():
+    "return whether the run is limited to some locations or to a product category"
+    return bool(SCOPE_LOCATION_ID or SCOPE_WAREHOUSE_ID or SCOPE_COMPANY_ID or SCOPE_CATEGORY_ID)
+
+def load_category_products():
+    "load the products of SCOPE_CATEGORY_ID and of its children in the fix_quant_scope_product temporary table"
+    frame = start_phase('load')
+    try:
+        execute("""
+            CREATE TEMP TABLE IF NOT EXISTS fix_quant_scope_product (id integer PRIMARY KEY);
+            TRUNCATE fix_quant_scope_product;
+        """)
+        if not SCOPE_CATEGORY_ID:
+            return
+        execute("""
+            INSERT INTO fix_quant_scope_product (id)
+            SELECT pp.id
+            FROM product_product pp
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            JOIN product_category c ON c.id = pt.categ_id
+            WHERE c.parent_path LIKE (SELECT r.parent_path || '%%' FROM product_category r WHERE r.id = %s)
+        """, (SCOPE_CATEGORY_ID,))
+        info("%s - %s products in the category %s" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount, SCOPE_CATEGORY_ID,))
+        execute("ANALYZE fix_quant_scope_product")
+    finally:
+        end_phase(frame)
+
+def scope_products():
+    "keep in fix_quant_scope_product the products with internal locations in the scope, the only ones claimed"
+    frame = start_phase('load')
+    try:
+        execute("TRUNCATE fix_quant_scope_product")
+        execute("""
+            INSERT INTO fix_quant_scope_product (id)
+            SELECT unnest(%s::integer[])
+        """, (list(PRODUCT_LOCATIONS.keys()),))
+        execute("ANALYZE fix_quant_scope_product")
+    finally:
+        end_phase(frame)
+
+def load_product_locations():
+    """load the internal locations of the unprocessed products in PRODUCT_LOCATIONS
+
+        one grouped pass over stock_move_line, streamed through a server-side cursor
+    """
+    frame = start_phase('load')
+    try:
+        PRODUCT_LOCATIONS.clear()
+        category_join = ""
+        if SCOPE_CATEGORY_ID:
+            category_join = "JOIN fix_quant_scope_product sp ON sp.id = pl.id"
+        if INCREMENTAL:
+            # only the (product, location) touched since the previous run
+            query = """
+                SELECT t.product_id, array_agg(t.location_id)
+                FROM
+                    fix_quant_todo t
+                    JOIN product_locks pl ON pl.id = t.product_id
+                    %s
+                    JOIN fix_quant_location ll ON ll.id = t.location_id
+                WHERE
+                    pl.processed = 'f'
+                    AND pl.id BETWEEN %%s AND %%s
+                GROUP BY t.product_id
+            """ % category_join
+        else:
+            query = """
+                SELECT l.product_id, array_agg(DISTINCT b.location_id)
+                FROM
+                    stock_move_line l
+                    JOIN product_locks pl ON pl.id = l.product_id
+                    %s
+                    CROSS JOIN LATERAL (VALUES (l.location_id), (l.location_dest_id)) AS b (location_id)
+                    JOIN fix_quant_location ll ON ll.id = b.location_id
+                WHERE
+                    pl.processed = 'f'
+                    AND pl.id BETWEEN %%s AND %%s
+                GROUP BY l.product_id
+            """ % category_join
+        for product_id, location_ids in fetch_by_chunk(query, (MIN_PRODUCT_ID, MAX_PRODUCT_ID,), name='fix_quant_product_locations'):
+            PRODUCT_LOCATIONS[product_id] = tuple(location_ids)
+        LOADED_CACHES.add('product_locations')
+        info("%s - internal locations of %s products loaded" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), len(PRODUCT_LOCATIONS),))
+    finally:
+        end_phase(frame)
+
 def find_locations(product_id):
-    "find possible locations for quants based on sml"
-    env.cr.execute("""
-    SELECT l.lid AS location_id FROM
-        (
-        SELECT DISTINCT location_id lid FROM stock_move_line WHERE product_id = %s
-        UNION
-        SELECT DISTINCT location_dest_id lid FROM stock_move_line WHERE product_id = %s
-        )l
-        JOIN stock_location ll ON l.lid = ll.id
-        WHERE ll.usage = 'internal'
-    """, (product_id, product_id,))
-    return [r['location_id'] for r in env.cr.dictfetchall()]
+    """find possible locations for quants based on sml
+
+        from PRODUCT_LOCATIONS once loaded, otherwise the locations of the product in
+        stock_move_line kept if they are in INTERNAL_LOCATION_IDS
+    """
+    frame = start_phase('load')
+    try:
+        if 'product_locations' in LOADED_CACHES:
+            return list(PRODUCT_LOCATIONS.get(product_id, ()))
+        if 'internal_locations' not in LOADED_CACHES:
+            load_internal_locations()
+        execute("""
+        SELECT l.lid AS location_id FROM
+            (
+            SELECT DISTINCT location_id lid FROM stock_move_line WHERE product_id = %s
+            UNION
+            SELECT DISTINCT location_dest_id lid FROM stock_move_line WHERE product_id = %s
+            )l
+        """, (product_id, product_id,))
+        # the internal locations of the scope, without joining stock_location
+        location_ids = []
+        for row in env.cr.fetchall():
+            if row[0] in INTERNAL_LOCATION_IDS:
+                location_ids.append(row[0])
+        return location_ids
+    finally:
+        end_phase(frame)
+
+def load_product_metadata(product_ids=None):
+    "load the uom of the stockable products (all of them or product_ids) in PRODUCT_METADATA"
+    frame = start_phase('load')
+    try:
+        PRODUCT_METADATA.clear()
+        query = """
+            SELECT pp.id, pt.uom_id
+            FROM product_product pp
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            WHERE pt.type = 'product'
+        """
+        if product_ids is None:
+            for product_id, uom_id in fetch_by_chunk(query, name='fix_quant_product_metadata'):
+                PRODUCT_METADATA[product_id] = uom_id
+        else:
+            execute(query + " AND pp.id = ANY(%s)", (product_ids,))
+            for product_id, uom_id in env.cr.fetchall():
+                PRODUCT_METADATA[product_id] = uom_id
+    finally:
+        end_phase(frame)
+
+def find_product_uom(product_id):
+    "return the default uom of the product"
+    if product_id in PRODUCT_METADATA:
+        return PRODUCT_METADATA[product_id]
+    execute("""
+    SELECT t.uom_id FROM product_product p
+    JOIN product_template t ON p.product_tmpl_id = t.id
+    WHERE p.id = %s
+    """, (product_id,))
+    return env.cr.fetchone()[0]
 
 def is_stockable_product(product_id):
-    env.cr.execute("""
-                    SELECT type
-                    FROM product_template pt
-                    JOIN product_product pp ON pt.id = pp.product_tmpl_id
-                    WHERE pp.id = %s
-                    """, (product_id,))
-    if not env.cr.rowcount:
-        print("  no template for product %s" % (product_id,))
-        return
-    else:
-        return env.cr.fetchone()[0] == "product"
+    frame = start_phase('load')
+    try:
+        if product_id in PRODUCT_METADATA:
+            return True
+        execute("""
+                        SELECT type
+                        FROM product_template pt
+                        JOIN product_product pp ON pt.id = pp.product_tmpl_id
+                        WHERE pp.id = %s
+                        """, (product_id,))
+        if not env.cr.rowcount:
+            trace("  no template for product %s" % (product_id,))
+            return
+        else:
+            return env.cr.fetchone()[0] == "product"
+    finally:
+        end_phase(frame)
 
 def max_product_id():
-    env.cr.execute("""SELECT max(id) FROM product_product""")
+    execute("""SELECT max(id) FROM product_product""")
     return env.cr.fetchone()[0]
 
-def get_next_product(last_product_id):
-  found_product = False
-  offset = 0
-  while not found_product:
-    print("get_next_product: offset:%s cron_id:%s" % (offset,CRON_ID,))
-    env.cr.execute("savepoint acquire_lock")
-    try:
-      env.cr.execute("select min(id) + %s from product_locks where processed = 'f' and id > %s ", (offset,last_product_id,))
-      min_id = env.cr.fetchone()[0]
-      offset += 1
-      env.cr.execute("select id from product_locks where id = %s for update nowait",(min_id,))
-      if env.cr.rowcount:
-        return min_id
-      if offset > MAX_OFFSET:
+def prepare_product_locks():
+    "add the claimed_by, claimed_at, attempts and error columns to product_locks if needed"
+    execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'product_locks'
+        AND column_name IN ('claimed_by', 'claimed_at', 'attempts', 'error')
+    """)
+    if env.cr.rowcount == 4:
         return
-    except Exception as e:
-        env.cr.execute('rollback to savepoint acquire_lock')
+    execute("""
+        ALTER TABLE product_locks ADD COLUMN IF NOT EXISTS claimed_by varchar;
+        ALTER TABLE product_locks ADD COLUMN IF NOT EXISTS claimed_at timestamp;
+        ALTER TABLE product_locks ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0;
+        ALTER TABLE product_locks ADD COLUMN IF NOT EXISTS error varchar;
+    """)
+    env.cr.commit()
+
+def skip_non_stockable_products():
+    "flag the unprocessed products that are not stockable as processed, before claiming anything"
+    frame = start_phase('claim')
+    try:
+        execute("""
+            UPDATE product_locks
+            SET processed = 't'
+            WHERE id IN (
+                SELECT pl.id
+                FROM product_locks pl
+                WHERE pl.processed = 'f'
+                AND pl.id BETWEEN %s AND %s
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM product_product pp
+                    JOIN product_template pt ON pt.id = pp.product_tmpl_id
+                    WHERE pp.id = pl.id
+                    AND pt.type = 'product'
+                )
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (MIN_PRODUCT_ID, MAX_PRODUCT_ID,))
+        info("%s - %s non-stockable products skipped" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount,))
+        env.cr.commit()
+    finally:
+        end_phase(frame)
+
+def claim_products():
+    """claim the next CLAIM_BATCH_SIZE unprocessed products for this cron, return their ids
+
+        the products locked by another cron are skipped (SKIP LOCKED), as well as the products
+        claimed by another cron less than CLAIM_LEASE_MINUTES ago, the ones that failed
+        MAX_ATTEMPTS times and the ones that failed in this run (FAILED_PRODUCT_IDS): another cron
+        retries them. With a scope, only the products of fix_quant_scope_product are claimed.
+    """
+    frame = start_phase('claim')
+    try:
+        scope = ""
+        if is_scoped():
+            scope = "AND id IN (SELECT id FROM fix_quant_scope_product)"
+        execute("""
+            UPDATE product_locks
+            SET claimed_by = %%s,
+                claimed_at = (Now() at time zone 'UTC')
+            WHERE id IN (
+                SELECT id
+                FROM product_locks
+                WHERE processed = 'f'
+                AND id BETWEEN %%s AND %%s
+                %s
+                AND attempts < %%s
+                AND id <> ALL(%%s::integer[])
+                AND (
+                    claimed_by IS NULL
+                    OR claimed_at < (Now() at time zone 'UTC') - interval '1 minute' * %%s
+                )
+                ORDER BY id
+                LIMIT %%s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        """ % scope, (CRON_ID, MIN_PRODUCT_ID, MAX_PRODUCT_ID, MAX_ATTEMPTS, FAILED_PRODUCT_IDS, CLAIM_LEASE_MINUTES,
+                      CLAIM_BATCH_SIZE,))
+        product_ids = sorted([r[0] for r in env.cr.fetchall()])
+        CLAIMED_PRODUCT_IDS[:] = product_ids
+        info("%s - claimed %s products (cron: %s)" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), len(product_ids), CRON_ID))
+        # no commit: until the next commit(), which makes the claim visible, the claimed
+        # products stay locked and the other crons skip them
+        return product_ids
+    finally:
+        end_phase(frame)
+
+def renew_claims():
+    "renew the lease of the unprocessed products of the batch, and lock them until the next commit"
+    frame = start_phase('claim')
+    try:
+        if not CLAIMED_PRODUCT_IDS:
+            return
+        execute("""
+            UPDATE product_locks
+            SET claimed_at = (statement_timestamp() at time zone 'UTC')
+            WHERE id = ANY(%s)
+            AND claimed_by = %s
+            AND processed = 'f'
+        """, (CLAIMED_PRODUCT_IDS, CRON_ID,))
+    finally:
+        end_phase(frame)
 
 def processed(product_id):
-    env.cr.execute("update product_locks set processed = 't' where id = %s",(product_id,))
+    frame = start_phase('claim')
+    try:
+        execute("update product_locks set processed = 't' where id = %s",(product_id,))
+    finally:
+        end_phase(frame)
 
-def do_the_thing():
+def failed(product_id, error):
+    """release the product in product_locks with its error, to be claimed again by another cron
 
-    product_id = get_next_product(0)
-    while product_id:
-        if not is_stockable_product(product_id):
-            print("%s - product %s is not a stockable product, skip" %
-            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id,))
-            processed(product_id)
-            if COMMIT_EACH_PRODUCT:
-                env.cr.commit()
-            product_id = get_next_product(product_id)
-            continue
-        location_ids = find_locations(product_id)
-        if not location_ids:
-            print("%s - no location_id for product %s, skip" %
-            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id,))
-            processed(product_id)
-            if COMMIT_EACH_PRODUCT:
-                env.cr.commit()
-            product_id = get_next_product(product_id)
-            continue
-        for location_id in location_ids:
-            print("%s - prepare to handle product %s on location %s (cron: %s)" %
-            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id, location_id, CRON_ID))
-            realign_quant_with_moves(product_id, location_id)
-            set_quants(product_id,location_id)
+        after MAX_ATTEMPTS failures, the product is flagged as processed, its error kept
+    """
+    frame = start_phase('claim')
+    try:
+        FAILED_PRODUCT_IDS.append(product_id)
+        execute("""
+            UPDATE product_locks
+            SET claimed_by = NULL,
+                claimed_at = NULL,
+                attempts = attempts + 1,
+                error = %s,
+                processed = CASE WHEN attempts + 1 >= %s THEN 't' ELSE processed END
+            WHERE id = %s
+            RETURNING processed
+        """, (error, MAX_ATTEMPTS, product_id,))
+        if env.cr.fetchone()[0] == 't':
+            log("%s - product %s failed %s times, given up" %
+            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id, MAX_ATTEMPTS), level='warning')
+    finally:
+        end_phase(frame)
+
+def dry_run(write=None):
+    """compute the corrections do_the_thing() would make, without writing anything
+
+        write is called with a tuple of DRY_RUN_COLUMNS values for every (product, location)
+        with a correction (logged as CSV by default). Only temporary tables are created.
+        return the number of pairs to correct.
+    """
+    frame = start_phase('dry_run')
+    try:
+        if write is None:
+            write = lambda row: info(','.join([str(value) for value in row]))
+
+        load_internal_locations()
+        load_category_products()
+        category_join = ""
+        if SCOPE_CATEGORY_ID:
+            category_join = "JOIN fix_quant_scope_product sp ON sp.id = pl.id"
+        execute("""
+            CREATE TEMP TABLE IF NOT EXISTS fix_quant_product (id integer PRIMARY KEY);
+            TRUNCATE fix_quant_product;
+        """)
+        execute("""
+            INSERT INTO fix_quant_product (id)
+            SELECT pl.id
+            FROM product_locks pl
+            %s
+            JOIN product_product pp ON pp.id = pl.id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            WHERE pl.processed = 'f'
+            AND pl.id BETWEEN %%s AND %%s
+            AND pt.type = 'product'
+        """ % category_join, (MIN_PRODUCT_ID, MAX_PRODUCT_ID,))
+        info("%s - dry run: %s products selected" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount,))
+        execute("ANALYZE fix_quant_product")
+        bulk_compute_balances()
+        bulk_find_desired_quant_values()
+
+        query = """
+            SELECT
+                b.product_id,
+                b.location_id,
+                b.sml_quantity,
+                d.desired_quantity,
+                b.quant_quantity,
+                b.sml_quantity - b.quant_quantity,
+                d.desired_quantity - b.sml_quantity
+            FROM
+                fix_quant_balance b
+                JOIN fix_quant_desired d ON d.product_id = b.product_id AND d.location_id = b.location_id
+            WHERE
+                b.sml_quantity <> b.quant_quantity
+                OR d.desired_quantity <> b.sml_quantity
+            ORDER BY b.product_id, b.location_id
+        """
+        write(DRY_RUN_COLUMNS)
+        count = 0
+        for row in fetch_by_chunk(query, name='fix_quant_dry_run'):
+            write(row)
+            count += 1
+        info("%s - dry run: %s locations to correct" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), count,))
+        return count
+    finally:
+        end_phase(frame)
+
+def prepare_incremental_run():
+    """start a new incremental run if every product of product_locks is processed
+
+        save a new watermark, fill fix_quant_todo with the (product, location) touched since the
+        previous watermark (all of them for the first run) and flag their products as unprocessed.
+    """
+    frame = start_phase('incremental')
+    try:
+        execute("SELECT pg_advisory_xact_lock(%s)", (INCREMENTAL_LOCK_ID,))
+        execute("""
+            CREATE TABLE IF NOT EXISTS fix_quant_watermark (
+                id serial PRIMARY KEY,
+                create_date timestamp NOT NULL DEFAULT (Now() at time zone 'UTC'),
+                move_line_id integer NOT NULL,
+                pending_move_line_id integer NOT NULL,
+                inventory_line_id integer NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS fix_quant_snapshot (
+                product_id integer NOT NULL,
+                location_id integer NOT NULL,
+                quantity numeric NOT NULL,
+                write_date timestamp NOT NULL,
+                PRIMARY KEY (product_id, location_id)
+            );
+            CREATE TABLE IF NOT EXISTS fix_quant_todo (
+                product_id integer NOT NULL,
+                location_id integer NOT NULL,
+                PRIMARY KEY (product_id, location_id)
+            );
+        """)
+        execute("""
+            SELECT create_date, move_line_id, pending_move_line_id, inventory_line_id
+            FROM fix_quant_watermark
+            ORDER BY id DESC
+            LIMIT 1
+        """)
+        previous = env.cr.fetchone()
+        # the products that failed MAX_ATTEMPTS times won't be claimed again
+        execute("SELECT 1 FROM product_locks WHERE processed = 'f' AND attempts < %s LIMIT 1", (MAX_ATTEMPTS,))
+        if previous and env.cr.rowcount:
+            # the current run is not over
+            env.cr.commit()
+            return
+        execute("""
+            INSERT INTO fix_quant_watermark (move_line_id, pending_move_line_id, inventory_line_id)
+            SELECT
+                (SELECT COALESCE(max(id), 0) FROM stock_move_line),
+                COALESCE(
+                    (SELECT min(l.id) FROM stock_move_line l
+                     JOIN stock_move m ON l.move_id = m.id
+                     WHERE m.state NOT IN ('done', 'cancel')),
+                    (SELECT COALESCE(max(id), 0) + 1 FROM stock_move_line)
+                ),
+                (SELECT COALESCE(max(id), 0) FROM stock_inventory_line)
+        """)
+
+        execute("TRUNCATE fix_quant_todo")
+        if not previous:
+            todo_query = """
+                SELECT DISTINCT l.product_id, b.location_id
+                FROM
+                    stock_move_line l
+                    CROSS JOIN LATERAL (VALUES (l.location_id), (l.location_dest_id)) AS b (location_id)
+            """
+            params = None
+        else:
+            todo_query = """
+                -- new stock_move_line
+                SELECT l.product_id, b.location_id
+                FROM
+                    stock_move_line l
+                    CROSS JOIN LATERAL (VALUES (l.location_id), (l.location_dest_id)) AS b (location_id)
+                WHERE l.id > %(move_line_id)s
+            UNION
+                -- stock_move_line not done at the previous watermark and updated since
+                SELECT l.product_id, b.location_id
+                FROM
+                    stock_move_line l
+                    CROSS JOIN LATERAL (VALUES (l.location_id), (l.location_dest_id)) AS b (location_id)
+                WHERE l.id BETWEEN %(pending_move_line_id)s AND %(move_line_id)s
+                AND l.write_date > %(date)s
+            UNION
+                -- inventory adjustments done since the previous watermark
+                SELECT il.product_id, il.location_id
+                FROM
+                    stock_inventory i
+                    JOIN stock_inventory_line il ON il.inventory_id = i.id
+                WHERE i.state = 'done'
+                AND (il.id > %(inventory_line_id)s OR i.write_date > %(date)s)
+            UNION
+                -- quants changed since their snapshot
+                SELECT s.product_id, s.location_id
+                FROM
+                    fix_quant_snapshot s
+                    LEFT JOIN (
+                        SELECT product_id, location_id, SUM(quantity) AS quantity
+                        FROM stock_quant
+                        GROUP BY product_id, location_id
+                    ) q ON q.product_id = s.product_id AND q.location_id = s.location_id
+                WHERE COALESCE(q.quantity, 0) <> s.quantity
+            """
+            params = {
+                'date': previous[0],
+                'move_line_id': previous[1],
+                'pending_move_line_id': previous[2],
+                'inventory_line_id': previous[3],
+            }
+        execute("""
+            INSERT INTO fix_quant_todo (product_id, location_id)
+            SELECT t.product_id, t.location_id
+            FROM (""" + todo_query + """) t
+            JOIN stock_location ll ON ll.id = t.location_id
+            WHERE ll.usage = 'internal'
+        """, params)
+        info("%s - incremental run: %s locations to process" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), env.cr.rowcount,))
+
+        execute("""
+            INSERT INTO product_locks (id, processed)
+            SELECT pp.id, 't'
+            FROM product_product pp
+            WHERE NOT EXISTS (SELECT 1 FROM product_locks pl WHERE pl.id = pp.id)
+        """)
+        execute("""
+            UPDATE product_locks pl
+            SET processed = CASE
+                    WHEN EXISTS (SELECT 1 FROM fix_quant_todo t WHERE t.product_id = pl.id) THEN 'f'
+                    ELSE 't'
+                END,
+                claimed_by = NULL,
+                claimed_at = NULL,
+                attempts = 0,
+                error = NULL
+        """)
+        env.cr.commit()
+    finally:
+        end_phase(frame)
+
+def save_snapshot(product_id, location_id, quantity):
+    "keep the quant quantity of the fixed (product, location) for the next incremental run"
+    frame = start_phase('incremental')
+    try:
+        execute("""
+            INSERT INTO fix_quant_snapshot (product_id, location_id, quantity, write_date)
+            VALUES (%s, %s, %s, (Now() at time zone 'UTC'))
+            ON CONFLICT (product_id, location_id) DO UPDATE
+            SET quantity = EXCLUDED.quantity,
+                write_date = EXCLUDED.write_date
+        """, (product_id, location_id, quantity,))
+    finally:
+        end_phase(frame)
+
+def prepare_ledger():
+    "create the tables of the ledger if they don't exist"
+    execute("""
+        CREATE TABLE IF NOT EXISTS fix_quant_ledger (
+            product_id integer NOT NULL,
+            location_id integer NOT NULL,
+            balance numeric NOT NULL,
+            delta_date timestamp NOT NULL,
+            delta numeric NOT NULL,
+            PRIMARY KEY (product_id, location_id)
+        );
+        CREATE TABLE IF NOT EXISTS fix_quant_ledger_pending (
+            id integer PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS fix_quant_ledger_watermark (
+            id serial PRIMARY KEY,
+            create_date timestamp NOT NULL DEFAULT (Now() at time zone 'UTC'),
+            move_line_id integer NOT NULL
+        );
+    """)
+
+def ledger_tail(products):
+    """return the query of the stock_move_line not in fix_quant_ledger
+
+        the ones after the cutoff and the ones not done at the cutoff, for the products of the
+        condition on l.product_id: (product_id, location_id, quantity, date, done, counted),
+        one row for each side of the line, counted: neither an inventory nor a correction move
+    """
+    return """
+        SELECT
+            l.product_id,
+            b.location_id,
+            b.quantity,
+            l.date,
+            COALESCE(m.state = 'done', false) AS done,
+            COALESCE(m.inventory_id IS NULL AND m.name NOT LIKE %%(pattern)s, false) AS counted
+        FROM
+            (
+                SELECT l.product_id, l.location_id, l.location_dest_id, l.qty_done, l.date, l.move_id
+                FROM stock_move_line l
+                WHERE l.id > (SELECT COALESCE(max(move_line_id), 0) FROM fix_quant_ledger_watermark)
+                AND %s
+            UNION ALL
+                SELECT l.product_id, l.location_id, l.location_dest_id, l.qty_done, l.date, l.move_id
+                FROM fix_quant_ledger_pending p
+                JOIN stock_move_line l ON l.id = p.id
+                WHERE %s
+            ) l
+            LEFT JOIN stock_move m ON l.move_id = m.id
+            CROSS JOIN LATERAL (
+                VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+            ) AS b (location_id, quantity)
+    """ % (products, products)
+
+def find_ledger_balance(product_id, location_id):
+    "return the balance of the done stock_move_line of the pair: the ledger plus its tail"
+    frame = start_phase('realign')
+    try:
+        execute("""
+            SELECT
+                COALESCE((
+                    SELECT balance
+                    FROM fix_quant_ledger
+                    WHERE product_id = %%(product_id)s AND location_id = %%(location_id)s
+                ), 0)
+                + COALESCE((
+                    SELECT SUM(t.quantity)
+                    FROM (%s) t
+                    WHERE t.location_id = %%(location_id)s AND t.done
+                ), 0)
+        """ % ledger_tail("l.product_id = %(product_id)s"),
+            {'product_id': product_id, 'location_id': location_id, 'pattern': CORRECTION_MOVE_PATTERN})
+        return env.cr.fetchone()[0]
+    finally:
+        end_phase(frame)
+
+def find_ledger_delta(product_id, location_id, date):
+    """return the delta of find_delta_move from the ledger plus its tail
+
+        or None when the ledger holds the delta since another inventory date than date
+    """
+    execute("""
+        SELECT delta_date = %s::timestamp, delta
+        FROM fix_quant_ledger
+        WHERE product_id = %s AND location_id = %s
+    """, (date, product_id, location_id,))
+    row = env.cr.fetchone()
+    if row and not row[0]:
+        trace("  the ledger has a delta since another inventory, read the history")
+        return None
+    execute("""
+        SELECT COALESCE(SUM(t.quantity), 0)
+        FROM (%s) t
+        WHERE t.location_id = %%(location_id)s AND t.done AND t.counted AND t.date > %%(date)s
+    """ % ledger_tail("l.product_id = %(product_id)s"),
+        {'product_id': product_id, 'location_id': location_id, 'date': date, 'pattern': CORRECTION_MOVE_PATTERN})
+    return (row[1] if row else 0) + env.cr.fetchone()[0]
+
+def roll_forward_ledger(cutoff_date=None, move_line_id=None, rebuild=False):
+    """move the cutoff of fix_quant_ledger forward, reading only the stock_move_line since the previous one
+
+        the new cutoff is move_line_id, or the latest stock_move_line dated before cutoff_date,
+        or the latest stock_move_line; rebuild: start again from an empty ledger (this commits)
+    """
+    frame = start_phase('ledger')
+    locked = False
+    try:
+        prepare_ledger()
+        env.cr.commit()
+        # a session lock: the roll forward spans several transactions
+        execute("SELECT pg_advisory_lock(%s)", (LEDGER_LOCK_ID,))
+        locked = True
+        if rebuild:
+            execute("TRUNCATE fix_quant_ledger, fix_quant_ledger_pending, fix_quant_ledger_watermark")
+        execute("SELECT COALESCE(max(move_line_id), 0) FROM fix_quant_ledger_watermark")
+        previous = env.cr.fetchone()[0]
+        if cutoff_date and not move_line_id:
+            execute("""
+                SELECT id, txid_snapshot_xmax(txid_current_snapshot()) FROM stock_move_line
+                WHERE date <= %s ORDER BY id DESC LIMIT 1
+            """, (cutoff_date,))
+        else:
+            execute("""
+                SELECT LEAST(max(id), %s), txid_snapshot_xmax(txid_current_snapshot()) FROM stock_move_line
+            """, (move_line_id,))
+        row = env.cr.fetchone()
+        move_line_id = max(row and row[0] or 0, previous)
+        xmax = row[1] if row else None
+        env.cr.commit()
+        # a move line below the cutoff that isn't visible yet belongs to a transaction running at the
+        # snapshot of the cutoff: wait until all of them ended, instead of locking stock_move_line
+        waited = 0
+        ended = not xmax
+        while not ended:
+            execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) >= %s", (xmax,))
+            ended = env.cr.fetchone()[0]
+            env.cr.commit()
+            if not ended:
+                if waited >= LEDGER_WAIT_SECONDS:
+                    break
+                execute("SELECT pg_sleep(1)")
+                waited += 1
+        if not ended:
+            log("%s - ledger: transactions older than the cutoff %s still running after %s seconds, "
+                "the cutoff stays at %s" %
+                (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), move_line_id, waited, previous),
+                level='warning')
+            move_line_id = previous
+        # one snapshot for the rest of the roll forward: the lines done after it stay pending
+        execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+        # the pairs with a newer inventory: their delta since it, up to the previous cutoff
+        execute("""
+            WITH
+            inventory AS (
+                SELECT DISTINCT ON (il.product_id, il.location_id)
+                    il.product_id,
+                    il.location_id,
+                    i.date
+                FROM
+                    stock_inventory i -- needed to have the state
+                    JOIN stock_inventory_line il ON il.inventory_id = i.id
+                WHERE
+                    i.state = 'done'
+                ORDER BY il.product_id, il.location_id, i.date DESC, il.id DESC
+            ),
+            changed AS (
+                SELECT g.product_id, g.location_id, COALESCE(inventory.date, '1930-09-26') AS date
+                FROM
+                    fix_quant_ledger g
+                    LEFT JOIN inventory ON inventory.product_id = g.product_id AND inventory.location_id = g.location_id
+                WHERE COALESCE(inventory.date, '1930-09-26') <> g.delta_date
+            )
+            UPDATE fix_quant_ledger g
+            SET delta_date = c.date,
+                delta = COALESCE((
+                    SELECT SUM(((l.location_dest_id = c.location_id)::integer
+                                - (l.location_id = c.location_id)::integer) * l.qty_done)
+                    FROM
+                        stock_move_line l
+                        JOIN stock_move m ON l.move_id = m.id
+                    WHERE
+                        m.state = 'done'
+                        AND l.product_id = c.product_id
+                        AND (l.location_id = c.location_id OR l.location_dest_id = c.location_id)
+                        AND l.id <= %(previous)s
+                        AND l.id NOT IN (SELECT id FROM fix_quant_ledger_pending)
+                        AND l.date > c.date
+                        AND m.inventory_id IS NULL
+                        AND m.name NOT LIKE %(pattern)s
+                ), 0)
+            FROM changed c
+            WHERE g.product_id = c.product_id AND g.location_id = c.location_id
+        """, {'previous': previous, 'pattern': CORRECTION_MOVE_PATTERN})
+        inventories = env.cr.rowcount
+
+        execute("""
+            DROP TABLE IF EXISTS fix_quant_ledger_tail;
+            CREATE TEMP TABLE fix_quant_ledger_tail AS
+            SELECT l.id, l.product_id, l.location_id, l.location_dest_id, l.qty_done, l.date, m.state,
+                (m.inventory_id IS NULL AND m.name NOT LIKE %(pattern)s) AS counted
+            FROM
+                (
+                    SELECT l.* FROM stock_move_line l
+                    WHERE l.id > %(previous)s AND l.id <= %(cutoff)s
+                UNION ALL
+                    SELECT l.* FROM fix_quant_ledger_pending p JOIN stock_move_line l ON l.id = p.id
+                ) l
+                LEFT JOIN stock_move m ON l.move_id = m.id;
+        """, {'previous': previous, 'cutoff': move_line_id, 'pattern': CORRECTION_MOVE_PATTERN})
+        lines = env.cr.rowcount
+        # the delta of a new pair starts at its latest inventory; the pairs with only cancelled or
+        # pending lines get a balance of 0, as in the history
+        execute("""
+            INSERT INTO fix_quant_ledger (product_id, location_id, balance, delta_date, delta)
+            SELECT
+                t.product_id,
+                b.location_id,
+                COALESCE(SUM(b.quantity) FILTER (WHERE t.state = 'done'), 0),
+                d.date,
+                COALESCE(SUM(b.quantity) FILTER (WHERE t.state = 'done' AND t.counted AND t.date > d.date), 0)
+            FROM
+                fix_quant_ledger_tail t
+                CROSS JOIN LATERAL (
+                    VALUES (t.location_id, - t.qty_done), (t.location_dest_id, t.qty_done)
+                ) AS b (location_id, quantity)
+                JOIN stock_location ll ON ll.id = b.location_id AND ll.usage = 'internal'
+                LEFT JOIN fix_quant_ledger g ON g.product_id = t.product_id AND g.location_id = b.location_id
+                LEFT JOIN LATERAL (
+                    SELECT i.date
+                    FROM
+                        stock_inventory i
+                        JOIN stock_inventory_line il ON il.inventory_id = i.id
+                    WHERE
+                        i.state = 'done'
+                        AND il.product_id = t.product_id
+                        AND il.location_id = b.location_id
+                    ORDER BY i.date DESC, il.id DESC
+                    LIMIT 1
+                ) inventory ON g.product_id IS NULL
+                CROSS JOIN LATERAL (
+                    SELECT COALESCE(g.delta_date, inventory.date, '1930-09-26')
+                ) AS d (date)
+            GROUP BY t.product_id, b.location_id, d.date
+            ON CONFLICT (product_id, location_id) DO UPDATE
+            SET balance = fix_quant_ledger.balance + EXCLUDED.balance,
+                delta = fix_quant_ledger.delta + EXCLUDED.delta
+        """)
+        pairs = env.cr.rowcount
+        execute("""
+            DELETE FROM fix_quant_ledger_pending;
+            INSERT INTO fix_quant_ledger_pending (id)
+            SELECT id FROM fix_quant_ledger_tail
+            WHERE state IS NULL OR state NOT IN ('done', 'cancel');
+        """)
+        pending = env.cr.rowcount
+        execute("INSERT INTO fix_quant_ledger_watermark (move_line_id) VALUES (%s)", (move_line_id,))
+        execute("DROP TABLE fix_quant_ledger_tail")
+        env.cr.commit()
+        info("%s - ledger rolled forward from move line %s to %s: %s move lines, %s locations updated, "
+             "%s new inventories, %s move lines pending" %
+             (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), previous, move_line_id, lines, pairs,
+              inventories, pending))
+    finally:
+        if locked:
+            # nothing left to roll back after the commit, needed to unlock after an error
+            env.cr.rollback()
+            execute("SELECT pg_advisory_unlock(%s)", (LEDGER_LOCK_ID,))
+        end_phase(frame)
+
+# state of the internal locations of %(product_id)s, in one query:
+# (location_id, sml_quantity, quant_quantity, desired_quantity)
+PRODUCT_STATE_QUERY = """
+    WITH
+    inventory AS (
+        SELECT DISTINCT ON (il.location_id)
+            il.location_id,
+            i.date,
+            il.product_qty
+        FROM
+            stock_inventory i -- needed to have the state
+            JOIN stock_inventory_line il ON il.inventory_id = i.id
+        WHERE
+            i.state = 'done'
+            AND il.product_id = %(product_id)s
+        ORDER BY il.location_id, i.date DESC, il.id DESC
+    ),
+    sml AS (
+        SELECT
+            b.location_id,
+            COALESCE(SUM(b.quantity) FILTER (WHERE m.state = 'done'), 0) AS quantity,
+            COALESCE(SUM(b.quantity) FILTER (
+                WHERE m.state = 'done'
+                AND l.date > COALESCE(inventory.date, '1930-09-26')
+                AND m.inventory_id IS NULL
+                AND m.name NOT LIKE %(pattern)s
+            ), 0) AS delta
+        FROM
+            stock_move_line l
+            LEFT JOIN stock_move m ON l.move_id = m.id
+            CROSS JOIN LATERAL (
+                VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+            ) AS b (location_id, quantity)
+            JOIN stock_location ll ON ll.id = b.location_id AND ll.usage = 'internal'
+            LEFT JOIN inventory ON inventory.location_id = b.location_id
+        WHERE l.product_id = %(product_id)s
+        GROUP BY b.location_id
+    ),
+    quant AS (
+        SELECT location_id, SUM(quantity) AS quantity
+        FROM stock_quant
+        WHERE product_id = %(product_id)s
+        GROUP BY location_id
+    )
+    SELECT
+        sml.location_id,
+        sml.quantity,
+        COALESCE(quant.quantity, 0),
+        COALESCE(inventory.product_qty, 0) + sml.delta
+    FROM
+        sml
+        LEFT JOIN quant ON quant.location_id = sml.location_id
+        LEFT JOIN inventory ON inventory.location_id = sml.location_id
+    ORDER BY sml.location_id
+"""
+
+# PRODUCT_STATE_QUERY with LEDGER: the balance is the ledger plus its tail, the delta too when the
+# ledger holds the delta since the latest inventory of the location (as find_ledger_delta)
+PRODUCT_LEDGER_STATE_QUERY = """
+    WITH
+    inventory AS (
+        SELECT DISTINCT ON (il.location_id)
+            il.location_id,
+            i.date,
+            il.product_qty
+        FROM
+            stock_inventory i -- needed to have the state
+            JOIN stock_inventory_line il ON il.inventory_id = i.id
+        WHERE
+            i.state = 'done'
+            AND il.product_id = %%(product_id)s
+        ORDER BY il.location_id, i.date DESC, il.id DESC
+    ),
+    tail AS (%s),
+    sml AS (
+        SELECT s.location_id, SUM(s.quantity) AS quantity
+        FROM
+            (
+                SELECT g.location_id, g.balance AS quantity
+                FROM fix_quant_ledger g
+                WHERE g.product_id = %%(product_id)s
+            UNION ALL
+                SELECT t.location_id, CASE WHEN t.done THEN t.quantity ELSE 0 END
+                FROM tail t
+            ) s
+            JOIN stock_location ll ON ll.id = s.location_id AND ll.usage = 'internal'
+        GROUP BY s.location_id
+    ),
+    quant AS (
+        SELECT location_id, SUM(quantity) AS quantity
+        FROM stock_quant
+        WHERE product_id = %%(product_id)s
+        GROUP BY location_id
+    )
+    SELECT
+        sml.location_id,
+        sml.quantity,
+        COALESCE(quant.quantity, 0),
+        COALESCE(inventory.product_qty, 0) + CASE
+            WHEN g.product_id IS NULL OR g.delta_date = d.date THEN
+                COALESCE(g.delta, 0) + COALESCE((
+                    SELECT SUM(t.quantity)
+                    FROM tail t
+                    WHERE t.location_id = sml.location_id AND t.done AND t.counted AND t.date > d.date
+                ), 0)
+            ELSE
+                COALESCE((
+                    SELECT SUM(((l.location_dest_id = sml.location_id)::integer
+                                - (l.location_id = sml.location_id)::integer) * l.qty_done)
+                    FROM
+                        stock_move_line l
+                        JOIN stock_move m ON l.move_id = m.id
+                    WHERE
+                        m.state = 'done'
+                        AND l.product_id = %%(product_id)s
+                        AND (l.location_id = sml.location_id OR l.location_dest_id = sml.location_id)
+                        AND l.date > d.date
+                        AND m.inventory_id IS NULL
+                        AND m.name NOT LIKE %%(pattern)s
+                ), 0)
+            END
+    FROM
+        sml
+        LEFT JOIN quant ON quant.location_id = sml.location_id
+        LEFT JOIN inventory ON inventory.location_id = sml.location_id
+        LEFT JOIN fix_quant_ledger g ON g.product_id = %%(product_id)s AND g.location_id = sml.location_id
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(inventory.date, '1930-09-26')
+        ) AS d (date)
+    ORDER BY sml.location_id
+""" % ledger_tail("l.product_id = %(product_id)s")
+
+def fix_product(product_id):
+    "fix the quants of the product on all its internal locations, return the number of locations"
+
+    if not is_stockable_product(product_id):
+        trace("%s - product %s is not a stockable product, skip" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id,))
+        return 0
+    location_ids = find_locations(product_id)
+    if not location_ids:
+        trace("%s - no location_id for product %s, skip" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id,))
+        return 0
+    for location_id in location_ids:
+        start = datetime.datetime.now()
+        trace("%s - prepare to handle product %s on location %s (cron: %s)" %
+        (start.strftime('%Y/%m/%d %H:%M:%S'), product_id, location_id, CRON_ID))
+        if BULK_MODE:
+            # the quants are merged by consolidate_quants once the batch is done
+            current_quant = set_quants(product_id, location_id)
+        else:
+            current_quant = set_quants(product_id, location_id, realign_quant_with_moves(product_id, location_id))
             merge_quant(product_id, location_id)
-            current_quant = find_current_quant_value(product_id, location_id)
-            print("  current quant quantity: %s" % current_quant)
+        # the correction of the pair may still be in the write buffer: its quantity is the one
+        # set_quants returns, the quants are only read back to be logged
+        if VERBOSE:
+            trace("  current quant quantity: %s" % find_current_quant_value(product_id, location_id))
+        if INCREMENTAL:
+            save_snapshot(product_id, location_id, current_quant)
+        record_pair(product_id, location_id, (datetime.datetime.now() - start).total_seconds())
+    return len(location_ids)
+
+def fix_prefetched_product(product_id, states):
+    """fix the quants of the product from its state read ahead, return the number of locations
+
+        states: the rows of PRODUCT_STATE_QUERY (or PRODUCT_LEDGER_STATE_QUERY), read before any
+        write of the product
+        after the realignment, the current quant value is the stock_move_line balance
+    """
+    if not is_stockable_product(product_id):
+        trace("%s - product %s is not a stockable product, skip" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id,))
+        return 0
+    location_ids = set(find_locations(product_id))
+    count = 0
+    for location_id, sml_quantity, quant_quantity, desired_quantity in states:
+        if location_id not in location_ids:
+            continue
+        count += 1
+        start = datetime.datetime.now()
+        trace("%s - prepare to handle product %s on location %s (cron: %s)" %
+        (start.strftime('%Y/%m/%d %H:%M:%S'), product_id, location_id, CRON_ID))
+        fix_quant_company(product_id, location_id)
+        trace("  align quant with moves (%s)" % (sml_quantity - quant_quantity))
+        if sml_quantity != quant_quantity:
+            insert_quant(product_id, location_id, sml_quantity - quant_quantity)
+        trace("  quant_desired_value (%s)" % (desired_quantity,))
+        adjust_quant(product_id, location_id, desired_quantity, sml_quantity)
+        merge_quant(product_id, location_id)
+        if INCREMENTAL:
+            save_snapshot(product_id, location_id, desired_quantity)
+        record_pair(product_id, location_id, (datetime.datetime.now() - start).total_seconds())
+    return count
+
+def run_product(product_id, fix, *args):
+    """fix the product with fix(*args) and flag it as processed, commit if it is time
+
+        with PRODUCT_SAVEPOINTS, a failure only rolls back the product, recorded as failed
+    """
+    if not PRODUCT_SAVEPOINTS:
+        STATS['locations'] += fix(*args)
+        processed(product_id)
+    else:
+        execute("SAVEPOINT fix_quant_product")
+        PENDING_WRITES['sent_moves'] = []
+        PENDING_WRITES['sent_quants'] = []
+        PENDING_WRITES['sent_merges'] = []
+        try:
+            STATS['locations'] += fix(*args)
             processed(product_id)
-            if COMMIT_EACH_PRODUCT:
-                env.cr.commit()
-            product_id = get_next_product(product_id)
+            execute("RELEASE SAVEPOINT fix_quant_product")
+        except Exception as e:
+            execute("ROLLBACK TO SAVEPOINT fix_quant_product")
+            rollback_writes(product_id)
+            failed(product_id, str(e))
+            STATS['failed'] += 1
+            log("%s - product %s failed, rolled back: %s" %
+            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_id, e), level='warning')
+        finally:
+            PENDING_WRITES['sent_moves'] = None
+            PENDING_WRITES['sent_quants'] = None
+            PENDING_WRITES['sent_merges'] = None
+    STATS['products'] += 1
+    STATS['uncommitted'] += 1
+    if not BULK_MODE and commit_due():
+        commit()
+    log_summary()
+
+def commit_due():
+    "return whether the products fixed since the last commit must be committed"
+    if COMMIT_EACH_PRODUCT:
+        return True
+    if COMMIT_EVERY_PRODUCTS and STATS['uncommitted'] >= COMMIT_EVERY_PRODUCTS:
+        return True
+    seconds = (datetime.datetime.now() - STATS['last_commit']).total_seconds()
+    return bool(COMMIT_EVERY_SECONDS) and seconds >= COMMIT_EVERY_SECONDS
+
+def commit():
+    """send the buffered writes and commit
+
+        the lease of the rest of the batch is renewed before, so that a batch running longer than
+        CLAIM_LEASE_MINUTES isn't claimed again by another cron, and its rows locked again after
+    """
+    flush_writes()
+    renew_claims()
+    env.cr.commit()
+    renew_claims()
+    STATS['uncommitted'] = 0
+    STATS['last_commit'] = datetime.datetime.now()
+
+def do_the_thing():
+    "fix the products of product_locks between MIN_PRODUCT_ID and MAX_PRODUCT_ID"
+
+    if DRY_RUN:
+        return {'products': 0, 'locations': dry_run()}
+
+    start_stats()
+    discard_writes()
+    FAILED_PRODUCT_IDS[:] = []
+    prepare_product_locks()
+    if INCREMENTAL:
+        prepare_incremental_run()
+    if LEDGER:
+        prepare_ledger()
+    skip_non_stockable_products()
+    load_internal_locations()
+    load_category_products()
+    load_product_locations()
+    if is_scoped():
+        scope_products()
+    STATS['processed_at_start'] = count_products()[0]
+    if PRODUCT_CACHE_PER_RUN:
+        load_product_metadata()
+    product_ids = claim_products()
+    while product_ids:
+        if not PRODUCT_CACHE_PER_RUN:
+            load_product_metadata(product_ids)
+        if BULK_MODE:
+            bulk_select_products(product_ids)
+            bulk_compute_balances()
+            bulk_realign_quant_with_moves()
+            bulk_find_desired_quant_values()
+        if PREFETCH and not BULK_MODE:
+            for product_id, states in PREFETCH(product_ids):
+                run_product(product_id, fix_prefetched_product, product_id, states)
+        else:
+            for product_id in product_ids:
+                run_product(product_id, fix_product, product_id)
+        if BULK_MODE:
+            deleted = consolidate_quants(product_ids[0], product_ids[-1], product_ids)
+            info("%s - bulk: %s quants merged" %
+            (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), deleted,))
+        if RECOMPUTE_RESERVED:
+            recompute_reserved_quantities(product_ids[0], product_ids[-1], product_ids)
+        if BULK_MODE or RECOMPUTE_RESERVED:
+            if commit_due():
+                commit()
+        product_ids = claim_products()
+    flush_writes()
+    log_summary(force=True)
+    return {'products': STATS['products'], 'locations': STATS['locations'], 'failed': STATS['failed'],
+            'phases': dict(STATS['phases'])}
 
-do_the_thing()
\ No newline at end of file
+# fix-quant-runner.py loads the script without running it
+if not env.context.get('fix_quant_standalone'):
+    do_the_thing()
\ No newline at end of file
@@ -0,0 +1,868 @@
+#!/usr/bin/env python3
+"""Run fix-quant-python-sql.py outside of Odoo, with a pool of processes.
+
+The server action code is loaded as is, with an ``env`` whose cursor wraps a
+plain psycopg2 connection. The unprocessed product ids of product_locks are
+split in ranges, the ranges are processed by a pool of processes, each
+process keeping its own connection for all its ranges and committing
+independently.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo host=db" --processes 8
+
+With --dry-run, nothing is written: the corrections the run would make are
+streamed to a CSV or JSONL file (compressed if the name ends with .gz).
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo" --dry-run corrections.csv.gz
+
+With --backup before|after, the rows of stock_quant, stock_move and
+stock_move_line of the unprocessed products are streamed with COPY into
+compressed files of --backup-directory; --restore TIMESTAMP restores them.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo" --backup before --backup-directory /backups
+
+With --numpy, the stock_move_line are first read in one sequential scan
+(a server-side cursor fetching --itersize rows at a time) and aggregated
+per (product, location) with NumPy, the lines not done counting as 0: the
+move line balance, and the delta
+since the latest inventory. Compared with the quants, the result is stored
+in the fix_quant_reconciliation table, which the bulk mode of the run reads
+instead of querying stock_move_line batch after batch. The memory depends on
+the number of (product, location), not on the number of move lines.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo" --numpy --itersize 200000
+
+With --pipeline K (not with --bulk), each worker reads the state of the next
+K products (PRODUCT_STATE_QUERY, or PRODUCT_LEDGER_STATE_QUERY with --ledger)
+on a second, asyncio psycopg 3 connection in pipeline mode, while its psycopg2
+connection writes the corrections of the current product. The products are still fixed in order, each in the
+transaction of the worker: the state of a product is read before any write
+for it, and no other product writes it.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo" --pipeline 16
+
+With --audit, nothing is fixed nor written, not even a temporary table, so it
+can run on a read-only replica: the product ids of product_product are split
+in ranges checked by the pool, each (product, internal location) whose quants
+differ from the done move lines, or that has duplicate quants, is counted, and
+a JSON report with the counts and the --top largest differences is written.
+The exit status is 1 when something is wrong.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo host=replica" --audit audit.json --top 50
+
+With --ledger, the ledger of the script (fix_quant_ledger: the move line
+balance of every pair up to a cutoff) is rolled forward before the run, from
+the move lines since its previous cutoff only, and the run reads it plus the
+newer move lines instead of the whole history. --ledger-cutoff sets the
+cutoff (a move line id or a date), --ledger-rebuild starts from scratch.
+
+    python3 fix-quant-runner.py --dsn "dbname=odoo" --ledger --bulk
+
+The messages of the script (log() in a server action) go to stderr, or to
+--log-file; --verbose adds the details of each (product, location).
+
+Requires psycopg2, NumPy for --numpy and psycopg 3 for --pipeline.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fix-quant-python-sql.py')
+RECONCILIATION_TABLE = 'fix_quant_reconciliation'
+# quantities are summed as integers of millionths, to be exact
+SCALE = 1000000
+# date of find_latest_inventory_adjustment when there is no inventory
+NO_INVENTORY_DATE = '1930-09-26'
+
+_logger = logging.getLogger('fix-quant')
+
+
+class Cursor:
+    "The subset of odoo.sql_db.Cursor used by the scripts, over a psycopg2 connection."
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def execute(self, query, params=None):
+        return self.cursor.execute(query, params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def copy_expert(self, sql, file):
+        return self.cursor.copy_expert(sql, file)
+
+    def dictfetchall(self):
+        columns = [column[0] for column in self.cursor.description]
+        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def autocommit(self, on):
+        self.connection.autocommit = on
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+
+
+class Environment:
+    "Stands for the Odoo ``env`` of a server action."
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.context = {'fix_quant_standalone': True}
+
+
+def log(message, level='info'):
+    "The ``log`` of a server action, over the logging module."
+    _logger.log(logging.getLevelName(level.upper()), message)
+
+
+def load_script(env, path=SCRIPT_PATH, quiet=False, **constants):
+    """Execute the server action code without running it and return its namespace.
+
+    ``constants`` override the global variables of the script (CRON_ID,
+    COMMIT_EACH_PRODUCT, ...).
+    """
+    with open(path) as script:
+        source = script.read()
+    namespace = {'env': env, 'datetime': datetime, 'log': log}
+    if quiet:
+        namespace['log'] = lambda message, level='info': None
+    exec(compile(source, path, 'exec'), namespace)
+    namespace.update(constants)
+    return namespace
+
+
+class Prefetcher:
+    """The PREFETCH of the script: yield (product_id, state) for the products of a batch,
+    the state of the next ``depth`` products being read ahead on another connection.
+
+    The reads run on an asyncio event loop of a background thread, ``depth``
+    queries sent at once in psycopg 3 pipeline mode; the queue holding their
+    results is bounded, so the reads stay at most ``depth`` products ahead.
+    """
+
+    def __init__(self, dsn, depth, query, pattern):
+        self.dsn = dsn
+        self.depth = depth
+        self.query = query
+        self.pattern = pattern
+        self.connection = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def __call__(self, product_ids):
+        results = queue.Queue(maxsize=self.depth)
+        future = asyncio.run_coroutine_threadsafe(self.read(product_ids, results), self.loop)
+        try:
+            for _product_id in product_ids:
+                item = results.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            future.result()
+        finally:
+            # the batch was interrupted: stop reading ahead and unblock the reader
+            future.cancel()
+            while not results.empty():
+                results.get_nowait()
+
+    async def read(self, product_ids, results):
+        try:
+            if self.connection is None:
+                self.connection = await psycopg.AsyncConnection.connect(self.dsn, autocommit=True)
+            for start in range(0, len(product_ids), self.depth):
+                chunk = product_ids[start:start + self.depth]
+                async with self.connection.pipeline():
+                    cursors = [
+                        await self.connection.execute(self.query, {'product_id': product_id, 'pattern': self.pattern})
+                        for product_id in chunk
+                    ]
+                for product_id, cursor in zip(chunk, cursors):
+                    await asyncio.to_thread(results.put, (product_id, await cursor.fetchall()))
+        except Exception as exception:
+            await asyncio.to_thread(results.put, exception)
+            raise
+
+
+def connect(dsn, **constants):
+    "Open a connection and load the script on it."
+    env = Environment(Cursor(psycopg2.connect(dsn)))
+    return load_script(env, **constants)
+
+
+def product_ranges(dsn, count, query="SELECT min(id), max(id) FROM product_locks WHERE processed = 'f'"):
+    "Split the product ids of ``query`` (the unprocessed ones of product_locks) in ``count`` ranges."
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection.cursor() as cr:
+            cr.execute(query)
+            min_id, max_id = cr.fetchone()
+    finally:
+        connection.close()
+    if min_id is None:
+        return []
+    size = max(1, (max_id - min_id + count) // count)
+    return [(start, min(start + size - 1, max_id)) for start in range(min_id, max_id + 1, size)]
+
+
+# the script namespace of the current worker process
+_worker = {}
+
+
+def init_worker(dsn, quiet, constants, log_level, log_file, pipeline=None):
+    "Pool initializer: one connection per worker process, kept for all its ranges."
+    setup_logging(log_level, log_file)
+    constants = dict(constants, CRON_ID='runner-%s' % os.getpid())
+    namespace = _worker['namespace'] = connect(dsn, quiet=quiet, **constants)
+    if pipeline:
+        query = namespace['PRODUCT_LEDGER_STATE_QUERY' if namespace['LEDGER'] else 'PRODUCT_STATE_QUERY']
+        namespace['PREFETCH'] = Prefetcher(dsn, pipeline, query, namespace['CORRECTION_MOVE_PATTERN'])
+
+
+def run_range(product_range):
+    "Fix the products of the range, commit, and return the worker statistics."
+    namespace = _worker['namespace']
+    namespace['MIN_PRODUCT_ID'], namespace['MAX_PRODUCT_ID'] = product_range
+    start = time.monotonic()
+    try:
+        stats = namespace['do_the_thing']()
+        namespace['env'].cr.commit()
+    except Exception:
+        namespace['env'].cr.rollback()
+        raise
+    return os.getpid(), product_range, stats, time.monotonic() - start
+
+
+def report(results, elapsed):
+    "Print the throughput of each worker and of the whole run, and the time of each phase."
+    workers = {}
+    for pid, _product_range, stats, seconds in results:
+        worker = workers.setdefault(pid, {'ranges': 0, 'products': 0, 'locations': 0, 'seconds': 0.0})
+        worker['ranges'] += 1
+        worker['products'] += stats['products']
+        worker['locations'] += stats['locations']
+        worker['seconds'] += seconds
+    print('%-10s %8s %10s %10s %10s %12s' % ('worker', 'ranges', 'products', 'locations', 'seconds', 'products/s'))
+    for pid, worker in sorted(workers.items()):
+        print('%-10s %8s %10s %10s %10.1f %12.2f' % (
+            pid, worker['ranges'], worker['products'], worker['locations'], worker['seconds'],
+            worker['products'] / worker['seconds'] if worker['seconds'] else 0.0))
+    products = sum(worker['products'] for worker in workers.values())
+    print('total: %s products in %.1f seconds (%.2f products/s)' % (
+        products, elapsed, products / elapsed if elapsed else 0.0))
+    phases = {}
+    for _pid, _product_range, stats, _seconds in results:
+        for phase, phase_stats in stats.get('phases', {}).items():
+            total = phases.setdefault(phase, dict.fromkeys(phase_stats, 0))
+            for key, value in phase_stats.items():
+                total[key] += value
+    print('%-14s %10s %10s %10s %14s %12s' % ('phase', 'calls', 'seconds', 'queries', 'query seconds', 'rows'))
+    for phase, total in sorted(phases.items(), key=lambda item: -item[1]['seconds']):
+        print('%-14s %10s %10.1f %10s %14.1f %12s' % (
+            phase, total['calls'], total['seconds'], total['queries'], total['query_seconds'], total['rows']))
+
+
+def dry_run(dsn, path, quiet, constants):
+    "Stream the corrections of the run to a CSV or JSONL file, and roll back."
+    namespace = connect(dsn, quiet=quiet, **constants)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as output:
+        if path.endswith(('.jsonl', '.jsonl.gz')):
+            columns = namespace['DRY_RUN_COLUMNS']
+
+            def write(row):
+                if row is not columns:
+                    output.write(json.dumps(dict(zip(columns, row)), default=_json_default) + '\n')
+        else:
+            write = csv.writer(output).writerow
+        try:
+            count = namespace['dry_run'](write)
+        finally:
+            namespace['env'].cr.rollback()
+            namespace['env'].cr.close()
+    print('%s locations to correct, written to %s' % (count, path))
+
+
+def backup(dsn, before_after, directory, quiet):
+    "Stream the backup rows of the run in compressed CSV files on the client."
+    namespace = connect(dsn, quiet=quiet, BACKUP_MODE='copy')
+    cr = namespace['env'].cr
+    try:
+        for name, query in namespace['backup_queries'](before_after):
+            path = os.path.join(directory, name + '.csv.gz')
+            with gzip.open(path, 'wb') as output:
+                cr.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)' % query, output)
+            print('%s: %s rows' % (path, cr.rowcount))
+        cr.commit()
+    finally:
+        cr.close()
+
+
+def restore(dsn, timestamp, directory, quiet):
+    "Load the files of a 'before' backup and restore them."
+    namespace = connect(dsn, quiet=quiet, BACKUP_MODE='copy')
+    cr = namespace['env'].cr
+    try:
+        for table in namespace['BACKUP_TABLES']:
+            name = '%s_before_%s' % (table, timestamp)
+            cr.execute('CREATE TEMP TABLE %s (LIKE %s)' % (name, table))
+            with gzip.open(os.path.join(directory, name + '.csv.gz'), 'rb') as backup_file:
+                cr.copy_expert('COPY %s FROM STDIN WITH (FORMAT csv, HEADER)' % name, backup_file)
+        namespace['restore_v12_backup'](timestamp, load=False)
+        cr.commit()
+    finally:
+        cr.close()
+
+
+class Aggregator:
+    """Sums of int64 values by int64 key, merged chunk after chunk.
+
+    Each chunk is summed by key on its own. The sums of the keys already known
+    are added in place; the new keys wait until they are as many as the known
+    ones, and are then merged in one sort, so that a chunk costs about its own
+    size, not the number of keys gathered so far.
+    """
+
+    def __init__(self):
+        self.keys = numpy.empty(0, dtype=numpy.int64)
+        self.sums = numpy.empty(0, dtype=numpy.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    def add(self, keys, values):
+        keys, values = _reduce(keys, values)
+        if len(self.keys) and len(keys):
+            index = numpy.searchsorted(self.keys, keys)
+            index[index == len(self.keys)] = 0
+            known = self.keys[index] == keys
+            # the keys of a reduced chunk are unique, so are their indexes
+            self.sums[index[known]] += values[known]
+            keys, values = keys[~known], values[~known]
+        if len(keys):
+            self.pending.append((keys, values))
+            self.pending_size += len(keys)
+            if self.pending_size >= len(self.keys):
+                self.merge()
+
+    def merge(self):
+        "Merge the new keys waiting in ``pending``."
+        if not self.pending:
+            return
+        self.keys, self.sums = _reduce(
+            numpy.concatenate([self.keys] + [keys for keys, _values in self.pending]),
+            numpy.concatenate([self.sums] + [values for _keys, values in self.pending]))
+        self.pending = []
+        self.pending_size = 0
+
+    def result(self):
+        "Return the sorted keys and their sums."
+        self.merge()
+        return self.keys, self.sums
+
+    def lookup(self, keys, default=0):
+        "Return the sums of ``keys`` (sorted or not), ``default`` for the missing ones."
+        self.merge()
+        return _lookup(self.keys, self.sums, keys, default)
+
+
+def _reduce(keys, values):
+    "Return the sorted unique ``keys`` and the sum of the ``values`` of each (exact in int64)."
+    order = numpy.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    if not len(keys):
+        return keys, values
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], numpy.add.reduceat(values, starts)
+
+
+def _lookup(sorted_keys, values, keys, default):
+    "Return the values of ``keys`` in ``sorted_keys``, ``default`` for the missing ones."
+    if not len(sorted_keys):
+        return numpy.full(len(keys), default, dtype=values.dtype)
+    index = numpy.searchsorted(sorted_keys, keys)
+    index[index == len(sorted_keys)] = 0
+    return numpy.where(sorted_keys[index] == keys, values[index], default)
+
+
+def _pair_keys(product_ids, location_ids):
+    return (product_ids.astype(numpy.int64) << 32) | location_ids.astype(numpy.int64)
+
+
+def reconcile(dsn, itersize, correction_pattern):
+    """Compute the balances and desired quantities of the unprocessed products with NumPy.
+
+    Fill RECONCILIATION_TABLE with the columns of fix_quant_balance and
+    fix_quant_desired, and return the number of (product, location) whose
+    quants differ from the move lines, and of the ones needing an inventory
+    correction.
+    """
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection.cursor() as cr:
+            cr.execute("SELECT id FROM stock_location WHERE usage = 'internal'")
+            internal_ids = numpy.array([row[0] for row in cr.fetchall()], dtype=numpy.int64)
+            # latest done inventory line of every pair, as in bulk_find_desired_quant_values
+            cr.execute("""
+                SELECT DISTINCT ON (il.product_id, il.location_id)
+                    il.product_id, il.location_id,
+                    (extract(epoch FROM i.date) * 1000000)::bigint,
+                    round(il.product_qty * %s)::bigint
+                FROM stock_inventory i
+                JOIN stock_inventory_line il ON il.inventory_id = i.id
+                JOIN product_locks pl ON pl.id = il.product_id AND pl.processed = 'f'
+                WHERE i.state = 'done'
+                ORDER BY il.product_id, il.location_id, i.date DESC, il.id DESC
+            """, (SCALE,))
+            inventories = numpy.array(cr.fetchall() or numpy.empty((0, 4)), dtype=numpy.int64).reshape(-1, 4)
+        inventory_keys = _pair_keys(inventories[:, 0], inventories[:, 1])
+        order = numpy.argsort(inventory_keys)
+        inventory_keys, inventories = inventory_keys[order], inventories[order]
+
+        balance, delta = Aggregator(), Aggregator()
+        lines = 0
+        with connection.cursor(name='fix_quant_numpy') as cr:
+            cr.itersize = itersize
+            cr.execute("""
+                SELECT
+                    l.product_id, l.location_id, l.location_dest_id,
+                    round(COALESCE(l.qty_done, 0) * %s)::bigint,
+                    (extract(epoch FROM l.date) * 1000000)::bigint,
+                    COALESCE(m.inventory_id IS NULL AND m.name NOT LIKE %s, false)::integer,
+                    COALESCE(m.state = 'done', false)::integer
+                FROM stock_move_line l
+                LEFT JOIN stock_move m ON m.id = l.move_id
+                JOIN product_locks pl ON pl.id = l.product_id AND pl.processed = 'f'
+            """, (SCALE, correction_pattern,))
+            while True:
+                rows = cr.fetchmany(itersize)
+                if not rows:
+                    break
+                lines += len(rows)
+                chunk = numpy.array(rows, dtype=numpy.int64)
+                # one negative entry on location_id, one positive on location_dest_id; the lines not
+                # done count as 0, their pairs are realigned as in bulk_compute_balances
+                done = chunk[:, 6].astype(bool)
+                keys = numpy.concatenate((_pair_keys(chunk[:, 0], chunk[:, 1]), _pair_keys(chunk[:, 0], chunk[:, 2])))
+                quantities = numpy.concatenate((numpy.where(done, -chunk[:, 3], 0), numpy.where(done, chunk[:, 3], 0)))
+                dates = numpy.concatenate((chunk[:, 4], chunk[:, 4]))
+                counted = numpy.concatenate((chunk[:, 5] & chunk[:, 6], chunk[:, 5] & chunk[:, 6])).astype(bool)
+                internal = numpy.isin(numpy.concatenate((chunk[:, 1], chunk[:, 2])), internal_ids)
+                keys, quantities, dates, counted = keys[internal], quantities[internal], dates[internal], counted[internal]
+                balance.add(keys, quantities)
+                # moves after the latest inventory, except the inventory moves and the corrections
+                inventory_dates = _lookup(inventory_keys, inventories[:, 2], keys, numpy.iinfo(numpy.int64).min)
+                after = counted & (dates > inventory_dates)
+                delta.add(keys[after], quantities[after])
+        keys, sml_quantity = balance.result()
+        _logger.info('%s move lines, %s (product, location)', lines, len(keys))
+
+        with connection.cursor(name='fix_quant_numpy_quants') as cr:
+            cr.itersize = itersize
+            cr.execute("""
+                SELECT q.product_id, q.location_id, round(sum(q.quantity) * %s)::bigint
+                FROM stock_quant q
+                JOIN product_locks pl ON pl.id = q.product_id AND pl.processed = 'f'
+                JOIN stock_location sl ON sl.id = q.location_id AND sl.usage = 'internal'
+                GROUP BY q.product_id, q.location_id
+            """, (SCALE,))
+            quants = Aggregator()
+            while True:
+                rows = cr.fetchmany(itersize)
+                if not rows:
+                    break
+                chunk = numpy.array(rows, dtype=numpy.int64)
+                quants.add(_pair_keys(chunk[:, 0], chunk[:, 1]), chunk[:, 2])
+
+        quant_quantity = quants.lookup(keys)
+        has_inventory = _lookup(inventory_keys, numpy.ones(len(inventory_keys), dtype=bool), keys, False)
+        inventory_date = _lookup(inventory_keys, inventories[:, 2], keys, 0)
+        inventory_qty = _lookup(inventory_keys, inventories[:, 3], keys, 0)
+        delta_quantity = delta.lookup(keys)
+        desired_quantity = inventory_qty + delta_quantity
+
+        with connection.cursor() as cr:
+            cr.execute("""
+                CREATE TEMP TABLE fix_quant_numpy (
+                    product_id integer, location_id integer, sml_quantity bigint, quant_quantity bigint,
+                    inventory_date bigint, inventory_qty bigint, delta_quantity bigint
+                )
+            """)
+            buffer = io.StringIO()
+            for row in zip(keys >> 32, keys & 0xffffffff, sml_quantity, quant_quantity,
+                           has_inventory, inventory_date, inventory_qty, delta_quantity):
+                buffer.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (
+                    row[0], row[1], row[2], row[3], row[5] if row[4] else '\\N', row[6], row[7]))
+            buffer.seek(0)
+            cr.copy_expert('COPY fix_quant_numpy FROM STDIN', buffer)
+            cr.execute("""
+                DROP TABLE IF EXISTS {table};
+                CREATE UNLOGGED TABLE {table} AS
+                SELECT
+                    product_id,
+                    location_id,
+                    sml_quantity / %(scale)s::numeric AS sml_quantity,
+                    quant_quantity / %(scale)s::numeric AS quant_quantity,
+                    COALESCE(to_timestamp(inventory_date / 1000000.0) AT TIME ZONE 'UTC',
+                             %(no_inventory)s::timestamp) AS inventory_date,
+                    inventory_qty / %(scale)s::numeric AS inventory_qty,
+                    delta_quantity / %(scale)s::numeric AS delta_quantity,
+                    (inventory_qty + delta_quantity) / %(scale)s::numeric AS desired_quantity
+                FROM fix_quant_numpy;
+                ALTER TABLE {table} ADD PRIMARY KEY (product_id, location_id);
+                ANALYZE {table};
+            """.format(table=RECONCILIATION_TABLE), {'scale': SCALE, 'no_inventory': NO_INVENTORY_DATE})
+        connection.commit()
+    finally:
+        connection.close()
+    return int((sml_quantity != quant_quantity).sum()), int((desired_quantity != sml_quantity).sum())
+
+
+# one pass over the move lines and the quants of a range of products, nothing
+# stored: the pairs are aggregated in the query, the largest differences sliced
+AUDIT_QUERY = """
+    WITH
+    sml AS (
+        SELECT l.product_id, b.location_id, SUM(b.quantity) AS quantity
+        FROM
+            stock_move_line l
+            JOIN stock_move m ON m.id = l.move_id AND m.state = 'done'
+            CROSS JOIN LATERAL (
+                VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+            ) AS b (location_id, quantity)
+            JOIN stock_location sl ON sl.id = b.location_id AND sl.usage = 'internal'
+        WHERE l.product_id BETWEEN %(min_id)s AND %(max_id)s
+        GROUP BY l.product_id, b.location_id
+    ),
+    quant AS (
+        SELECT q.product_id, q.location_id, SUM(q.quantity) AS quantity, count(*) AS quants
+        FROM
+            stock_quant q
+            JOIN stock_location sl ON sl.id = q.location_id AND sl.usage = 'internal'
+        WHERE q.product_id BETWEEN %(min_id)s AND %(max_id)s
+        GROUP BY q.product_id, q.location_id
+    ),
+    pair AS (
+        SELECT
+            COALESCE(sml.product_id, quant.product_id) AS product_id,
+            COALESCE(sml.location_id, quant.location_id) AS location_id,
+            COALESCE(sml.quantity, 0) AS sml_quantity,
+            COALESCE(quant.quantity, 0) AS quant_quantity,
+            COALESCE(quant.quants, 0) AS quants
+        FROM
+            sml
+            FULL JOIN quant ON quant.product_id = sml.product_id AND quant.location_id = sml.location_id
+    )
+    SELECT
+        count(*),
+        count(*) FILTER (WHERE sml_quantity <> quant_quantity),
+        count(*) FILTER (WHERE quants > 1),
+        COALESCE(SUM(abs(sml_quantity - quant_quantity)), 0),
+        (array_agg(json_build_object(
+            'product_id', pair.product_id, 'location_id', location_id,
+            'sml_quantity', sml_quantity, 'quant_quantity', quant_quantity, 'quants', quants
+        ) ORDER BY abs(sml_quantity - quant_quantity) DESC, quants DESC)
+         FILTER (WHERE sml_quantity <> quant_quantity OR quants > 1))[1:%(top)s]
+    FROM
+        pair
+        JOIN product_product pp ON pp.id = pair.product_id
+        JOIN product_template pt ON pt.id = pp.product_tmpl_id
+    WHERE pt.type = 'product'
+"""
+
+
+def init_audit_worker(dsn):
+    "Pool initializer of --audit: one read-only connection per worker process."
+    connection = _worker['connection'] = psycopg2.connect(dsn)
+    connection.set_session(readonly=True, autocommit=True)
+
+
+def audit_range(args):
+    "Check the stockable products of a range and return the counts and the top offenders."
+    product_range, top = args
+    start = time.monotonic()
+    with _worker['connection'].cursor() as cr:
+        cr.execute(AUDIT_QUERY, {'min_id': product_range[0], 'max_id': product_range[1], 'top': top})
+        pairs, mismatches, duplicates, difference, offenders = cr.fetchone()
+    return {
+        'range': product_range,
+        'pairs': pairs,
+        'mismatches': mismatches,
+        'duplicates': duplicates,
+        'difference': difference,
+        'offenders': offenders or [],
+        'seconds': time.monotonic() - start,
+    }
+
+
+def audit(dsn, path, processes, count, top):
+    """Check every stockable (product, internal location) with the pool, read only.
+
+    Write the JSON report to ``path`` and return the number of mismatches plus
+    the number of pairs with duplicate quants.
+    """
+    ranges = product_ranges(dsn, count, 'SELECT min(id), max(id) FROM product_product')
+    start = time.monotonic()
+    totals = {'pairs': 0, 'mismatches': 0, 'duplicates': 0, 'difference': decimal.Decimal(0)}
+    offenders = []
+    with multiprocessing.Pool(processes, initializer=init_audit_worker, initargs=(dsn,)) as pool:
+        for result in pool.imap_unordered(audit_range, [(product_range, top) for product_range in ranges]):
+            for key in totals:
+                totals[key] += result[key]
+            # each range returns its own top: keep the global one
+            offenders = sorted(offenders + result['offenders'], key=lambda offender: (
+                -abs(offender['sml_quantity'] - offender['quant_quantity']), -offender['quants']))[:top]
+            _logger.info('products %s to %s: %s pairs, %s mismatches, %s duplicates in %.1f seconds',
+                         result['range'][0], result['range'][1], result['pairs'], result['mismatches'],
+                         result['duplicates'], result['seconds'])
+    elapsed = time.monotonic() - start
+    with open(path, 'w') as output:
+        json.dump(dict(totals, date=datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'),
+                       seconds=round(elapsed, 1), ranges=len(ranges), offenders=offenders),
+                  output, indent=1, default=_json_default)
+    print('%s - audit in %.1f seconds: %s pairs, %s mismatches (total difference %s), %s with duplicate quants' % (
+        datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), elapsed, totals['pairs'],
+        totals['mismatches'], totals['difference'], totals['duplicates']))
+    for offender in offenders[:10]:
+        print('  product %(product_id)s location %(location_id)s: moves %(sml_quantity)s, '
+              'quants %(quant_quantity)s (%(quants)s quants)' % offender)
+    print('report written to %s' % path)
+    return totals['mismatches'] + totals['duplicates']
+
+
+def drop_reconciliation(dsn):
+    "Drop RECONCILIATION_TABLE once the run is done."
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection.cursor() as cr:
+            cr.execute('DROP TABLE IF EXISTS %s' % RECONCILIATION_TABLE)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(repr(value))
+
+
+def setup_logging(level, path=None):
+    "Send the messages of the script to stderr, or append them to ``path``."
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(process)d %(levelname)s %(message)s'))
+    _logger.handlers[:] = [handler]
+    _logger.setLevel(level)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dsn', required=True, help='libpq connection string of the Odoo database')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--ranges', type=int,
+                        help='number of product id ranges (default: 4 per process)')
+    parser.add_argument('--batch-size', type=int, help='override CLAIM_BATCH_SIZE')
+    parser.add_argument('--bulk', action='store_true', help='set BULK_MODE')
+    parser.add_argument('--scope-location', type=int, metavar='ID',
+                        help='set SCOPE_LOCATION_ID: only the internal locations of the subtree of ID')
+    parser.add_argument('--scope-warehouse', type=int, metavar='ID',
+                        help='set SCOPE_WAREHOUSE_ID: only the internal locations of the warehouse ID')
+    parser.add_argument('--scope-company', type=int, metavar='ID',
+                        help='set SCOPE_COMPANY_ID: only the internal locations of the company ID')
+    parser.add_argument('--scope-category', type=int, metavar='ID',
+                        help='set SCOPE_CATEGORY_ID: only the products of the category ID and its children')
+    parser.add_argument('--commit-each-product', action='store_true',
+                        help='set COMMIT_EACH_PRODUCT, otherwise each range is committed at once')
+    parser.add_argument('--commit-every-products', type=int, metavar='N',
+                        help='set COMMIT_EVERY_PRODUCTS: commit every N products')
+    parser.add_argument('--commit-every-seconds', type=int, metavar='T',
+                        help='set COMMIT_EVERY_SECONDS: commit every T seconds')
+    parser.add_argument('--manage-indexes', action='store_true',
+                        help='create the temporary indexes of the run before it, and drop them after')
+    parser.add_argument('--recompute-reserved', action='store_true',
+                        help='set RECOMPUTE_RESERVED: recompute the reserved quantities of each batch')
+    parser.add_argument('--merge-all', action='store_true',
+                        help='after the run, fix the company and merge the quants of the whole stock_quant table')
+    parser.add_argument('--dry-run', metavar='FILE',
+                        help='write the corrections to FILE (.csv or .jsonl, optionally .gz) without fixing anything')
+    parser.add_argument('--audit', metavar='FILE',
+                        help='check the quants of every product against the move lines, read only, '
+                             'and write a JSON report to FILE')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of largest differences in the --audit report (default: 20)')
+    parser.add_argument('--backup', choices=['before', 'after'],
+                        help='write the rows the run touches to compressed files of --backup-directory')
+    parser.add_argument('--restore', metavar='TIMESTAMP',
+                        help='restore the before backup of TIMESTAMP from --backup-directory')
+    parser.add_argument('--backup-directory', default='.', help='directory of the backup files')
+    parser.add_argument('--ledger', action='store_true',
+                        help='roll the ledger of the move line balances forward before the run and set LEDGER')
+    parser.add_argument('--ledger-cutoff', metavar='ID_OR_DATE',
+                        help='cutoff of the ledger: a move line id or a date (default: the latest move line)')
+    parser.add_argument('--ledger-rebuild', action='store_true',
+                        help='rebuild the ledger from scratch instead of rolling it forward')
+    parser.add_argument('--numpy', action='store_true',
+                        help='compute the balances with one scan of stock_move_line aggregated with NumPy (bulk mode)')
+    parser.add_argument('--itersize', type=int, default=100000,
+                        help='rows fetched at a time by the --numpy scan (default: 100000)')
+    parser.add_argument('--pipeline', type=int, metavar='K',
+                        help='read the state of the next K products on a psycopg 3 pipeline while writing')
+    parser.add_argument('--quiet', action='store_true', help='silence the messages of the script')
+    parser.add_argument('--verbose', action='store_true',
+                        help='set VERBOSE: log the details of each (product, location)')
+    parser.add_argument('--summary-interval', type=int, help='override SUMMARY_INTERVAL (seconds)')
+    parser.add_argument('--log-file', help='append the messages of the script to LOG_FILE instead of stderr')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log_level = logging.DEBUG if args.verbose else logging.INFO
+    setup_logging(log_level, args.log_file)
+    scope = {
+        'SCOPE_LOCATION_ID': args.scope_location,
+        'SCOPE_WAREHOUSE_ID': args.scope_warehouse,
+        'SCOPE_COMPANY_ID': args.scope_company,
+        'SCOPE_CATEGORY_ID': args.scope_category,
+    }
+    if args.audit:
+        if audit(args.dsn, args.audit, args.processes, args.ranges or args.processes * 4, args.top):
+            raise SystemExit(1)
+        return
+    if args.backup:
+        backup(args.dsn, args.backup, args.backup_directory, args.quiet)
+        return
+    if args.restore:
+        restore(args.dsn, args.restore, args.backup_directory, args.quiet)
+        return
+
+    constants = dict(scope, COMMIT_EACH_PRODUCT=args.commit_each_product, VERBOSE=args.verbose)
+    if args.summary_interval is not None:
+        constants['SUMMARY_INTERVAL'] = args.summary_interval
+    if args.bulk:
+        constants['BULK_MODE'] = True
+    if args.batch_size:
+        constants['CLAIM_BATCH_SIZE'] = args.batch_size
+    if args.recompute_reserved:
+        constants['RECOMPUTE_RESERVED'] = True
+    if args.commit_every_products:
+        constants['COMMIT_EVERY_PRODUCTS'] = args.commit_every_products
+    if args.commit_every_seconds:
+        constants['COMMIT_EVERY_SECONDS'] = args.commit_every_seconds
+    if args.pipeline:
+        if psycopg is None:
+            raise SystemExit('--pipeline requires psycopg 3')
+        if args.bulk or args.numpy:
+            raise SystemExit('--pipeline is for the product by product mode, not with --bulk or --numpy')
+    if args.ledger:
+        namespace = connect(args.dsn, quiet=args.quiet)
+        cutoff = args.ledger_cutoff or ''
+        try:
+            namespace['roll_forward_ledger'](
+                move_line_id=int(cutoff) if cutoff.isdigit() else None,
+                cutoff_date=None if cutoff.isdigit() else cutoff or None,
+                rebuild=args.ledger_rebuild)
+        finally:
+            namespace['env'].cr.close()
+        constants['LEDGER'] = True
+    if args.numpy:
+        if numpy is None:
+            raise SystemExit('--numpy requires NumPy')
+        namespace = connect(args.dsn, quiet=True)
+        pattern = namespace['CORRECTION_MOVE_PATTERN']
+        namespace['env'].cr.close()
+        start = time.monotonic()
+        realign_count, adjust_count = reconcile(args.dsn, args.itersize, pattern)
+        print('%s - reconciliation in %.1f seconds: %s quants to realign, %s inventory corrections' % (
+            datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), time.monotonic() - start,
+            realign_count, adjust_count))
+        constants.update(BULK_MODE=True, RECONCILIATION_TABLE=RECONCILIATION_TABLE)
+
+    if args.dry_run:
+        try:
+            dry_run(args.dsn, args.dry_run, args.quiet, constants)
+        finally:
+            if args.numpy:
+                drop_reconciliation(args.dsn)
+        return
+
+    if args.manage_indexes:
+        namespace = connect(args.dsn, quiet=args.quiet)
+        try:
+            namespace['create_run_indexes']()
+        finally:
+            namespace['env'].cr.close()
+
+    ranges = product_ranges(args.dsn, args.ranges or args.processes * 4)
+    start = time.monotonic()
+    results = []
+    with multiprocessing.Pool(args.processes, initializer=init_worker,
+                              initargs=(args.dsn, args.quiet, constants, log_level, args.log_file, args.pipeline)) as pool:
+        for result in pool.imap_unordered(run_range, ranges):
+            pid, product_range, stats, seconds = result
+            print('%s - worker %s: products %s to %s, %s products (%s failed) in %.1f seconds' % (
+                datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), pid,
+                product_range[0], product_range[1], stats['products'], stats.get('failed', 0), seconds))
+            results.append(result)
+    report(results, time.monotonic() - start)
+
+    if args.numpy:
+        drop_reconciliation(args.dsn)
+
+    if args.merge_all or args.manage_indexes:
+        namespace = connect(args.dsn, quiet=args.quiet, **scope)
+        try:
+            if args.merge_all:
+                namespace['merge_all_quants']()
+            if args.manage_indexes:
+                namespace['drop_run_indexes']()
+        finally:
+            namespace['env'].cr.close()
+
+
+if __name__ == '__main__':
+    main()
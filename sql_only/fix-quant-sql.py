@@ -0,0 +1,357 @@
+
+#        This script should fix the quants, like python_sql/fix-quant-python-sql.py
+#        but all the work is done inside PostgreSQL.
+#
+#        How to use it ?
+#        ----------------
+#
+#        1. Check the global variable below.
+#        2. Copy the code in a server action and run it
+#        or
+#        2. Run it once to create the fix_quant_* functions (they are committed right away)
+#           then call fix_quant_run directly from as many sessions as you want, eg:
+#               SELECT * FROM fix_quant_run(1, 50000, 5);       -- session 1
+#               SELECT * FROM fix_quant_run(50001, 100000, 5);  -- session 2
+#
+#
+#        How does it works ?
+#        --------------------
+#
+#        fix_quant_run(product_from, product_to, inventory_location_id) does, for the
+#        product range, what do_the_thing() of python_sql/fix-quant-python-sql.py does
+#        product by product:
+#            lock the unprocessed products of the range (FOR UPDATE SKIP LOCKED, so several
+#            sessions never process the same product)
+#            compute, for every internal (product, location) of the stockable products,
+#            the stock_move_line balance, the current quant quantity and the desired quantity
+#            (latest inventory adjustment + stock_move_line delta since then)
+#            fix the quant company_id
+#            insert a quant with the delta between the stock_move_line and the quants
+#            insert the stock_move, stock_move_line and stock_quant of the inventory correction
+#            merge the quants
+#            flag the products as processed in product_locks
+#
+#        The quantities are the same than with do_the_thing(), the only difference is that
+#        no quant is inserted when a delta is 0.
+#
+#       What are the risks ?
+#       --------------------
+#
+#       Attention to reserved quantities !!!
+#       The moves created by the script (named 'correction_script product ...') are not counted in
+#       the delta since the latest inventory adjustment, so running the script again doesn't apply
+#       the same correction twice.
+#
+#
+#       Before running the script :
+#       ---------------------------
+#
+#       - make a backup before and after
+#       - create the following table:
+#           CREATE TABLE product_locks AS SELECT id, 'f' AS processed FROM product_product;
+
+INVENTORY_LOCATION_ID = 5
+PRODUCT_RANGE_SIZE = 1000
+COMMIT_EACH_RANGE = False
+FUNCTIONS_LOCK_ID = 424242
+
+FUNCTIONS_QUERY = """
+CREATE OR REPLACE FUNCTION fix_quant_select_products(p_product_from integer, p_product_to integer)
+RETURNS integer
+LANGUAGE plpgsql AS $$
+-- lock the unprocessed products of the range and keep them in fix_quant_sql_product
+DECLARE
+    product_count integer;
+BEGIN
+    DROP TABLE IF EXISTS fix_quant_sql_product;
+    CREATE TEMP TABLE fix_quant_sql_product (id integer PRIMARY KEY, stockable boolean);
+    INSERT INTO fix_quant_sql_product (id, stockable)
+    SELECT pl.id, COALESCE(pt.type = 'product', false)
+    FROM product_locks pl
+    LEFT JOIN product_product pp ON pp.id = pl.id
+    LEFT JOIN product_template pt ON pt.id = pp.product_tmpl_id
+    WHERE pl.processed = 'f'
+    AND pl.id BETWEEN p_product_from AND p_product_to
+    FOR UPDATE OF pl SKIP LOCKED;
+    GET DIAGNOSTICS product_count = ROW_COUNT;
+    ANALYZE fix_quant_sql_product;
+    RETURN product_count;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION fix_quant_compute_pairs()
+RETURNS integer
+LANGUAGE plpgsql AS $$
+-- fill fix_quant_sql_pair with the internal (product, location) of the stockable products
+-- of fix_quant_sql_product, their stock_move_line balance, current and desired quant quantity
+DECLARE
+    pair_count integer;
+BEGIN
+    DROP TABLE IF EXISTS fix_quant_sql_pair;
+    CREATE TEMP TABLE fix_quant_sql_pair AS
+    WITH
+    sml AS (
+        SELECT
+            l.product_id,
+            b.location_id,
+            COALESCE(SUM(b.quantity) FILTER (WHERE m.state = 'done'), 0) AS quantity
+        FROM
+            stock_move_line l
+            JOIN fix_quant_sql_product p ON p.id = l.product_id AND p.stockable
+            LEFT JOIN stock_move m ON l.move_id = m.id
+            CROSS JOIN LATERAL (
+                VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+            ) AS b (location_id, quantity)
+            JOIN stock_location ll ON ll.id = b.location_id
+        WHERE
+            ll.usage = 'internal'
+        GROUP BY l.product_id, b.location_id
+    ),
+    quant AS (
+        SELECT q.product_id, q.location_id, SUM(q.quantity) AS quantity
+        FROM stock_quant q
+        JOIN fix_quant_sql_product p ON p.id = q.product_id AND p.stockable
+        GROUP BY q.product_id, q.location_id
+    ),
+    inventory AS (
+        SELECT DISTINCT ON (il.product_id, il.location_id)
+            il.product_id,
+            il.location_id,
+            i.date,
+            il.product_qty
+        FROM
+            stock_inventory i
+            JOIN stock_inventory_line il ON il.inventory_id = i.id
+            JOIN fix_quant_sql_product p ON p.id = il.product_id AND p.stockable
+        WHERE
+            i.state = 'done'
+        ORDER BY il.product_id, il.location_id, i.date DESC, il.id DESC
+    ),
+    latest AS (
+        SELECT
+            sml.product_id,
+            sml.location_id,
+            COALESCE(inventory.date, '1930-09-26') AS inventory_date,
+            COALESCE(inventory.product_qty, 0) AS inventory_qty
+        FROM
+            sml
+            LEFT JOIN inventory ON inventory.product_id = sml.product_id AND inventory.location_id = sml.location_id
+    ),
+    delta AS (
+        SELECT
+            latest.product_id,
+            latest.location_id,
+            SUM(b.quantity) AS quantity
+        FROM
+            stock_move_line l
+            JOIN stock_move m ON l.move_id = m.id
+            CROSS JOIN LATERAL (
+                VALUES (l.location_id, - l.qty_done), (l.location_dest_id, l.qty_done)
+            ) AS b (location_id, quantity)
+            JOIN latest ON latest.product_id = l.product_id AND latest.location_id = b.location_id
+        WHERE
+            m.state = 'done'
+            AND l.date > latest.inventory_date
+            AND m.inventory_id IS NULL
+            AND m.name NOT LIKE 'correction_script product %'
+        GROUP BY latest.product_id, latest.location_id
+    )
+    SELECT
+        sml.product_id,
+        sml.location_id,
+        sml.quantity AS sml_quantity,
+        COALESCE(quant.quantity, 0) AS quant_quantity,
+        latest.inventory_qty + COALESCE(delta.quantity, 0) AS desired_quantity
+    FROM
+        sml
+        JOIN latest ON latest.product_id = sml.product_id AND latest.location_id = sml.location_id
+        LEFT JOIN quant ON quant.product_id = sml.product_id AND quant.location_id = sml.location_id
+        LEFT JOIN delta ON delta.product_id = sml.product_id AND delta.location_id = sml.location_id;
+    SELECT count(*) INTO pair_count FROM fix_quant_sql_pair;
+    ALTER TABLE fix_quant_sql_pair ADD PRIMARY KEY (product_id, location_id);
+    ANALYZE fix_quant_sql_pair;
+    RETURN pair_count;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION fix_quant_realign()
+RETURNS integer
+LANGUAGE plpgsql AS $$
+-- makes the quants of fix_quant_sql_pair great again
+DECLARE
+    realigned_count integer;
+BEGIN
+    -- fix quant with and without company_id
+    UPDATE stock_quant q SET company_id = NULL
+    FROM stock_location l, fix_quant_sql_pair p
+    WHERE q.location_id = l.id
+    AND p.product_id = q.product_id
+    AND p.location_id = q.location_id
+    AND COALESCE(q.company_id, -1) <> COALESCE(l.company_id, -1)
+    AND q.company_id = 1;
+
+    INSERT INTO stock_quant
+        (id, create_uid, create_date, write_uid, write_date, in_date,
+         location_id, product_id, quantity, reserved_quantity)
+    SELECT
+        Nextval('stock_quant_id_seq'), 1, (Now() at time zone 'UTC'), 1, (Now() at time zone 'UTC'), (Now() at time zone 'UTC'),
+        p.location_id, p.product_id, p.sml_quantity - p.quant_quantity, 0.0
+    FROM fix_quant_sql_pair p
+    WHERE p.sml_quantity <> p.quant_quantity;
+    GET DIAGNOSTICS realigned_count = ROW_COUNT;
+    RETURN realigned_count;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION fix_quant_adjust(p_inventory_location_id integer)
+RETURNS integer
+LANGUAGE plpgsql AS $$
+-- create the stock_move, stock_move_line and stock_quant bringing the quants of
+-- fix_quant_sql_pair from their stock_move_line balance to the desired quantity
+DECLARE
+    adjusted_count integer;
+BEGIN
+    WITH
+    corrections AS (
+        SELECT
+            p.product_id,
+            CASE WHEN p.desired_quantity > p.sml_quantity THEN p_inventory_location_id ELSE p.location_id END AS location_id,
+            CASE WHEN p.desired_quantity > p.sml_quantity THEN p.location_id ELSE p_inventory_location_id END AS location_dest_id,
+            abs(p.desired_quantity - p.sml_quantity) AS qty,
+            t.uom_id
+        FROM
+            fix_quant_sql_pair p
+            JOIN product_product pp ON pp.id = p.product_id
+            JOIN product_template t ON pp.product_tmpl_id = t.id
+        WHERE
+            p.desired_quantity <> p.sml_quantity
+    ),
+    moves AS (
+        INSERT INTO stock_move
+            (id, create_uid, create_date, write_uid, write_date, date, date_expected,
+             procure_method, company_id, is_done, location_dest_id, location_id, name,
+             product_id, product_uom, product_uom_qty, state)
+        SELECT
+            Nextval('stock_move_id_seq'), 1, (Now() at time zone 'UTC'), 1, (Now() at time zone 'UTC'),
+            (Now() at time zone 'UTC'), (Now() at time zone 'UTC'),
+            'make_to_stock', 1, 't', c.location_dest_id, c.location_id, 'correction_script product ' || c.product_id,
+            c.product_id, c.uom_id, c.qty, 'done'
+        FROM corrections c
+        RETURNING id, location_id, location_dest_id, product_id, product_uom, product_uom_qty
+    ),
+    lines AS (
+        INSERT INTO stock_move_line
+            (id, create_uid, create_date, write_uid, write_date, date, done_move,
+             location_dest_id, location_id, move_id, product_id, product_uom_id,
+             product_uom_qty, qty_done, done_wo, product_qty, state)
+        SELECT
+            Nextval('stock_move_line_id_seq'), 1, (Now() at time zone 'UTC'), 1, (Now() at time zone 'UTC'),
+            (Now() at time zone 'UTC'), 't',
+            mv.location_dest_id, mv.location_id, mv.id, mv.product_id, mv.product_uom,
+            '0.000', mv.product_uom_qty, 't', 0, 'done'
+        FROM moves mv
+    )
+    INSERT INTO stock_quant
+        (id, create_uid, create_date, write_uid, write_date, in_date,
+         location_id, product_id, quantity, reserved_quantity)
+    SELECT
+        Nextval('stock_quant_id_seq'), 1, (Now() at time zone 'UTC'), 1, (Now() at time zone 'UTC'), (Now() at time zone 'UTC'),
+        q.location_id, mv.product_id, q.quantity, 0.0
+    FROM
+        moves mv
+        CROSS JOIN LATERAL (
+            VALUES (mv.location_dest_id, mv.product_uom_qty), (mv.location_id, - mv.product_uom_qty)
+        ) AS q (location_id, quantity);
+    GET DIAGNOSTICS adjusted_count = ROW_COUNT;
+    -- two quants per correction
+    RETURN adjusted_count / 2;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION fix_quant_merge()
+RETURNS integer
+LANGUAGE plpgsql AS $$
+-- merge the quants of fix_quant_sql_pair, return the number of deleted quants
+DECLARE
+    merged_count integer;
+BEGIN
+    WITH
+    dupes AS (
+        SELECT min(qq.id) as to_update_quant_id,
+            (array_agg(qq.id ORDER BY qq.id))[2:array_length(array_agg(qq.id), 1)] as to_delete_quant_ids,
+            SUM(qq.reserved_quantity) as reserved_quantity,
+            SUM(qq.quantity) as quantity,
+            min(qq.in_date) as in_date,
+            min(l.company_id) as company_id
+        FROM stock_quant qq
+        JOIN stock_location l ON qq.location_id = l.id
+        JOIN fix_quant_sql_pair p ON p.product_id = qq.product_id AND p.location_id = qq.location_id
+        GROUP BY qq.product_id, qq.location_id
+        HAVING count(qq.id) > 1
+    ),
+    _up AS (
+        UPDATE stock_quant q
+            SET quantity = d.quantity,
+                reserved_quantity = d.reserved_quantity,
+                in_date = d.in_date,
+                company_id = d.company_id
+        FROM dupes d
+        WHERE d.to_update_quant_id = q.id
+    )
+    DELETE FROM stock_quant m WHERE m.id in (SELECT unnest(to_delete_quant_ids) FROM dupes);
+    GET DIAGNOSTICS merged_count = ROW_COUNT;
+    RETURN merged_count;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION fix_quant_run(
+    p_product_from integer,
+    p_product_to integer,
+    p_inventory_location_id integer,
+    OUT product_count integer,
+    OUT pair_count integer,
+    OUT realigned_count integer,
+    OUT adjusted_count integer,
+    OUT merged_count integer)
+LANGUAGE plpgsql AS $$
+-- fix the quants of the unprocessed products between p_product_from and p_product_to
+BEGIN
+    product_count := fix_quant_select_products(p_product_from, p_product_to);
+    pair_count := fix_quant_compute_pairs();
+    realigned_count := fix_quant_realign();
+    adjusted_count := fix_quant_adjust(p_inventory_location_id);
+    merged_count := fix_quant_merge();
+    UPDATE product_locks pl SET processed = 't'
+    FROM fix_quant_sql_product p
+    WHERE pl.id = p.id;
+END
+$$;
+"""
+
+def create_functions():
+    "create or replace the fix_quant_* functions, and commit them so every session can use them"
+    env.cr.execute("SELECT pg_advisory_xact_lock(%s)", (FUNCTIONS_LOCK_ID,))
+    env.cr.execute(FUNCTIONS_QUERY)
+    env.cr.commit()
+
+def product_ranges():
+    "split the unprocessed products of product_locks in ranges of PRODUCT_RANGE_SIZE ids"
+    env.cr.execute("SELECT min(id), max(id) FROM product_locks WHERE processed = 'f'")
+    min_id, max_id = env.cr.fetchone()
+    if min_id is None:
+        return []
+    return [(start, start + PRODUCT_RANGE_SIZE - 1) for start in range(min_id, max_id + 1, PRODUCT_RANGE_SIZE)]
+
+def do_the_thing():
+
+    create_functions()
+    for product_from, product_to in product_ranges():
+        env.cr.execute("SELECT * FROM fix_quant_run(%s, %s, %s)", (product_from, product_to, INVENTORY_LOCATION_ID,))
+        product_count, pair_count, realigned_count, adjusted_count, merged_count = env.cr.fetchone()
+        log("%s - products %s to %s: %s products, %s locations, %s quants realigned, %s corrections, %s quants merged" %
+        (datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S'), product_from, product_to,
+         product_count, pair_count, realigned_count, adjusted_count, merged_count,))
+        if COMMIT_EACH_RANGE:
+            env.cr.commit()
+
+do_the_thing()